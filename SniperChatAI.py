@@ -2,9 +2,30 @@
 # PYTHON_ARGCOMPLETE_OK
 
 # Import the required modules and the helper functions
-from required_modules import aiofiles, aiohttp, alive_bar, asyncio, OpenAI, os
-from helper import handle_error, FileParser, ArgumentParser, print_status_messages
-from openai_api_request_wrapper import openai_api_request_wrapper
+from required_modules import alive_bar, argparse, asyncio, collections, contextlib, copy, math, os, time
+from helper import (config, handle_error, setup_program, FileParser, ArgumentParser, print_program_summary,
+                    print_status_messages)
+from openai_api_request_wrapper import (build_request_payload, look_up_ai_model, openai_api_request_wrapper,
+                                        ERROR_RESPONSE_PREFIX)
+from rate_limiter import estimate_message_tokens, RateLimiter
+from concurrency_controller import AdaptiveConcurrencyController
+from request_hedger import RequestHedger
+from prompt_scheduler import estimate_prompt_tokens, get_skipped_prompts_filename, PromptScheduler
+from prompt_templates import is_template_suite, TemplateParser
+from response_cache import RequestDeduplicator, ResponseCache
+from response_scorer import read_reference_answers, ScoringPipeline
+from run_resumer import RunResumer
+from output_writer import OutputWriter
+from batch_runner import BatchRunner
+from shard_runner import ShardRunner
+from run_metrics import RunMetrics
+from http_transport import create_client_session
+
+
+# Class to carry the OpenAI API key, as a lightweight stand-in for the client of the OpenAI SDK
+class OpenAIAPIClient:
+    def __init__(self, api_key):
+        self.api_key = api_key
 
 
 # Function to set up the OpenAI API client
@@ -17,222 +38,773 @@ def setup_openai_api_client():
         handle_error("OPENAI_API_KEY environment variable not set. Aborting - no key, no ignition!",
                      "OPENAI_API_KEY environment variable was not set.")
 
+    # Only import the OpenAI SDK when asked to, as the requests are sent directly and it slows down the start
+    if not config.get('use_openai_sdk'):
+        return OpenAIAPIClient(openai_api_key)
+
+    try:
+        from openai import OpenAI
+    except ModuleNotFoundError:
+        handle_error("Python module 'openai' is missing while 'use_openai_sdk' is enabled in config.yaml. "
+                     "Install it using 'pip install openai'. Aborting launch!",
+                     "Python module 'openai' required by 'use_openai_sdk' was missing.")
+
     # Initialize the OpenAI API client with the provided API key
     client = OpenAI(api_key=openai_api_key)
     return client
 
 
 # Function to verify the connection with the OpenAI API
-async def verify_openai_api_connection(session, local_args, guidelines, client):
+async def verify_openai_api_connection(session, local_args, guidelines, client, rate_limiter=None):
+    # Leave it to the first prompts to reveal any connection issue
+    if local_args.connection_check == 'off':
+        return
+
+    # Look up each AI model, which verifies the API key and the models without spending any tokens
+    if local_args.connection_check == 'models':
+        for ai_model in local_args.ai_models:
+            await look_up_ai_model(session, client, ai_model, local_args.max_retries)
+        print_status_messages("successful_connection_with_openai_api", local_args)
+        return
+
     # Dummy prompt for the connection verification request
     dummy_prompt = "Hello!"
     messages = [{"role": "system", "content": guidelines}, {"role": "user", "content": dummy_prompt}]
 
-    # Query the OpenAI API with the prepared dummy message
-    response = await openai_api_request_wrapper(session, client, local_args, messages)
+    # Query the OpenAI API with the prepared dummy message for each AI model
+    # (a failed connection check always aborts the program)
+    for ai_model in local_args.ai_models:
+        response = await openai_api_request_wrapper(session, client,
+                                                    argparse.Namespace(**dict(vars(local_args), ai_model=ai_model)),
+                                                    messages, on_failure='abort', rate_limiter=rate_limiter)
 
     # If the connection is successful, print a success message on the terminal
     if response:
-        print_status_messages("successful_connection_with_openai_api")
+        print_status_messages("successful_connection_with_openai_api", local_args)
 
 
-# Class to manage the conversation history
+# Class to manage the conversation history, and the window of it that is sent along with each prompt
 class ConversationHistoryManager:
-    def __init__(self, conversation_mode):
+    def __init__(self, conversation_mode, token_budget=None, strategy='sliding_window', keep_first=0, keep_last=None):
         self.conversation_mode = conversation_mode  # Conversation mode (on/off)
-        self.conversation_history = []
-
-    # Method to add the current prompt to the conversation history
-    def add_prompt_to_history(self, prompt):
-        # If the conversation mode is on, append the current prompt to the existing conversation history
+        self.token_budget = token_budget  # Maximum tokens of conversation history sent with a prompt (None: unlimited)
+        self.strategy = strategy  # How the history is trimmed to the budget (sliding_window/keep_first_last/summarize)
+        self.keep_first = keep_first if strategy == 'keep_first_last' else 0  # First turns that are always kept
+        self.keep_last = keep_last if strategy == 'keep_first_last' else None  # Maximum recent turns kept
+        self.conversation_history = []  # Recorded (prompt, response) turns, may be filled up front when resuming
+        self.history_offset = 0  # Turns recorded before the branch started, shared with the branch it forked from
+        self.synced_turns = 0  # Turns of the conversation history already turned into messages
+        self.pinned_messages = []  # Messages of the first turns, that are never trimmed
+        self.pinned_tokens = 0
+        self.window = collections.deque()  # Messages and token count of the most recent turns
+        self.window_tokens = 0
+        self.summary = None  # Summary of the turns trimmed from the window (summarize strategy only)
+        self.summary_tokens = 0
+        self.trimmed_turns = []  # Messages of the trimmed turns that still await summarization
+
+    # Method to record a completed turn in the conversation history
+    def add_turn(self, prompt, response):
         if self.conversation_mode == 'on':
-            self.conversation_history.append((prompt, ""))
+            self.conversation_history.append((prompt, response))
+
+    # Method to turn the turns recorded since the last call into messages, appending them to the window
+    def sync_messages(self):
+        while self.synced_turns < self.history_offset + len(self.conversation_history):
+            prompt, response = self.conversation_history[self.synced_turns - self.history_offset]
+            self.synced_turns += 1
+
+            turn_messages = [{"role": "user", "content": prompt}, {"role": "assistant", "content": response}]
+            turn_tokens = estimate_message_tokens(turn_messages)
+            if self.synced_turns <= self.keep_first:
+                self.pinned_messages.extend(turn_messages)
+                self.pinned_tokens += turn_tokens
+            else:
+                self.window.append((turn_messages, turn_tokens))
+                self.window_tokens += turn_tokens
+                self.trim_window()
+
+    # Method to fork a branch of the conversation off the current turn (the messages of the turns recorded so far are
+    # shared with the branch rather than copied, only the window referencing them is)
+    def fork(self):
+        self.sync_messages()
+        branch = copy.copy(self)
+        branch.conversation_history = []
+        branch.history_offset = self.synced_turns
+        branch.pinned_messages = list(self.pinned_messages)
+        branch.window = collections.deque(self.window)
+        branch.trimmed_turns = list(self.trimmed_turns)
+        return branch
+
+    # Method to get the tokens of the conversation history sent along with each prompt
+    def get_history_tokens(self):
+        return self.pinned_tokens + self.summary_tokens + self.window_tokens
+
+    # Method to drop the oldest turns of the window until it fits the turn limit and the token budget
+    def trim_window(self):
+        while self.keep_last is not None and len(self.window) > self.keep_last:
+            self.drop_oldest_turn()
+
+        if self.token_budget is not None and self.get_history_tokens() > self.token_budget:
+            # The summarize strategy makes room for several turns at once, so that it does not summarize every turn
+            target = self.token_budget // 2 if self.strategy == 'summarize' else self.token_budget
+            while self.window and self.get_history_tokens() > target:
+                self.drop_oldest_turn()
+
+    # Method to drop the oldest turn of the window
+    def drop_oldest_turn(self):
+        turn_messages, turn_tokens = self.window.popleft()
+        self.window_tokens -= turn_tokens
+        if self.strategy == 'summarize':
+            self.trimmed_turns.append(turn_messages)
+
+    # Property to check whether trimmed turns are waiting to be folded into the summary (after syncing the new turns)
+    @property
+    def needs_summary(self):
+        self.sync_messages()
+        return bool(self.trimmed_turns)
+
+    # Method to hand over the trimmed turns that are to be summarized, as a transcript
+    def take_trimmed_turns(self):
+        transcript = "\n".join(f"{message['role']}: {message['content']}"
+                               for turn_messages in self.trimmed_turns for message in turn_messages)
+        self.trimmed_turns = []
+        return transcript
+
+    # Method to replace the summary of the trimmed turns
+    def set_summary(self, summary):
+        self.summary = summary
+        self.summary_tokens = estimate_message_tokens([{"content": summary}])
+        self.trim_window()  # The summary takes its share of the token budget
+
+    # Method to get the messages for a prompt: the guidelines, the conversation history window and the prompt
+    # (only the turns recorded since the last call are turned into messages)
+    def get_messages(self, guidelines, prompt):
+        messages = [{"role": "system", "content": guidelines}]
 
-        # If the conversation mode is off, replace the conversation history with only the current prompt
-        elif self.conversation_mode == 'off':
-            self.conversation_history = [(prompt, "")]
-
-    # Method to update the latest response in the conversation history
-    def update_latest_response(self, response):
-        self.conversation_history[-1] = (self.conversation_history[-1][0], response)
+        if self.conversation_mode == 'on':
+            self.sync_messages()
+            if self.summary:
+                messages.append({"role": "system", "content": f"Summary of the earlier conversation: {self.summary}"})
+            messages.extend(self.pinned_messages)
+            for turn_messages, _ in self.window:
+                messages.extend(turn_messages)
 
-    # Method to retrieve the complete conversation history
-    def get_conversation_history(self):
-        return self.conversation_history.copy()
+        messages.append({"role": "user", "content": prompt})
+        return messages
 
 
 # Class to manage the interactions with the OpenAI API
 class OpenAIConversationManager:
-    def __init__(self, local_args, client, guidelines):
+    def __init__(self, local_args, client, guidelines, rate_limiter=None, concurrency_controller=None, cache=None,
+                 conversation_id=None, metrics=None, deduplicator=None, cell=None, hedger=None):
         self.args = local_args
         self.client = client
         self.guidelines = guidelines
-        self.conversation_context = ConversationHistoryManager(local_args.conversation_mode)
-        self.results = []
+        self.rate_limiter = rate_limiter  # Rate limiter shared by every request sent to the OpenAI API
+        self.concurrency_controller = concurrency_controller  # Adaptive concurrency limit (None: fixed limit)
+        self.cache = cache  # On-disk cache of the responses (None: caching is off)
+        self.conversation_id = conversation_id  # Identifier of the conversation (None: single conversation)
+        self.metrics = metrics  # Performance metrics of the run (None: not recorded)
+        self.deduplicator = deduplicator  # Shares the responses of identical requests (None: deduplication is off)
+        self.cell = cell  # Guidelines file and AI model of the cell of a matrix run (None: single cell)
+        self.hedger = hedger  # Sends a duplicate of the slow requests (None: hedging is off)
+        self.conversation_context = ConversationHistoryManager(
+            local_args.conversation_mode, local_args.history_token_budget, local_args.history_strategy,
+            config['history_tuning']['keep_first'], config['history_tuning']['keep_last'])
+
+    # Method to start another independent conversation that shares the limits, the cache and the client
+    # (optionally in a cell of a matrix run, with the guidelines and the AI model of that cell)
+    def create_conversation(self, conversation_id, cell=None):
+        local_args, guidelines = self.args, self.guidelines
+        if cell:
+            local_args = argparse.Namespace(**dict(vars(self.args), ai_model=cell["ai_model"]))
+            guidelines = cell["guidelines"]
+        return OpenAIConversationManager(local_args, self.client, guidelines, self.rate_limiter,
+                                         self.concurrency_controller, self.cache, conversation_id, self.metrics,
+                                         self.deduplicator, cell, self.hedger)
 
     # Method to process the prompts and update the conversation history
     async def __call__(self, session, index_prompt_tuple, queue, bar=None):
         index, prompt = index_prompt_tuple  # Index and prompt for current conversation
         prompt = prompt.rstrip('\n')  # Remove trailing newlines from each prompt
 
-        # Add the current prompt to the conversation history
-        self.conversation_context.add_prompt_to_history(prompt)
-
-        # Get the local conversation history after adding the prompt
-        local_conversation_history = self.conversation_context.get_conversation_history()
+        # Fold the turns trimmed from the conversation history window into its summary
+        if self.conversation_context.needs_summary:
+            await self.summarize_trimmed_turns(session)
 
         # Query the OpenAI API to generate responses based on the current conversation history
-        responses = await self.query_openai_and_get_responses(session, local_conversation_history)
+        responses = await self.query_openai_and_get_responses(session, self.build_messages(prompt))
 
-        # Update the conversation history with the responses
-        if self.args.conversation_mode == 'on':
-            for response in responses:
-                # Reset the conversation history to its state before the responses were generated
-                self.conversation_context.conversation_history = local_conversation_history.copy()
-                self.conversation_context.update_latest_response(response)
+        # Responses of failed requests are recorded in the output, but kept out of the conversation history
+        successful_responses = [response for response in responses if not response.startswith(ERROR_RESPONSE_PREFIX)]
 
-        elif self.args.conversation_mode == 'off':
-            for response in responses:
-                self.conversation_context.update_latest_response(response)
+        # Carry the conversation on with the last response
+        self.conversation_context.add_turn(prompt, successful_responses[-1] if successful_responses else "")
 
-        # Append the results and put them in the queue
-        self.results.append((index, prompt, responses))
-        await queue.put((index, prompt, responses))
+        # Put the results in the queue of the writer task, if any
+        if queue is not None:
+            await queue.put((index, prompt, responses, self.conversation_id, self.cell, None))
 
-        return index, prompt, responses
+        return index, prompt, responses, self.conversation_id, self.cell, None
 
-    # Method to query the OpenAI API with the prepared messages and get responses
-    async def query_openai_and_get_responses(self, session, local_conversation_history):
-        messages = [{"role": "system", "content": self.guidelines}]
+    # Method to start a branch of the conversation tree, that carries on from the current turn on its own
+    def create_branch(self):
+        branch = copy.copy(self)
+        branch.conversation_context = self.conversation_context.fork()
+        return branch
 
-        # Append the previous conversation history to the message
-        for message in local_conversation_history:
-            messages.append({"role": "user", "content": message[0]})
-            messages.append({"role": "assistant", "content": message[1]})
+    # Method to process a prompt of a branch of the conversation tree: at a branching prompt each successful response
+    # carries the conversation on in a branch of its own, past them the branch carries on with a single response
+    # (returns the branch path and the conversation manager of each branch that carries on)
+    async def process_branch_prompt(self, session, index_prompt_tuple, queue, branch_path, is_branching):
+        index, prompt = index_prompt_tuple
+        prompt = prompt.rstrip('\n')  # Remove trailing newlines from each prompt
+
+        # Fold the turns trimmed from the conversation history window into its summary
+        if self.conversation_context.needs_summary:
+            await self.summarize_trimmed_turns(session)
+
+        local_args = self.args if is_branching else argparse.Namespace(**dict(vars(self.args), n=1))
+        responses = await self.query_openai_and_get_responses(session, self.build_messages(prompt), local_args)
 
-        response = await openai_api_request_wrapper(session, self.client, self.args, messages)
+        # The path of a branch lists the response it took at each branching prompt (Example: '2.0')
+        branch_paths = [f"{branch_path}.{choice_index}" if branch_path else str(choice_index)
+                        for choice_index in range(len(responses))] if is_branching else [branch_path] * len(responses)
+        await queue.put((index, prompt, responses, self.conversation_id, self.cell, branch_paths))
 
-        # Update the conversation history with the last appended prompt's response
-        if response:
-            # Treat each response from the OpenAI API as a separate response
-            for choice in response:
-                local_conversation_history[-1] = (local_conversation_history[-1][0], choice)
+        # Responses of failed requests are recorded in the output, but kept out of the conversation history
+        branches = [(path, response) for path, response in zip(branch_paths, responses)
+                    if not response.startswith(ERROR_RESPONSE_PREFIX)] or [(branch_path, "")]
 
-        return response
+        # Fork every branch off the current turn before it is recorded, the last branch carries on here
+        conversation_managers = [self.create_branch() for _ in branches[1:]] + [self]
+        for conversation_manager, (path, response) in zip(conversation_managers, branches):
+            conversation_manager.conversation_context.add_turn(prompt, response)
+        return [(path, conversation_manager)
+                for conversation_manager, (path, _) in zip(conversation_managers, branches)]
+
+    # Method to prepare the messages sent to the OpenAI API for a prompt
+    def build_messages(self, prompt):
+        return self.conversation_context.get_messages(self.guidelines, prompt)
+
+    # Method to query the OpenAI API with the prepared messages and get responses
+    async def query_openai_and_get_responses(self, session, messages, local_args=None):
+        local_args = local_args or self.args
+
+        # Function to send the request, once it is known not to duplicate another request of the run
+        def send_request():
+            return openai_api_request_wrapper(session, self.client, local_args, messages,
+                                              rate_limiter=self.rate_limiter,
+                                              concurrency_controller=self.concurrency_controller, cache=self.cache,
+                                              metrics=self.metrics, hedger=self.hedger)
+
+        if self.deduplicator:
+            return await self.deduplicator.get_or_send(build_request_payload(local_args, messages), send_request)
+        return await send_request()
+
+    # Method to summarize the turns trimmed from the conversation history window, along with the previous summary
+    async def summarize_trimmed_turns(self, session):
+        transcript = self.conversation_context.take_trimmed_turns()
+        if self.conversation_context.summary:
+            transcript = f"Summary of the conversation so far: {self.conversation_context.summary}\n{transcript}"
+        messages = [{"role": "system", "content": config['history_tuning']['summary_prompt']},
+                    {"role": "user", "content": transcript}]
+
+        # A single summary is enough, and a failed summary keeps the previous one
+        summary_args = argparse.Namespace(**dict(vars(self.args), n=1))
+        summary = await openai_api_request_wrapper(session, self.client, summary_args, messages, on_failure='skip',
+                                                   rate_limiter=self.rate_limiter,
+                                                   concurrency_controller=self.concurrency_controller,
+                                                   cache=self.cache, metrics=self.metrics)
+        if self.metrics:
+            self.metrics.record_usage(summary)
+        if summary:
+            self.conversation_context.set_summary(summary[0])
+
+
+# Function to hand the items of a list over like a stream (Example: the indexed prompts of a conversation)
+async def stream_items(items):
+    for item in items:
+        yield item
 
 
 # Class to orchestrate the processing of prompts
 class PromptOrchestrator:
-    def __init__(self, conversation_manager):
+    def __init__(self, conversation_manager, output_writer, scheduler=None):
         self.conversation_manager = conversation_manager
-        self.file_lock = asyncio.Lock()  # Add a lock
-
-    # Method to process prompts sequentially when the conversation mode is on
-    async def process_prompts_sequentially(self, session, prompts):
-        queue = asyncio.PriorityQueue()  # Queue to store results
-
-        with alive_bar(len(prompts)) as bar:  # Display the progress bar
-            for index, prompt in enumerate(prompts, start=1):
-                index, prompt, responses = await self.conversation_manager(session, (index, prompt), queue, bar)
+        self.output_writer = output_writer  # Long-lived writer of the output file
+        self.scheduler = scheduler  # Dispatches the prompts within the budgets of the run (None: in file order)
+        self.explored_branches = 0  # Branches of the conversation tree (--branch_depth only)
+
+    # Method to get the semaphore that limits the number of concurrent requests
+    def get_semaphore(self):
+        # Create a semaphore to limit the number of concurrent tasks, unless the limit is tuned adaptively
+        return (self.conversation_manager.concurrency_controller or
+                asyncio.Semaphore(self.conversation_manager.args.max_threads))
+
+    # Method to process the indexed prompts sequentially when the conversation mode is on
+    async def process_prompts_sequentially(self, session, prompts, prompt_count):
+        with alive_bar(prompt_count, disable=self.conversation_manager.args.quiet) as bar:  # Display the progress bar
+            async for index, prompt in prompts:
+                result = await self.conversation_manager(session, (index, prompt), None, bar)
                 # Write the output to the specified file immediately after processing each prompt
-                await self.write_output_to_file(self.conversation_manager.args, (index, prompt, responses))
+                await self.write_output_to_file(self.conversation_manager.args, result)
                 bar()
 
-    # Method to process prompts concurrently when the conversation mode is off
-    async def process_prompts_concurrently(self, session, prompts):
-        queue = asyncio.PriorityQueue()  # Queue to store results
-
-        with alive_bar(len(prompts)) as bar:  # Display the progress bar
-            writer_task = asyncio.create_task(self.cache_output(queue, bar))
-
-            # Create a semaphore to limit the number of concurrent tasks
-            semaphore = asyncio.Semaphore(self.conversation_manager.args.max_threads)
+    # Method to process the indexed prompts concurrently when the conversation mode is off
+    # (the prompts are read lazily and pulled by a bounded pool of workers, so memory use stays flat; independent
+    # conversations or the cells of a matrix run are given as conversations instead, and share the same pool)
+    async def process_prompts_concurrently(self, session, prompts, prompt_count, bar=None, conversations=None):
+        args = self.conversation_manager.args
+        queue = asyncio.Queue()  # Queue to store results (put back in order by the writer task)
+        work_queue = asyncio.Queue(maxsize=args.max_threads)  # Queue to hand the prompts over to the workers
+        dispatched_indices = collections.deque()  # Indices in the order they were handed over, for the writer task
+
+        # Cap the prompts that are in flight or waiting to be written, so that a stalled prompt holds back the reader
+        reorder_window = asyncio.Semaphore(max(config.get('reorder_window'), args.max_threads))
+
+        # Display the progress bar, unless the prompts are part of a larger run that has its own (Example: a shard)
+        progress_bar = contextlib.nullcontext(bar) if bar else alive_bar(prompt_count, disable=args.quiet)
+        with progress_bar as bar:
+            writer_task = asyncio.create_task(self.cache_output(queue, bar, dispatched_indices, reorder_window))
+            semaphore = self.get_semaphore()
+
+            # Create a pool of workers, but limit the concurrency with the semaphore
+            worker_tasks = [asyncio.create_task(self.process_prompts_from_queue(semaphore, session, work_queue, queue))
+                            for _ in range(args.max_threads)]
+
+            # Method to take a prompt in, in file order, as the reorder window allows (the output follows this order)
+            async def take_in(result_key):
+                await reorder_window.acquire()
+                dispatched_indices.append(result_key)
+
+            # Hand the prompts over to the workers, in the order of the scheduler if any
+            if self.scheduler:
+                async for index, prompt, is_admitted in self.scheduler.schedule(prompts, take_in,
+                                                                                reorder_window.locked):
+                    if is_admitted:
+                        await work_queue.put((index, prompt, time.monotonic(), self.conversation_manager))
+                    else:
+                        await queue.put((index, prompt, None, None, None, None))  # Left out of the output
+            elif conversations is None:
+                async for index, prompt in prompts:
+                    await take_in(index)
+                    await work_queue.put((index, prompt, time.monotonic(), self.conversation_manager))
+            else:
+                # The conversations are streamed one after the other, so that the output stays grouped per
+                # conversation (and per cell)
+                for conversation_id, indexed_prompts, _, cell in conversations:
+                    conversation_manager = self.conversation_manager.create_conversation(conversation_id, cell)
+                    async for index, prompt in indexed_prompts:
+                        await take_in(self.get_result_key((index, None, None, None, cell, None)))
+                        await work_queue.put((index, prompt, time.monotonic(), conversation_manager))
+            for _ in worker_tasks:
+                await work_queue.put(None)  # Signal the workers to exit
+
+            await asyncio.gather(*worker_tasks)
+            await queue.put((None, None, None, None, None, None))  # Signal the writer task to exit
+            await writer_task
 
-            # Create a task for each prompt, but limit the concurrency with the semaphore
+    # Method to process the prompts handed over by the reader once a concurrency slot is free
+    # (the pacing is left to the shared rate limiter)
+    async def process_prompts_from_queue(self, semaphore, session, work_queue, queue):
+        while True:
+            work_item = await work_queue.get()
+            if work_item is None:
+                break
+            index, prompt, queued_at, conversation_manager = work_item
+            async with semaphore:
+                self.record_queue_wait(queued_at)
+                result = await conversation_manager(session, (index, prompt), queue)
+            if self.scheduler:
+                await self.scheduler.record_result(index, result[2])
+
+    # Method to process several independent conversations concurrently, each one strictly in order, when the
+    # conversation mode is on (the cells of a matrix run each hold their own copy of the conversations)
+    async def process_conversations_concurrently(self, session, conversations):
+        queue = asyncio.Queue()  # Queue to store results (put back in order by the writer task)
+        indices = [self.get_result_key((index, None, None, None, cell, None))
+                   for _, prompts, _, cell in conversations for index, _ in prompts]
+
+        with alive_bar(len(indices), disable=self.conversation_manager.args.quiet) as bar:  # Display the progress bar
+            # The prompts are numbered conversation by conversation, so the output stays grouped per conversation
+            # (the results of a conversation wait in the buffer until the conversations before it are written)
+            writer_task = asyncio.create_task(self.cache_output(queue, bar, collections.deque(indices)))
+            semaphore = self.get_semaphore()
+
+            # Create a task for each conversation, each request of which waits for a slot of the shared semaphore
             processor_tasks = [
-                self.process_prompts_concurrently_with_delay(semaphore, session, (index, prompt), queue, bar)
-                for index, prompt in enumerate(prompts, start=1)]
+                self.process_conversation(semaphore, session, conversation_id, prompts, conversation_history, queue,
+                                          cell)
+                for conversation_id, prompts, conversation_history, cell in conversations]
 
             await asyncio.gather(*processor_tasks)
-            await queue.put((None, None, None))  # Signal the writer task to exit
+            await queue.put((None, None, None, None, None, None))  # Signal the writer task to exit
             await writer_task
 
-    # Method to process prompts concurrently with delay
-    async def process_prompts_concurrently_with_delay(self, semaphore, session, index_prompt_tuple, queue, bar):
-        async with semaphore:
-            await asyncio.sleep(self.conversation_manager.args.delay)
-            await self.conversation_manager(session, index_prompt_tuple, queue, bar)
+    # Method to process the prompts of a single conversation, with its own conversation history
+    async def process_conversation(self, semaphore, session, conversation_id, prompts, conversation_history, queue,
+                                   cell=None):
+        conversation_manager = self.conversation_manager.create_conversation(conversation_id, cell)
+        conversation_manager.conversation_context.conversation_history = conversation_history
+
+        # The prompts run strictly in order, each one once a slot of the shared semaphore is free
+        for index_prompt_tuple in prompts:
+            queued_at = time.monotonic()
+            async with semaphore:
+                self.record_queue_wait(queued_at)
+                await conversation_manager(session, index_prompt_tuple, queue)
+
+    # Method to explore the conversation tree of the prompts (--branch_depth), each response to the branching prompts
+    # carrying the conversation on in a branch of its own through the rest of the prompts
+    # (the branches run side by side, each request of which waits for a slot of the shared semaphore)
+    async def process_conversation_tree(self, session, prompts):
+        args = self.conversation_manager.args
+        queue = asyncio.Queue()  # Queue to store the results, written as they come in (each branch in order)
+        self.explored_branches = 1
+
+        # Requests of a fully grown tree (failed requests leave their branch out)
+        request_count = sum(args.n ** min(position, args.branch_depth) for position in range(len(prompts)))
+
+        with alive_bar(request_count, disable=args.quiet) as bar:  # Display the progress bar
+            writer_task = asyncio.create_task(self.write_output_as_it_comes(queue, bar))
+            semaphore = self.get_semaphore()
+
+            # Method to carry a branch on from the given prompt, starting the branches forked off it on the way
+            async def explore_branch(conversation_manager, branch_path, first_position):
+                forked_branches = []
+                for position in range(first_position, len(prompts)):
+                    queued_at = time.monotonic()
+                    async with semaphore:
+                        self.record_queue_wait(queued_at)
+                        branches = await conversation_manager.process_branch_prompt(
+                            session, prompts[position], queue, branch_path, position < args.branch_depth)
+
+                    # The last branch carries on here, the others side by side
+                    *other_branches, (branch_path, conversation_manager) = branches
+                    self.explored_branches += len(other_branches)
+                    forked_branches += [asyncio.create_task(explore_branch(branch_conversation_manager, path,
+                                                                           position + 1))
+                                        for path, branch_conversation_manager in other_branches]
+                await asyncio.gather(*forked_branches)
+
+            await explore_branch(self.conversation_manager, "", 0)
+            await queue.put((None, None, None, None, None, None))  # Signal the writer task to exit
+            await writer_task
 
-    # Method to temporarily store the generated output
-    async def cache_output(self, queue, bar):
-        buffer = {}  # Buffer to store results
-        next_index = 1  # Index for the next result
+    # Method to write the generated output in the order it comes in
+    async def write_output_as_it_comes(self, queue, bar):
         while True:
             result = await queue.get()
             if result[0] is None:
                 break
-            index, prompt, responses = result  # Unpack the result
-            buffer[index] = (prompt, responses)  # Store the result in the buffer
+            await self.write_output_to_file(self.conversation_manager.args, result)
+            bar()
 
-            # Write results to the specified file and update the progress bar
-            while next_index in buffer:
-                prompt, responses = buffer.pop(next_index)
-                await self.write_output_to_file(self.conversation_manager.args, (next_index, prompt, responses))
+    # Method to temporarily store the generated output until it can be written in the order of the given indices
+    # (a deque that may still grow while the prompts are being read)
+    async def cache_output(self, queue, bar, indices, reorder_window=None):
+        buffer = {}  # Buffer to store results
+        while True:
+            result = await queue.get()
+            if result[0] is None:
+                break
+            buffer[self.get_result_key(result)] = result  # Store the result in the buffer
+
+            # Write results to the specified file and update the progress bar (the prompts left out by the scheduler
+            # have no responses)
+            while indices and indices[0] in buffer:
+                result = buffer.pop(indices.popleft())
+                if result[2] is not None:
+                    await self.write_output_to_file(self.conversation_manager.args, result)
                 bar()
-                next_index += 1
-
-    # Method to write the generated output to the specified file
-    async def write_output_to_file(self, local_args, result=None):
 
-        # Use file_lock to ensure a thread-safe file access
-        async with self.file_lock:
+                # Let the reader hand over another prompt
+                if reorder_window:
+                    reorder_window.release()
 
-            # Open the output file in append mode
-            async with aiofiles.open(local_args.output_file, mode='a', newline='') as f:
+    # Method to get the key that orders a result in the output (the results of a matrix run are grouped per cell)
+    @staticmethod
+    def get_result_key(result):
+        index, _, _, _, cell, _ = result
+        return (cell["number"], index) if cell else index
 
-                # Write the header row if the file is empty
-                if (await f.tell()) == 0:  # Check if the file pointer is at the beginning
-                    await f.write("#,Prompt,Response\n")
+    # Method to record the time a prompt waited for a concurrency slot since it was queued
+    def record_queue_wait(self, queued_at):
+        if self.conversation_manager.metrics:
+            self.conversation_manager.metrics.record_queue_wait(time.monotonic() - queued_at)
 
-                if result:
-                    for response in result[2]:
-                        # Encapsulate the prompt and response in quotes to preserve commas and newlines
-                        quoted_prompt = '"' + result[1].replace('"', '""') + '"'
-                        quoted_response = '"' + response.replace('"', '""') + '"'
-                        await f.write(','.join([str(result[0]), quoted_prompt, quoted_response]) + '\n')
+    # Method to write the generated output to the specified file
+    async def write_output_to_file(self, local_args, result):
+        if self.conversation_manager.metrics:
+            self.conversation_manager.metrics.record_result(result[2])
+        await self.output_writer.write_result(result)
 
 
 # Main function to orchestrate program execution
 async def main():
+    started = time.monotonic()  # Start of the program, that the --deadline counts from
+    setup_program()  # Set up logging and load the configuration
+
     # Parse the command-line arguments
     args = ArgumentParser().parse_arguments()
+    if not args.quiet:
+        print_program_summary()
 
     # Initialize an OpenAI API client instance
     client = setup_openai_api_client()
 
-    # Read prompts and guidelines from the provided input files
-    file_parser = FileParser(prompts_file=args.prompts_file, guidelines_file=args.guidelines_file)
-    prompts, guidelines = await file_parser.parse_input_files()
+    # Read prompts and guidelines from the provided input files (the prompts of a template suite are only counted
+    # here, and expanded on the fly later on)
+    file_parser_class = TemplateParser if is_template_suite(args.prompts_file) else FileParser
+    file_parser = file_parser_class(prompts_file=args.prompts_file, guidelines_file=args.guidelines_file)
+    conversations, guidelines, prompt_count = await file_parser.parse_input_files()
+    multiple_conversations = conversations is not None
+
+    # Only expand the given range of the positions of a template suite (Example: the share of one of several runs)
+    first_index, last_index = 1, None
+    if args.prompt_range:
+        if file_parser_class is not TemplateParser:
+            handle_error("Warp drive malfunction! Argument '--prompt_range' only supports a template suite. "
+                         "Launch sequence aborted!", "Argument '--prompt_range' was used without a template suite.")
+        first_index, last_index = args.prompt_range
+        if first_index > prompt_count:
+            handle_error(f"Warp drive malfunction! Argument '--prompt_range' starts past the {prompt_count} prompts "
+                         f"of '{args.prompts_file}'. Launch sequence aborted!",
+                         f"Argument '--prompt_range' started past the end of the template suite.")
+        last_index = min(last_index, prompt_count)
+        prompt_count = last_index - first_index + 1
+
+    # Index the output file of the interrupted run being resumed
+    run_resumer = None
+    if args.resume:
+        run_resumer = RunResumer(args.output_file, args.n)
+        run_resumer.load(args.conversation_mode)
+
+    # The Batch API only takes independent prompts from a single prompts file
+    if args.batch and multiple_conversations:
+        handle_error("Warp drive malfunction! Argument '--batch' only supports a single prompts file. "
+                     "Launch sequence aborted!", "Argument '--batch' was combined with multiple conversations.")
+
+    # The work queue shards a single prompts file
+    if args.work_queue and multiple_conversations:
+        handle_error("Warp drive malfunction! Argument '--work_queue' only supports a single prompts file. "
+                     "Launch sequence aborted!", "Argument '--work_queue' was combined with multiple conversations.")
+
+    # The budgets apply to the prompts of a single prompts file
+    if args.has_budget and multiple_conversations:
+        handle_error("Warp drive malfunction! Arguments '--max_cost', '--max_tokens_total' and '--deadline' only "
+                     "support a single prompts file. Launch sequence aborted!",
+                     "Budget arguments were combined with multiple conversations.")
+
+    # The conversation tree branches out from a single conversation
+    if args.branch_depth and multiple_conversations:
+        handle_error("Warp drive malfunction! Argument '--branch_depth' only supports a single prompts file. "
+                     "Launch sequence aborted!", "Argument '--branch_depth' was combined with multiple conversations.")
+
+    # Run every guidelines file against every AI model, each combination forming a cell of the matrix
+    cells = [None]
+    if args.is_matrix:
+        guidelines_per_file = {args.guidelines_file: guidelines}
+        for guidelines_file in args.guidelines_files[1:]:
+            guidelines_per_file[guidelines_file] = await file_parser.read_guidelines(guidelines_file)
+        combinations = [(guidelines_file, ai_model) for guidelines_file in args.guidelines_files
+                        for ai_model in args.ai_models]
+        cells = [{"number": number, "guidelines_file": guidelines_file,
+                  "guidelines": guidelines_per_file[guidelines_file], "ai_model": ai_model}
+                 for number, (guidelines_file, ai_model) in enumerate(combinations)]
+
+        # The prompts of a single prompts file form a single conversation in each cell (without conversation history,
+        # each cell streams them on its own instead)
+        if not multiple_conversations and args.conversation_mode == 'on':
+            conversations = [(None, [indexed_prompt async for indexed_prompt in
+                                     file_parser.stream_indexed_prompts(first_index, last_index=last_index)])]
+
+    conversation_history = []
+    if multiple_conversations or (args.is_matrix and args.conversation_mode == 'on'):
+        # Number the prompts conversation by conversation, so that each prompt keeps its place in the output
+        # and the output stays grouped per conversation
+        numbered_conversations = []
+        next_index = 1
+        for conversation_id, prompts in conversations:
+            # The prompts of a single prompts file keep the numbers they were streamed with
+            if multiple_conversations:
+                prompts = list(enumerate(prompts, start=next_index))
+                next_index += len(prompts)
+
+            # Skip the prompts already recorded in the output file when resuming an interrupted run
+            recorded_history = []
+            if run_resumer:
+                if args.conversation_mode == 'on':
+                    recorded_history = run_resumer.get_conversation_history(prompts)
+                prompts = run_resumer.get_pending_prompts(prompts, args.conversation_mode)
+            numbered_conversations.append((conversation_id, prompts, recorded_history))
+
+        # Each cell of a matrix run holds its own copy of the conversations
+        numbered_conversations = [(conversation_id, prompts, list(recorded_history), cell) for cell in cells
+                                  for conversation_id, prompts, recorded_history in numbered_conversations]
+        prompt_count = sum(len(prompts) for _, prompts, _, _ in numbered_conversations)
+
+        # Without conversation history, the prompts of every conversation are handed over to a single pool of workers
+        if args.conversation_mode == 'off':
+            numbered_conversations = [(conversation_id, stream_items(prompts), recorded_history, cell)
+                                      for conversation_id, prompts, recorded_history, cell in numbered_conversations]
+    elif args.is_matrix:
+        # Without conversation history, each cell of a matrix run streams the prompts lazily, numbered in file order
+        numbered_conversations = [(None, file_parser.stream_indexed_prompts(first_index, last_index=last_index), [],
+                                   cell) for cell in cells]
+        prompt_count *= len(cells)
+    else:
+        # Stream the prompts lazily, numbered in file order (or by their IDs in a template suite)
+        prompts = file_parser.stream_indexed_prompts(first_index, last_index=last_index)
+
+        # Skip the prompts already recorded in the output file when resuming an interrupted run
+        # (the conversation history is rebuilt on the way, before the first pending prompt is handed out)
+        if run_resumer:
+            prompts = run_resumer.filter_pending_prompts(prompts, args.conversation_mode, conversation_history)
+            prompt_count = run_resumer.count_pending_prompts(prompt_count, args.conversation_mode,
+                                                             file_parser.get_prompt_position)
+
+    # Initialize the rate limiter shared by every request sent to the OpenAI API
+    rate_limiter = RateLimiter(args.requests_per_minute, args.tokens_per_minute, args.delay)
+
+    # Initialize the adaptive concurrency controller if the number of concurrent threads is tuned during the run
+    concurrency_controller = None
+    if args.adaptive_concurrency == 'on' and (args.conversation_mode == 'off' or multiple_conversations or
+                                              args.is_matrix or args.branch_depth):
+        concurrency_controller = AdaptiveConcurrencyController(
+            args.min_threads, args.max_threads, config['adaptive_concurrency_tuning']['latency_tolerance'],
+            config['adaptive_concurrency_tuning']['decrease_factor'])
+
+    # Open the on-disk response cache if enabled
+    cache = None
+    if args.cache != 'off':
+        cache = ResponseCache(config.get('cache_file'), args.cache, config.get('cache_ttl'),
+                              config.get('cache_max_entries'))
+
+    # Send identical requests of the run only once, ahead of the response cache (by default, only the identical
+    # requests of the cells of a matrix run, Example: the same prompt under two identical guidelines files)
+    deduplicator = None
+    deduplicate_requests = str(config.get('deduplicate_requests')).lower()
+    if deduplicate_requests == 'on' or (deduplicate_requests == 'matrix' and args.is_matrix):
+        deduplicator = RequestDeduplicator(config.get('deduplication_max_entries'))
+
+    # Score the responses on their way to the output file
+    scoring_pipeline = None
+    if args.score:
+        reference_answers = read_reference_answers(args.reference_file) if args.reference_file else None
+        guidelines_per_file = {cell["guidelines_file"]: cell["guidelines"] for cell in cells if cell}
+        scoring_pipeline = ScoringPipeline(config['scoring'], guidelines_per_file, guidelines, reference_answers)
+
+    # Hedge the slow requests if enabled
+    hedger = None
+    if args.hedging == 'on':
+        hedger = RequestHedger(config['hedging_tuning']['percentile'], config['hedging_tuning']['budget'],
+                               config['hedging_tuning']['min_samples'],
+                               max_in_flight=math.ceil(args.max_threads * config['hedging_tuning']['budget']) or 1)
+
+    # Record the performance of the run
+    metrics = RunMetrics()
 
     # Initialize an OpenAIConversationManager instance
-    conversation_manager = OpenAIConversationManager(args, client, guidelines)
+    conversation_manager = OpenAIConversationManager(args, client, guidelines, rate_limiter, concurrency_controller,
+                                                     cache, metrics=metrics, deduplicator=deduplicator, hedger=hedger)
+    conversation_manager.conversation_context.conversation_history = conversation_history
+
+    # Set up the output file (the shards of a work queue each have their own, merged into it at the end)
+    output_writer = None
+    shard_runner = None
+    if args.work_queue:
+        shard_runner = ShardRunner(args, file_parser, prompt_count, scoring_pipeline)
+    else:
+        output_writer = OutputWriter(args.output_file, args.output_format, multiple_conversations,
+                                     config.get('output_flush_rows'), config.get('output_flush_interval'),
+                                     config.get('output_fsync_interval'), args.is_matrix, scoring_pipeline,
+                                     bool(args.branch_depth))
+        await output_writer.open()
+
+    # Dispatch the prompts within the budgets of the run, if any (the deadline counts from the start of the program)
+    scheduler = None
+    if args.has_budget:
+        token_prices = config.get('token_prices', {}).get(args.ai_model)
+        if args.max_cost is not None and not token_prices:
+            handle_error(f"Warp drive malfunction! Argument '--max_cost' requires the prices of '{args.ai_model}' "
+                         f"under 'token_prices' in config.yaml. Launch sequence aborted!",
+                         f"No token prices were configured for '{args.ai_model}'.")
+        scheduler = PromptScheduler(
+            lambda prompt: estimate_prompt_tokens(conversation_manager.build_messages(prompt.rstrip('\n')),
+                                                  args.max_tokens, args.n),
+            args.max_tokens_total, args.max_cost, started + args.deadline if args.deadline is not None else None,
+            token_prices, config.get('scheduler_lookahead'), get_skipped_prompts_filename(args.output_file))
 
     # Initialize a PromptOrchestrator instance
-    prompt_orchestrator = PromptOrchestrator(conversation_manager)
+    prompt_orchestrator = PromptOrchestrator(conversation_manager, output_writer, scheduler)
 
-    # Set up the output file
-    await prompt_orchestrator.write_output_to_file(args)
-
-    # Query the OpenAI API using the prompts and write the generated output to the specified file
-    async with aiohttp.ClientSession() as session:
-        await verify_openai_api_connection(session, args, guidelines, client)  # Verify connection with the OpenAI API
-        if args.conversation_mode == 'on':
-            await prompt_orchestrator.process_prompts_sequentially(session, prompts)
-        elif args.conversation_mode == 'off':
-            await prompt_orchestrator.process_prompts_concurrently(session, prompts)
+    try:
+        # Nothing to query when every prompt is already recorded in the output file being resumed
+        if not prompt_count:
+            print_status_messages("nothing_left_to_resume", args)
+
+        # Query the OpenAI API using the prompts and write the generated output to the specified file
+        else:
+            async with create_client_session(args.max_threads, hedger.max_in_flight if hedger else 0) as session:
+                # Verify connection with the OpenAI API
+                await verify_openai_api_connection(session, args, guidelines, client, rate_limiter)
+                metrics.start()
+                if shard_runner:
+                    await shard_runner.run(session, prompt_orchestrator)
+                elif args.batch:
+                    await BatchRunner(session, client, args, conversation_manager, cache).run(prompts, prompt_count,
+                                                                                               prompt_orchestrator)
+                elif (multiple_conversations or args.is_matrix) and args.conversation_mode == 'off':
+                    await prompt_orchestrator.process_prompts_concurrently(session, None, prompt_count,
+                                                                           conversations=numbered_conversations)
+                elif multiple_conversations or args.is_matrix:
+                    await prompt_orchestrator.process_conversations_concurrently(session, numbered_conversations)
+                elif args.branch_depth:
+                    await prompt_orchestrator.process_conversation_tree(
+                        session, [indexed_prompt async for indexed_prompt in prompts])
+                elif args.conversation_mode == 'on':
+                    await prompt_orchestrator.process_prompts_sequentially(session, prompts, prompt_count)
+                elif args.conversation_mode == 'off':
+                    await prompt_orchestrator.process_prompts_concurrently(session, prompts, prompt_count)
+
+    # Flush the buffered output and export the metrics, even when the program is interrupted
+    finally:
+        if output_writer:
+            output_writer.close()
+        if scoring_pipeline:
+            scoring_pipeline.close()
+        metrics.stop()
+        if args.metrics_file:
+            metrics.export(args.metrics_file)
+
+    # Collect the run statistics worth reporting
+    stats = metrics.get_report() if prompt_count else {}
+    if cache:
+        cache.close()
+        stats["Response cache"] = f"{cache.hits} hit(s), {cache.misses} miss(es)"
+    if deduplicator and deduplicator.hits:
+        stats["Deduplicated requests"] = f"{deduplicator.hits} answered by an identical request of the run"
+    if scheduler:
+        stats["Budget"] = scheduler.get_summary()
+    if hedger and hedger.hedges_fired:
+        stats["Hedged requests"] = (f"{hedger.hedges_fired} duplicate(s) sent "
+                                    f"({hedger.hedges_fired / hedger.requests:.1%} extra requests), "
+                                    f"{hedger.hedges_won} answered first")
+    if scoring_pipeline and scoring_pipeline.scored_rows:
+        stats["Response scores"] = scoring_pipeline.get_summary()
+    if prompt_orchestrator.explored_branches:
+        stats["Conversation tree"] = f"{prompt_orchestrator.explored_branches} branch(es) explored"
+    if shard_runner:
+        stats["Shards processed here"] = f"{shard_runner.processed_shards} of {shard_runner.total_shards}"
+    if concurrency_controller:
+        stats["Concurrent threads settled at"] = (f"{concurrency_controller.limit} (explored range: "
+                                                  f"{concurrency_controller.lowest_limit}-"
+                                                  f"{concurrency_controller.highest_limit})")
 
     # Print a success message on the terminal
-    print_status_messages("successful_program_execution", args)
+    print_status_messages("successful_program_execution", args, stats)
 
 
 # Starting point for the program
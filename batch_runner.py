@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+
+# Import the required modules and the helper functions
+from helper import config, handle_error, print_coloured, GREEN
+from http_transport import loads_json
+from openai_api_request_wrapper import (build_request_headers, build_request_payload, get_backoff_delay,
+                                        get_openai_api_base_url, handle_failed_request, parse_chat_completion,
+                                        send_openai_api_request, ChatCompletionResponses, OpenAIRequestError)
+from required_modules import aiohttp, alive_bar, asyncio, contextlib, json, logging, os, urlsplit
+
+# Statuses of a batch that will not change anymore
+BATCH_FINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+
+# Class to send the prompts through the OpenAI Batch API and merge the results back into the ordered output
+class BatchRunner:
+    def __init__(self, session, client, args, conversation_manager, cache=None):
+        self.session = session
+        self.args = args
+        self.conversation_manager = conversation_manager  # Builds the same messages as the live requests
+        self.cache = cache  # On-disk cache of the responses (None: caching is off)
+        self.authorization = {"Authorization": build_request_headers(client)["Authorization"]}
+
+        # The Batch API lives next to the chat completions endpoint (Example: https://api.openai.com/v1/batches)
+        self.base_url = get_openai_api_base_url()
+        self.endpoint = urlsplit(config.get('openai_api_url')).path  # Endpoint each request of the batch is sent to
+
+        self.poll_interval = config.get('batch_poll_interval')
+        self.completion_window = config.get('batch_completion_window')
+        self.max_requests = config.get('batch_max_requests')  # Requests per batch input file
+
+        # The submitted batches are listed next to the output file until their results are merged, so that they can
+        # still be looked up (or cancelled) if the program is stopped along the way
+        self.base_filename = os.path.splitext(args.output_file)[0]
+        self.manifest_file = f"{self.base_filename}_batches.json"
+        self.prompts_file = f"{self.base_filename}_batch_prompts.jsonl"  # Every prompt in order, to write them back
+
+    # Method to call the Batch API, retrying the transient errors (a persistent error aborts the program)
+    async def call_batch_api(self, description, method, path, payload=None, file_path=None):
+        attempt = 0
+        while True:
+            try:
+                if file_path is None:
+                    headers = dict(self.authorization, **{"Content-Type": "application/json"})
+                    return await send_openai_api_request(self.session, f"{self.base_url}{path}", headers, payload,
+                                                         method)
+
+                # Upload the batch input file as a multipart form
+                with open(file_path, 'rb') as file:
+                    form = aiohttp.FormData()
+                    form.add_field('purpose', 'batch')
+                    form.add_field('file', file, filename=os.path.basename(file_path))
+                    return await send_openai_api_request(self.session, f"{self.base_url}{path}",
+                                                         self.authorization, method=method, data=form)
+
+            # Handle potential errors
+            except OpenAIRequestError as OpenAIError:
+                error = OpenAIError
+            except (aiohttp.ClientError, asyncio.TimeoutError) as NetworkError:
+                error = OpenAIRequestError(f"{type(NetworkError).__name__}: {NetworkError}")
+
+            if not error.is_retryable or attempt >= self.args.max_retries:
+                handle_error(f"Batch API failed to {description} ➔ {error}. Aborting mission!",
+                             f"Batch API failed to {description} after {attempt + 1} attempt(s): {error}.")
+
+            delay = get_backoff_delay(attempt, error.retry_after)
+            logging.warning(f"Batch API failed to {description} ({error}). Retry {attempt + 1}/"
+                            f"{self.args.max_retries} in {delay:.2f} seconds.")
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    # Method to stream the lines of a file stored by the OpenAI API (Example: the results of a batch)
+    async def read_file_lines(self, file_id):
+        async with self.session.get(f"{self.base_url}/files/{file_id}/content", headers=self.authorization) as resp:
+            if resp.status != 200:
+                handle_error(f"Batch API failed to download the file '{file_id}' ➔ HTTP {resp.status}. "
+                             f"Aborting mission!",
+                             f"Batch API failed to download the file '{file_id}': HTTP {resp.status}.")
+            async for line in resp.content:
+                if line.strip():
+                    yield loads_json(line)
+
+    # Method to write the batch input files, one line per request with the prompt index as its custom_id, listing them
+    # in batches along with the range of prompt indices they cover (prompts answered by the cache are not sent again,
+    # their responses are kept along with the prompts instead; returns the number of such prompts)
+    async def write_batch_input_files(self, prompts, batches):
+        file = None
+        requests_in_file = 0
+        cached_prompts = 0
+
+        try:
+            with open(self.prompts_file, mode='w', encoding='utf-8') as prompts_file:
+                async for index, prompt in prompts:
+                    prompt = prompt.rstrip('\n')  # Remove trailing newlines from each prompt
+                    record = {"index": index, "prompt": prompt}
+                    payload = build_request_payload(self.args, self.conversation_manager.build_messages(prompt))
+
+                    if self.cache and self.cache.is_readable:
+                        record["responses"] = self.cache.get(payload)
+                        cached_prompts += record["responses"] is not None
+                    prompts_file.write(json.dumps(record, ensure_ascii=False) + '\n')
+                    if record.get("responses") is not None:
+                        continue
+
+                    # Start the next batch input file once the current one is full
+                    if file is None or requests_in_file >= self.max_requests:
+                        if file:
+                            file.close()
+                        batches.append({"input_file": f"{self.base_filename}_batch_{len(batches) + 1}.jsonl",
+                                        "first_index": index})
+                        file = open(batches[-1]["input_file"], mode='w', encoding='utf-8')
+                        requests_in_file = 0
+
+                    file.write(json.dumps({"custom_id": str(index), "method": "POST", "url": self.endpoint,
+                                           "body": payload}, ensure_ascii=False) + '\n')
+                    requests_in_file += 1
+                    batches[-1]["last_index"] = index
+        finally:
+            if file:
+                file.close()
+        return cached_prompts
+
+    # Method to read back the prompts written along with the batch input files, in order
+    def read_prompt_records(self):
+        with open(self.prompts_file, encoding='utf-8') as file:
+            for line in file:
+                yield json.loads(line)
+
+    # Method to list the submitted batches in the manifest file, with their input file and prompt indices
+    def save_manifest(self, batches):
+        with open(self.manifest_file, mode='w', encoding='utf-8') as file:
+            json.dump({"output_file": self.args.output_file, "prompts_file": self.prompts_file,
+                       "batches": [batch for batch in batches if "id" in batch]}, file, ensure_ascii=False, indent=2)
+
+    # Method to remove the batch input files, the prompts and the manifest file, once they are no longer needed
+    def remove_batch_files(self, batches):
+        for path in [batch["input_file"] for batch in batches] + [self.prompts_file, self.manifest_file]:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+
+    # Method to upload a batch input file and create a batch from it, listing it in the manifest file
+    async def submit_batch(self, batches, batch_number):
+        batch_file = batches[batch_number]["input_file"]
+        uploaded_file = await self.call_batch_api(f"upload '{batch_file}'", "POST", "/files", file_path=batch_file)
+        batch = await self.call_batch_api(f"create a batch from '{batch_file}'", "POST", "/batches", {
+            "input_file_id": uploaded_file["id"],
+            "endpoint": self.endpoint,
+            "completion_window": self.completion_window
+        })
+
+        batches[batch_number].update(id=batch["id"], status=batch["status"])
+        self.save_manifest(batches)
+
+        logging.info(f"Submitted batch '{batch['id']}' with the requests of '{batch_file}'.")
+        if not self.args.quiet:
+            print_coloured(GREEN, f"[📦] Batch '{batch['id']}' submitted with the requests of '{batch_file}' ✅\n")
+
+    # Method to cancel the batches still running when the program is stopped, which would otherwise carry on (and be
+    # billed) without anyone to collect their results (returns whether all of them could be cancelled)
+    async def cancel_batches(self, batches):
+        all_cancelled = True
+        headers = dict(self.authorization, **{"Content-Type": "application/json"})
+        for batch in batches:
+            if "id" not in batch or batch["status"] in BATCH_FINAL_STATUSES:
+                continue
+            try:
+                await send_openai_api_request(self.session, f"{self.base_url}/batches/{batch['id']}/cancel", headers)
+                logging.info(f"Cancelled batch '{batch['id']}'.")
+            except (OpenAIRequestError, aiohttp.ClientError, asyncio.TimeoutError) as error:
+                logging.warning(f"Batch API failed to cancel the batch '{batch['id']}': {error}.")
+                all_cancelled = False
+        return all_cancelled
+
+    # Method to poll the batches until all of them are done, advancing the progress bar on the way and handing the
+    # finished batches back in order (a batch finished early waits for the batches before it)
+    async def wait_for_batches(self, batches, bar):
+        progress = {batch["id"]: 0 for batch in batches}  # Finished requests per batch
+        finished = {}  # Finished batches not handed back yet, by ID
+        next_batch = 0
+
+        while next_batch < len(batches):
+            await asyncio.sleep(self.poll_interval)
+            for entry in batches[next_batch:]:
+                if entry["id"] in finished:
+                    continue
+                batch = await self.call_batch_api(f"check the batch '{entry['id']}'", "GET",
+                                                  f"/batches/{entry['id']}")
+                entry["status"] = batch["status"]
+                counts = batch.get("request_counts") or {}
+                done = (counts.get("completed") or 0) + (counts.get("failed") or 0)
+                if done > progress[batch["id"]]:
+                    bar(done - progress[batch["id"]])
+                    progress[batch["id"]] = done
+
+                if batch["status"] in BATCH_FINAL_STATUSES:
+                    finished[batch["id"]] = batch
+
+            while next_batch < len(batches) and batches[next_batch]["id"] in finished:
+                yield batches[next_batch], finished.pop(batches[next_batch]["id"])
+                next_batch += 1
+
+    # Method to collect the results of a finished batch (responses, or the error of a failed request, per index)
+    async def collect_results(self, batch):
+        results = {}
+        if batch["status"] != "completed":
+            handle_error(f"Batch '{batch['id']}' ended up {batch['status']}. Its missing results are recorded "
+                         f"as failures!", f"Batch '{batch['id']}' ended with the status '{batch['status']}'.",
+                         is_warning=True)
+
+        # Successful and failed requests end up in separate files
+        for file_id in (batch.get("output_file_id"), batch.get("error_file_id")):
+            if not file_id:
+                continue
+            async for line in self.read_file_lines(file_id):
+                index = int(line["custom_id"])
+                response = line.get("response") or {}
+
+                if response.get("status_code") == 200:
+                    try:
+                        results[index] = parse_chat_completion(response["body"], self.args.ai_model)
+                    except OpenAIRequestError as error:
+                        results[index] = error
+                else:
+                    error = line.get("error") or (response.get("body") or {}).get("error") or {}
+                    results[index] = OpenAIRequestError(f"HTTP {response.get('status_code')}: {error.get('message')}",
+                                                        response.get("status_code"))
+        return results
+
+    # Method to write the result of a prompt to the output file (a failed request goes through the failure policy
+    # only now, so that the results before it are written even when it aborts the program)
+    async def write_result(self, record, results, prompt_orchestrator):
+        index, prompt = record["index"], record["prompt"]
+        if record.get("responses") is not None:
+            responses = ChatCompletionResponses.from_dict(record["responses"], cached=True)
+        else:
+            responses = results.get(index)
+            if responses is None:
+                responses = OpenAIRequestError("No result returned by the batch")
+            if isinstance(responses, OpenAIRequestError):
+                responses = handle_failed_request(responses, self.args.on_failure, 1, self.args.ai_model)
+
+            # Store the responses for later runs
+            elif self.cache and self.cache.is_writable:
+                payload = build_request_payload(self.args, self.conversation_manager.build_messages(prompt))
+                self.cache.put(payload, responses.to_dict())
+
+        await prompt_orchestrator.write_output_to_file(self.args, (index, prompt, responses, None, None, None))
+
+    # Method to send the prompts as batches and write their results to the output file in order, batch by batch as
+    # they finish (only the results of a single batch are held at a time)
+    async def run(self, prompts, prompt_count, prompt_orchestrator):
+        # The batches of an earlier run that was not wrapped up may still be running
+        if os.path.exists(self.manifest_file):
+            handle_error(f"Batches of an earlier run are listed in '{self.manifest_file}' and may still be running! "
+                         f"Check or cancel them, then remove the file. Launch sequence aborted!",
+                         f"Batch manifest '{self.manifest_file}' of an earlier run found.")
+
+        batches = []  # Input file, prompt indices, ID and status of each batch
+        try:
+            with alive_bar(prompt_count, disable=self.args.quiet) as bar:  # Display the progress bar
+                cached_prompts = await self.write_batch_input_files(prompts, batches)
+                if cached_prompts:
+                    bar(cached_prompts)  # Prompts answered by the cache
+
+                for batch_number in range(len(batches)):
+                    await self.submit_batch(batches, batch_number)
+
+                # Write the results in the order of the prompts, up to the last prompt of each finished batch (the
+                # prompts answered by the cache are written on the way)
+                with contextlib.closing(self.read_prompt_records()) as records:
+                    record = next(records, None)
+                    async for entry, batch in self.wait_for_batches(batches, bar):
+                        results = await self.collect_results(batch)
+                        while record is not None and record["index"] <= entry["last_index"]:
+                            await self.write_result(record, results, prompt_orchestrator)
+                            record = next(records, None)
+                    while record is not None:
+                        await self.write_result(record, {}, prompt_orchestrator)
+                        record = next(records, None)
+
+        # Cancel the batches still running when the program is stopped (Example: interrupted or aborted), keeping the
+        # batch input files and the manifest file if some of them could not be cancelled
+        except BaseException:
+            if not await self.cancel_batches(batches):
+                handle_error(f"Some batches could not be cancelled and may still be running! They are listed in "
+                             f"'{self.manifest_file}'.", "Some batches could not be cancelled.", is_warning=True)
+                raise
+            self.remove_batch_files(batches)
+            raise
+
+        # The batch input files and the manifest file are only removed once the results are merged
+        self.remove_batch_files(batches)
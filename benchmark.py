@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+
+# Benchmark suite that runs SniperChatAI against the local mock OpenAI server (mock_openai_server.py) across
+# prompt counts, concurrency levels and conversation modes, and writes a results table
+# (Example: python benchmark.py --prompt_counts 100 1000 --max_threads 1 10 50 --latency_distribution lognormal)
+
+# Import the required modules
+from required_modules import argparse, csv, json, os, socket, subprocess, sys, tempfile, time, yaml
+
+# Directory of the repository, where the program, the mock server and the default config.yaml live
+REPO_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+# Columns of the results table
+RESULT_COLUMNS = ["conversation_mode", "prompts", "max_threads", "run", "exit_code", "wall_seconds",
+                  "cold_start_seconds", "processing_seconds", "shutdown_seconds", "prompts_per_second", "requests",
+                  "retries", "failed_results", "latency_p50", "latency_p95", "latency_p99"]
+
+
+# Function to parse the benchmark settings
+def parse_settings():
+    parser = argparse.ArgumentParser(description="Benchmarks SniperChatAI against the local mock OpenAI server")
+    parser.add_argument('--prompt_counts', type=int, nargs='+', default=[100, 1000],
+                        help='Prompt counts to benchmark (Default: 100 1000)')
+    parser.add_argument('--max_threads', type=int, nargs='+', default=[1, 10, 50],
+                        help='Concurrency levels to benchmark with --conversation_mode off (Default: 1 10 50)')
+    parser.add_argument('--conversation_modes', nargs='+', choices=['on', 'off'], default=['on', 'off'],
+                        help='Conversation modes to benchmark (Default: on off)')
+    parser.add_argument('--runs', type=int, default=1, help='Runs per scenario (Default: 1)')
+    parser.add_argument('--extra_args', default='--quiet',
+                        help="Extra arguments passed on to SniperChatAI (Example: '--quiet --stream -n 2', "
+                             "Default: '--quiet')")
+    parser.add_argument('--results_file', default='benchmark_results.csv',
+                        help='CSV file the results table is written to (Default: benchmark_results.csv)')
+    parser.add_argument('--timeout', type=float, default=600, help='Timeout per run in seconds (Default: 600)')
+
+    # Settings of the mock server
+    mock_args = parser.add_argument_group('mock server arguments')
+    mock_args.add_argument('--latency_distribution', default='lognormal',
+                           choices=['fixed', 'uniform', 'exponential', 'lognormal'],
+                           help='Distribution of the response latency (Default: lognormal)')
+    mock_args.add_argument('--latency_mean', type=float, default=0.05,
+                           help='Mean response latency in seconds (Default: 0.05)')
+    mock_args.add_argument('--latency_spread', type=float, default=0.5,
+                           help='Half-width of the uniform distribution, or sigma of the lognormal one '
+                                '(Default: 0.5)')
+    mock_args.add_argument('--rate_limit_error_rate', type=float, default=0.0,
+                           help='Share of the requests answered with an HTTP 429 (Default: 0)')
+    mock_args.add_argument('--server_error_rate', type=float, default=0.0,
+                           help='Share of the requests answered with an HTTP 500, 502 or 503 (Default: 0)')
+    mock_args.add_argument('--retry_after', type=float, default=0.5,
+                           help='Retry-After header of the HTTP 429 responses, in seconds (Default: 0.5)')
+    mock_args.add_argument('--seed', type=int, default=0, help='Seed of the random latencies and errors (Default: 0)')
+    return parser.parse_args()
+
+
+# Function to find a free local port for the mock server
+def get_free_port():
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+# Function to start the mock server and wait until it accepts connections
+def start_mock_server(settings, port):
+    mock_server = subprocess.Popen(
+        [sys.executable, os.path.join(REPO_DIRECTORY, 'mock_openai_server.py'), '--port', str(port),
+         '--latency_distribution', settings.latency_distribution, '--latency_mean', str(settings.latency_mean),
+         '--latency_spread', str(settings.latency_spread),
+         '--rate_limit_error_rate', str(settings.rate_limit_error_rate),
+         '--server_error_rate', str(settings.server_error_rate), '--retry_after', str(settings.retry_after),
+         '--seed', str(settings.seed)], stdout=subprocess.DEVNULL)
+
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return mock_server
+        except OSError:
+            if mock_server.poll() is not None:
+                break
+            time.sleep(0.1)
+
+    mock_server.kill()
+    sys.exit("The mock server could not be started.")
+
+
+# Function to prepare the working directory: a config.yaml pointing to the mock server, and the input files
+def prepare_work_directory(work_directory, port, prompt_counts):
+    with open(os.path.join(REPO_DIRECTORY, 'config.yaml')) as config_file:
+        config = yaml.safe_load(config_file)
+    config['openai_api_url'] = f"http://127.0.0.1:{port}/v1/chat/completions"
+    with open(os.path.join(work_directory, 'config.yaml'), 'w') as config_file:
+        yaml.safe_dump(config, config_file)
+
+    with open(os.path.join(work_directory, 'guidelines.txt'), 'w') as guidelines_file:
+        guidelines_file.write("You are a helpful assistant. Keep your answers short.\n")
+    for prompt_count in prompt_counts:
+        with open(os.path.join(work_directory, f'prompts_{prompt_count}.txt'), 'w') as prompts_file:
+            prompts_file.writelines(f"Benchmark prompt number {index}?\n" for index in range(1, prompt_count + 1))
+
+
+# Function to run SniperChatAI once and collect its results from the exported metrics
+def run_scenario(settings, work_directory, conversation_mode, prompt_count, max_threads, run):
+    output_file = os.path.join(work_directory, f'output_{conversation_mode}_{prompt_count}_{max_threads}_{run}.csv')
+    metrics_file = os.path.join(work_directory, 'metrics.json')
+    if os.path.exists(metrics_file):
+        os.remove(metrics_file)
+
+    command = [sys.executable, os.path.join(REPO_DIRECTORY, 'SniperChatAI.py'), '--ai_model', 'mock-model',
+               '--guidelines_file', 'guidelines.txt', '--prompts_file', f'prompts_{prompt_count}.txt',
+               '--conversation_mode', conversation_mode, '--max_threads', str(max_threads),
+               '--output_file', output_file, '--metrics_file', metrics_file] + settings.extra_args.split()
+
+    launched_at = time.time()
+    started = time.monotonic()
+    try:
+        exit_code = subprocess.run(command, cwd=work_directory, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                                   env=dict(os.environ, OPENAI_API_KEY='benchmark'),
+                                   timeout=settings.timeout).returncode
+    except subprocess.TimeoutExpired:
+        exit_code = 'timeout'
+    wall_seconds = time.monotonic() - started
+
+    metrics = {}
+    if os.path.exists(metrics_file):
+        with open(metrics_file) as file:
+            metrics = json.load(file)
+    processing_seconds = metrics.get("elapsed_seconds")
+
+    # Cold start: from the launch until the prompts start being processed (imports, input files, connection check)
+    cold_start_seconds = metrics["started_at"] - launched_at if metrics.get("started_at") else None
+    latencies = metrics.get("latency_seconds") or {}
+
+    return {
+        "conversation_mode": conversation_mode,
+        "prompts": prompt_count,
+        "max_threads": max_threads if conversation_mode == 'off' else '-',
+        "run": run,
+        "exit_code": exit_code,
+        "wall_seconds": round(wall_seconds, 3),
+        "cold_start_seconds": round(cold_start_seconds, 3) if cold_start_seconds else None,
+        "processing_seconds": round(processing_seconds, 3) if processing_seconds else None,
+        "shutdown_seconds": (round(wall_seconds - cold_start_seconds - processing_seconds, 3)
+                             if cold_start_seconds and processing_seconds else None),
+        "prompts_per_second": round(prompt_count / processing_seconds, 1) if processing_seconds else None,
+        "requests": metrics.get("requests"),
+        "retries": metrics.get("retries"),
+        "failed_results": metrics.get("failed_results"),
+        "latency_p50": latencies.get("p50") and round(latencies["p50"], 4),
+        "latency_p95": latencies.get("p95") and round(latencies["p95"], 4),
+        "latency_p99": latencies.get("p99") and round(latencies["p99"], 4)
+    }
+
+
+# Function to print the results as a Markdown table
+def print_results_table(results):
+    print("| " + " | ".join(RESULT_COLUMNS) + " |")
+    print("|" + "|".join("---" for _ in RESULT_COLUMNS) + "|")
+    for result in results:
+        print("| " + " | ".join("" if result[column] is None else str(result[column])
+                                for column in RESULT_COLUMNS) + " |")
+
+
+# Main function to run every scenario of the benchmark
+def main():
+    settings = parse_settings()
+    port = get_free_port()
+    mock_server = start_mock_server(settings, port)
+    results = []
+
+    try:
+        with tempfile.TemporaryDirectory(prefix='sniperchatai_benchmark_') as work_directory:
+            prepare_work_directory(work_directory, port, settings.prompt_counts)
+
+            for conversation_mode in settings.conversation_modes:
+                # The concurrency level only applies when the conversation history is off
+                thread_levels = settings.max_threads if conversation_mode == 'off' else settings.max_threads[:1]
+                for prompt_count in settings.prompt_counts:
+                    for max_threads in thread_levels:
+                        for run in range(1, settings.runs + 1):
+                            result = run_scenario(settings, work_directory, conversation_mode, prompt_count,
+                                                  max_threads, run)
+                            print(f"Finished: conversation_mode={conversation_mode} prompts={prompt_count} "
+                                  f"max_threads={result['max_threads']} run={run} "
+                                  f"({result['wall_seconds']}s)", file=sys.stderr)
+                            results.append(result)
+    finally:
+        mock_server.terminate()
+        mock_server.wait()
+
+    with open(settings.results_file, 'w', newline='', encoding='utf-8') as results_file:
+        writer = csv.DictWriter(results_file, fieldnames=RESULT_COLUMNS, lineterminator='\n')
+        writer.writeheader()
+        writer.writerows(results)
+
+    print_results_table(results)
+    print(f"\nResults written to '{settings.results_file}'.", file=sys.stderr)
+
+
+# Starting point for the benchmark suite
+if __name__ == "__main__":
+    main()
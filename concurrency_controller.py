@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+# Import the required modules
+from required_modules import asyncio, collections, time
+
+# HTTP status codes that signal an overloaded or throttling server
+CONGESTION_STATUS_CODES = {408, 429, 503, 504}
+
+
+# Function to calculate the given percentile of a list of values (nearest-rank method)
+def get_percentile(values, percentile):
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, int(round(percentile / 100 * len(ordered))) - 1))
+    return ordered[rank]
+
+
+# Class to limit the number of in-flight requests with an AIMD (additive increase, multiplicative decrease) controller
+class AdaptiveConcurrencyController:
+    def __init__(self, min_limit, max_limit, latency_tolerance=2.0, decrease_factor=0.5):
+        self.min_limit = min_limit
+        self.max_limit = max(min_limit, max_limit)
+        self.latency_tolerance = latency_tolerance  # Allowed growth of the p95 latency over its baseline
+        self.decrease_factor = decrease_factor  # Factor applied to the limit on congestion
+        self.limit = min_limit  # Current in-flight limit
+        self.lowest_limit = self.highest_limit = min_limit  # Range explored during the run
+        self.in_flight = 0
+        self.waiters = collections.deque()  # Futures of the tasks waiting for a free slot
+        self.window = []  # Latencies of the successful attempts since the last adjustment
+        self.baseline_p95 = None  # Healthy p95 latency
+        self.slow_start = True  # Double the limit per healthy window until the first congestion signal
+        self.last_decrease = 0.0
+
+    # Method to wait for a free slot
+    async def acquire(self):
+        if self.in_flight < self.limit and not self.waiters:
+            self.in_flight += 1
+            return
+
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            # Give the slot back if it was granted just before the waiting task got cancelled
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            raise
+
+    # Method to free a slot and hand it over to the waiting tasks
+    def release(self):
+        self.in_flight -= 1
+        self.wake_waiters()
+
+    # Method to hand out as many free slots as the current limit allows
+    def wake_waiters(self):
+        while self.waiters and self.in_flight < self.limit:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                self.in_flight += 1
+                waiter.set_result(None)
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.release()
+
+    # Method to record the outcome of a single request attempt (error is None for a successful attempt)
+    def record_attempt(self, latency, error=None):
+        if error is not None:
+            # Cut the limit on throttling and timeouts, other errors say nothing about the load
+            if error.status is None or error.status in CONGESTION_STATUS_CODES:
+                self.decrease()
+            return
+
+        self.window.append(latency)
+        if len(self.window) >= self.limit:
+            self.evaluate_window()
+
+    # Method to grow the limit after a healthy window, or cut it when the p95 latency rises
+    def evaluate_window(self):
+        p95 = get_percentile(self.window, 95)
+        self.window = []
+
+        if self.baseline_p95 is None:
+            self.baseline_p95 = p95
+        elif p95 > self.latency_tolerance * self.baseline_p95:
+            self.decrease()
+            return
+
+        # Let the baseline follow the lowest observed latency, and slowly drift up with the provider's latency
+        self.baseline_p95 = min(p95, 0.95 * self.baseline_p95 + 0.05 * p95)
+
+        self.set_limit(self.limit * 2 if self.slow_start else self.limit + 1)
+
+    # Method to cut the limit, at most once per round trip so that a burst of errors only counts once
+    def decrease(self):
+        now = time.monotonic()
+        if now - self.last_decrease < (self.baseline_p95 or 1.0):
+            return
+
+        self.slow_start = False
+        self.last_decrease = now
+        self.window = []
+        self.set_limit(int(self.limit * self.decrease_factor))
+
+    # Method to apply a new limit within the configured bounds
+    def set_limit(self, limit):
+        self.limit = max(self.min_limit, min(self.max_limit, limit))
+        self.lowest_limit = min(self.lowest_limit, self.limit)
+        self.highest_limit = max(self.highest_limit, self.limit)
+        self.wake_waiters()
@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 
 # Import the required modules
-from required_modules import aiofiles, argcomplete, argparse, logging, os, sys, time, yaml
+from required_modules import aiofiles, argcomplete, argparse, json, logging, os, sys, time, yaml
 
 # Define the colour codes
 RED = 91
@@ -18,19 +18,16 @@ def print_coloured(colour_code, coloured_text):
 # Get the program name
 program_name = os.path.basename(sys.argv[0]).split('.')[0]
 
-# Print the program summary
-print_coloured(BLUE, f"\n"
-                     f"[➤] Program Author: Navin M. (GitHub Handle: Navinscribed)\n\n"
-                     f"[➤] {program_name} is a customizable chatbot powered using OpenAI\n    "
-                     f"that allows rapid evaluation of prompts in a controlled space\n\n"
-                     f"    --- --- --- --- --- --- --- --- --- --- --- --- --- --- --- ----\n"
-                     f"    {program_name} | Automation? Check! Coherence? Check! Wit? Always!\n"
-                     f"    --- --- --- --- --- --- --- --- --- --- --- --- --- --- --- ----\n")
 
-# Set up logging
-logging.basicConfig(filename=f"log_{program_name}.log", filemode='a',
-                    format='%(asctime)s - %(levelname)s - %(message)s',
-                    datefmt='%Y-%m-%d %H:%M:%S', level=logging.WARNING)
+# Function to print the program summary
+def print_program_summary():
+    print_coloured(BLUE, f"\n"
+                         f"[➤] Program Author: Navin M. (GitHub Handle: Navinscribed)\n\n"
+                         f"[➤] {program_name} is a customizable chatbot powered using OpenAI\n    "
+                         f"that allows rapid evaluation of prompts in a controlled space\n\n"
+                         f"    --- --- --- --- --- --- --- --- --- --- --- --- --- --- --- ----\n"
+                         f"    {program_name} | Automation? Check! Coherence? Check! Wit? Always!\n"
+                         f"    --- --- --- --- --- --- --- --- --- --- --- --- --- --- --- ----\n")
 
 
 # Function to handle errors
@@ -62,13 +59,28 @@ def load_config():
         exit(1)
 
 
-# Load the configuration from the config.yaml
-config = load_config()
+# Configuration from the config.yaml, filled in place by setup_program, so that every module importing it shares it
+config = {}
 
-# Override logging level if specified
-logging_level = config.get('logging_level')  # Get default logging level from config.yaml
-logging_level = getattr(logging, logging_level.upper())  # Convert the string to its matching logging level constant
-logging.getLogger().setLevel(logging_level)
+
+# Function to set up logging and load the configuration once the program starts, rather than when this module is
+# imported (Example: by the scoring processes, which need neither of them)
+def setup_program():
+    logging.basicConfig(filename=f"log_{program_name}.log", filemode='a',
+                        format='%(asctime)s - %(levelname)s - %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S', level=logging.WARNING)
+
+    # Load the configuration from the config.yaml
+    config.update(load_config())
+
+    # Override logging level if specified
+    logging_level = config.get('logging_level')  # Get default logging level from config.yaml
+    logging_level = getattr(logging, logging_level.upper())  # Convert the string to its matching logging level
+    logging.getLogger().setLevel(logging_level)
+
+
+# File extension of each output format
+OUTPUT_FORMAT_EXTENSIONS = {'csv': '.csv', 'jsonl': '.jsonl', 'parquet': '.parquet'}
 
 
 # Class to manage validation and parsing of command-line arguments
@@ -83,12 +95,30 @@ class ArgumentParser:
         self.default_temperature = config['temperature']['default']
         self.default_output_file = config.get('output_file')
         self.default_conversation_mode = config.get('conversation_mode').lower()
+        self.default_history_token_budget = config.get('history_token_budget')
+        self.default_history_strategy = config.get('history_strategy').lower()
+        self.default_branch_depth = config.get('branch_depth')
+        self.max_branches = config.get('max_branches')
         self.default_max_threads = config.get('max_threads')
+        self.default_adaptive_concurrency = config.get('adaptive_concurrency').lower()
+        self.default_min_threads = config.get('min_threads')
         self.default_delay = config.get('delay')
+        self.default_requests_per_minute = config.get('requests_per_minute')
+        self.default_tokens_per_minute = config.get('tokens_per_minute')
+        self.default_max_retries = config.get('max_retries')
+        self.default_on_failure = config.get('on_failure').lower()
+        self.default_hedging = config.get('hedging').lower()
+        self.default_max_cost = config.get('max_cost')
+        self.default_max_tokens_total = config.get('max_tokens_total')
+        self.default_deadline = config.get('deadline')
+        self.default_cache = config.get('cache').lower()
+        self.default_output_format = config.get('output_format').lower()
+        self.default_connection_check = config.get('connection_check').lower()
+        self.default_local_workers = config['work_queue_tuning']['local_workers']
 
     # Method to validate the arguments
     @staticmethod
-    def validate_arg(value, arg_name, expected_type):
+    def validate_arg(value, arg_name, expected_type, allow_zero=False):
         # Validate the argument type
         try:
             value = expected_type(value)
@@ -97,23 +127,46 @@ class ArgumentParser:
             raise argparse.ArgumentTypeError(f"\033[91mInvalid value '{value}' provided for the argument '{arg_name}'. "
                                              f"Has to be a number.\n\033[0m")
 
+        # Validate that the argument is non-negative (where zero is allowed)
+        if allow_zero and value < 0:
+            logging.error(f"Invalid value '{value}' provided for the argument '{arg_name}'. Exited program.")
+            raise argparse.ArgumentTypeError(f"\033[91mInvalid value '{value}' provided for the argument '{arg_name}'. "
+                                             f"Has to be a non-negative number.\n\033[0m")
+
         # Validate that the argument is a positive integer
-        if expected_type == int and value <= 0:
+        if expected_type == int and value <= 0 and not allow_zero:
             logging.error(f"Invalid value '{value}' provided for the argument '{arg_name}'. Exited program.")
             raise argparse.ArgumentTypeError(f"\033[91mInvalid value '{value}' provided for the argument '{arg_name}'. "
                                              f"Has to be a positive non-zero integer.\n\033[0m")
         return value
 
+    # Method to validate the '--prompt_range' argument, given as the first and last positions of the range
+    @staticmethod
+    def validate_prompt_range(value):
+        first_index, _, last_index = value.partition('-')
+        if first_index.isdigit() and last_index.isdigit() and 1 <= int(first_index) <= int(last_index):
+            return int(first_index), int(last_index)
+        logging.error(f"Invalid value '{value}' provided for the argument '--prompt_range'. Exited program.")
+        raise argparse.ArgumentTypeError(f"\033[91mInvalid value '{value}' provided for the argument '--prompt_range'. "
+                                         f"Has to be FIRST-LAST, two positions from 1 with FIRST <= LAST.\n\033[0m")
+
     # Method to define the required arguments
     @staticmethod
     def define_required_args(parser):
         required_args = parser.add_argument_group('required arguments')
-        required_args.add_argument('--ai_model', type=str, required=True,
-                                   help='Name of the chat-based AI model (Example: gpt-4)')
-        required_args.add_argument('--guidelines_file', type=str, required=True,
-                                   help="File containing guidelines that define the chatbot's behaviour")
+        required_args.add_argument('--ai_model', type=str, nargs='+', required=True,
+                                   help='Name of the chat-based AI model (Example: gpt-4)\n'
+                                        'Several models are each run against every guidelines file in a single '
+                                        'run')
+        required_args.add_argument('--guidelines_file', type=str, nargs='+', required=True,
+                                   help="File containing guidelines that define the chatbot's behaviour\n"
+                                        "Several files are each run against every AI model in a single run")
         required_args.add_argument('--prompts_file', type=str, required=True,
-                                   help='File containing prompts to query the chatbot')
+                                   help='File containing prompts to query the chatbot\n'
+                                        '(Note: A directory of prompts files, or a JSONL file with a '
+                                        "'conversation_id' and a 'prompt'\nper line, runs several "
+                                        'independent conversations concurrently, and a YAML template suite\n'
+                                        'expands prompt templates over wordlists on the fly)')
         return parser
 
     # Method to define the optional arguments
@@ -139,18 +192,170 @@ class ArgumentParser:
                                    help=f'on: Persists conversation history across prompts '
                                         f'(Default: {self.default_conversation_mode})\n'
                                         'off: Does not persist conversation history between prompts')
+        optional_args.add_argument('--history_token_budget',
+                                   type=lambda value: self.validate_arg(value, '--history_token_budget', int),
+                                   default=self.default_history_token_budget,
+                                   help=f'Maximum tokens of conversation history sent along with each prompt '
+                                        f'(Default: {self.default_history_token_budget or "Unlimited"})\n'
+                                        '(Note: This setting is only applied when --conversation_mode is on)')
+        optional_args.add_argument('--history_strategy', type=str, default=self.default_history_strategy,
+                                   help=f'How the conversation history is trimmed to fit --history_token_budget '
+                                        f'(Default: {self.default_history_strategy})\n'
+                                        'sliding_window: Drops the oldest turns first\n'
+                                        'keep_first_last: Always keeps the first turns, along with the most recent '
+                                        'ones\n'
+                                        'summarize: Drops the oldest turns first, and sends a running summary of '
+                                        'them instead')
+        optional_args.add_argument('--branch_depth',
+                                   type=lambda value: self.validate_arg(value, '--branch_depth', int),
+                                   default=self.default_branch_depth,
+                                   help=f'Prompts, from the first one, whose -n responses each continue the '
+                                        f'conversation in a branch of its own\nthrough the rest of the prompts. The '
+                                        f'branches run concurrently, with a single response\nper prompt past the '
+                                        f'branching prompts (Default: {self.default_branch_depth or "No branching"})\n'
+                                        f'(Note: This setting is only applied when --conversation_mode is on)')
         optional_args.add_argument('--max_threads',
                                    type=lambda value: self.validate_arg(value, '--max_threads', int),
                                    default=self.default_max_threads,
                                    help=f'Maximum concurrent threads to process the prompts '
                                         f'(Default: {self.default_max_threads})\n'
-                                        '(Note: This setting is only applied when --conversation_mode is off)')
-        optional_args.add_argument('--delay', type=lambda value: self.validate_arg(value, '--delay', int),
+                                        '(Note: This setting is only applied when --conversation_mode is off, '
+                                        'or across several conversations)')
+        optional_args.add_argument('--adaptive_concurrency', type=str, default=self.default_adaptive_concurrency,
+                                   help=f'on: Tunes the concurrent threads between --min_threads and --max_threads '
+                                        f'based on latency and errors (Default: {self.default_adaptive_concurrency})\n'
+                                        'off: Always uses --max_threads concurrent threads\n'
+                                        '(Note: This setting is only applied when --conversation_mode is off, '
+                                        'or across several conversations)')
+        optional_args.add_argument('--min_threads',
+                                   type=lambda value: self.validate_arg(value, '--min_threads', int),
+                                   default=self.default_min_threads,
+                                   help=f'Minimum concurrent threads when --adaptive_concurrency is on '
+                                        f'(Default: {self.default_min_threads})')
+        optional_args.add_argument('--delay',
+                                   type=lambda value: self.validate_arg(value, '--delay', float, allow_zero=True),
                                    default=self.default_delay,
-                                   help=f'Delay in seconds between each thread (Default: {self.default_delay})\n'
-                                        '(Note: This setting is only applied when --conversation_mode is off)')
+                                   help=f'Minimum delay in seconds between two consecutive requests. '
+                                        f'Fractions allowed (Default: {self.default_delay})')
+        optional_args.add_argument('--requests_per_minute',
+                                   type=lambda value: self.validate_arg(value, '--requests_per_minute', int),
+                                   default=self.default_requests_per_minute,
+                                   help=f'Maximum requests sent to the OpenAI API per minute '
+                                        f'(Default: {self.default_requests_per_minute or "Unlimited"})')
+        optional_args.add_argument('--tokens_per_minute',
+                                   type=lambda value: self.validate_arg(value, '--tokens_per_minute', int),
+                                   default=self.default_tokens_per_minute,
+                                   help=f'Maximum tokens (prompt + max_tokens) sent to the OpenAI API per minute '
+                                        f'(Default: {self.default_tokens_per_minute or "Unlimited"})')
+        optional_args.add_argument('--max_retries',
+                                   type=lambda value: self.validate_arg(value, '--max_retries', int, allow_zero=True),
+                                   default=self.default_max_retries,
+                                   help=f'Maximum retries per request on rate limits, timeouts and server errors '
+                                        f'(Default: {self.default_max_retries})')
+        optional_args.add_argument('--on_failure', type=str, default=self.default_on_failure,
+                                   help=f'Policy for prompts that still fail after all retries '
+                                        f'(Default: {self.default_on_failure})\n'
+                                        'error_row: Records the error in place of the response and moves on\n'
+                                        'skip: Leaves the prompt out of the output and moves on\n'
+                                        'abort: Exits the program')
+        optional_args.add_argument('--max_cost',
+                                   type=lambda value: self.validate_arg(value, '--max_cost', float, allow_zero=True),
+                                   default=self.default_max_cost,
+                                   help=f'Spend budget of the run in USD, priced with token_prices in config.yaml. '
+                                        f'No prompt is sent\nonce the projected spend would exceed it '
+                                        f'(Default: {self.default_max_cost or "Unlimited"})')
+        optional_args.add_argument('--max_tokens_total',
+                                   type=lambda value: self.validate_arg(value, '--max_tokens_total', int),
+                                   default=self.default_max_tokens_total,
+                                   help=f'Token budget of the run. No prompt is sent once the projected tokens '
+                                        f'would exceed it\n(Default: {self.default_max_tokens_total or "Unlimited"})')
+        optional_args.add_argument('--deadline',
+                                   type=lambda value: self.validate_arg(value, '--deadline', float, allow_zero=True),
+                                   default=self.default_deadline,
+                                   help=f'Seconds the run may take. No prompt is sent once it would not be '
+                                        f'answered in time\n(Default: {self.default_deadline or "Unlimited"})\n'
+                                        f'(Note: The budgets are only applied when --conversation_mode is off. The '
+                                        f'prompts left out\nare listed in <output_file>_skipped.jsonl)')
+        optional_args.add_argument('--hedging', type=str, default=self.default_hedging,
+                                   help=f'on: Sends a duplicate of the requests that take longer than a latency '
+                                        f'percentile learned during\nthe run, the first response wins and the other '
+                                        f'request is cancelled. The duplicates are\ncapped to a share of the '
+                                        f'requests (Default: {self.default_hedging})\n'
+                                        'off: Waits for every request, however slow')
+        optional_args.add_argument('--cache', type=str, default=self.default_cache,
+                                   help=f'Response cache mode (Default: {self.default_cache})\n'
+                                        'off: Always queries the OpenAI API\n'
+                                        'read: Serves cached responses, but does not store new ones\n'
+                                        'write: Always queries the OpenAI API and stores the responses\n'
+                                        'readwrite: Serves cached responses and stores new ones')
         optional_args.add_argument('--output_file', type=str, default=self.default_output_file,
-                                   help=f'Output CSV file name (Default: {self.default_output_file})')
+                                   help=f'Output file name, its extension follows --output_format '
+                                        f'(Default: {self.default_output_file})')
+        optional_args.add_argument('--output_format', type=str, default=self.default_output_format,
+                                   help=f'Output file format (Default: {self.default_output_format})\n'
+                                        'csv: One row per response with the prompt index, prompt and response\n'
+                                        'jsonl: One JSON object per response, with the details of each response\n'
+                                        'parquet: Columnar file with the details of each response (requires pyarrow)')
+        optional_args.add_argument('--metrics_file', type=str,
+                                   help='File to export the performance metrics of the run to, as JSON (.json '
+                                        'extension)\nor in the Prometheus text format (any other extension)')
+        optional_args.add_argument('--resume', type=str, metavar='OUTPUT_FILE',
+                                   help='Output CSV file of an interrupted run to resume. Only the prompts missing '
+                                        'from it are sent,\nand their output is appended to it')
+        optional_args.add_argument('--stream', action='store_true',
+                                   help='Streams the responses as they are generated, recording the time to the '
+                                        'first token\nand the latency between the streamed chunks')
+        optional_args.add_argument('--stream_stop', type=str,
+                                   help='Word or phrase at which the streamed responses are cut off on the client '
+                                        'side\n(Only with --stream)')
+        optional_args.add_argument('--max_response_chars',
+                                   type=lambda value: self.validate_arg(value, '--max_response_chars', int),
+                                   help='Maximum characters per streamed response, longer responses are cut off on '
+                                        'the client side\n(Only with --stream)')
+        optional_args.add_argument('--batch', action='store_true',
+                                   help='Sends the prompts through the OpenAI Batch API instead of live requests. '
+                                        'Cheaper and\nhigher throughput for large prompt suites, but the results '
+                                        'may take up to a day\n(Only with --conversation_mode off and a single '
+                                        'prompts file)')
+        optional_args.add_argument('--work_queue', type=str, metavar='QUEUE_FILE',
+                                   help='SQLite work queue to shard the prompts over several worker processes, '
+                                        'which may run\non different hosts sharing the filesystem, each with its '
+                                        'own API key\n(Only with --conversation_mode off and a single prompts '
+                                        'file)')
+        optional_args.add_argument('--work_queue_role', type=str, default='coordinator',
+                                   help='Role of this process in the work queue (Default: coordinator)\n'
+                                        'coordinator: Creates the work queue, processes shards and merges the '
+                                        'output of every shard\ninto the output file once all of them are done\n'
+                                        'worker: Joins an existing work queue and processes shards until none is '
+                                        'left')
+        optional_args.add_argument('--local_workers',
+                                   type=lambda value: self.validate_arg(value, '--local_workers', int,
+                                                                        allow_zero=True),
+                                   default=self.default_local_workers,
+                                   help=f'Worker processes started on this host by the coordinator, next to the '
+                                        f'coordinator itself\n(Default: {self.default_local_workers})')
+        optional_args.add_argument('--prompt_range', type=self.validate_prompt_range, metavar='FIRST-LAST',
+                                   help='Positions of the template suite to expand, from 1 (Example: 1-500000), to '
+                                        'split a suite\nover several independent runs\n(Only with a template suite '
+                                        'and --conversation_mode off)')
+        optional_args.add_argument('--connection_check', type=str, default=self.default_connection_check,
+                                   help=f'How the connection with the OpenAI API is verified before the prompts are '
+                                        f'sent:\nmodels: Looks up the AI model, which costs no tokens\n'
+                                        f'chat: Sends a short chat completion with the guidelines\n'
+                                        f'off: Skips the check, the first prompts then reveal any connection issue\n'
+                                        f'(Default: {self.default_connection_check})')
+        optional_args.add_argument('--score', action='store_true',
+                                   help='Scores each response for data leaks (PII/PCI), refusals and similarity to '
+                                        'the guidelines\n(or to the reference answers), adding the scores to the '
+                                        'output and a summary to the\nend-of-run statistics (requires numpy)')
+        optional_args.add_argument('--reference_file', type=str,
+                                   help='File with a reference answer per line, numbered like the prompts, that '
+                                        'the responses\nare compared to in place of the guidelines (Only with '
+                                        '--score)')
+        optional_args.add_argument('-q', '--quiet', action='store_true',
+                                   help='Non-interactive mode for scripts and CI: skips the program summary, the '
+                                        'status messages\nand the progress bar. Errors and warnings are still '
+                                        'printed')
         optional_args.add_argument('-h', '--help', action='help', help='Shows this help message and exits')
 
         return parser
@@ -167,6 +372,19 @@ class ArgumentParser:
                          f"Invalid value '{args.conversation_mode}' provided for the argument '--conversation_mode'.")
             exit(1)
 
+    # Method to validate an argument that only accepts a fixed set of values
+    @staticmethod
+    def validate_choice(args, arg_name, allowed_values):
+        attribute = arg_name.lstrip('-')
+        value = str(getattr(args, attribute)).lower()  # Convert the provided value to lowercase
+        setattr(args, attribute, value)
+
+        if value not in allowed_values:
+            expected = ', '.join(f"'{allowed_value}'" for allowed_value in allowed_values)
+            handle_error(f"Warp drive malfunction! Argument '{arg_name}' expecting values {expected}. "
+                         f"Received '{value}'. Launch sequence aborted!",
+                         f"Invalid value '{value}' provided for the argument '{arg_name}'.")
+
     # Method to clamp the '--temperature' argument value
     def clamp_temperature(self, args):
         if not (self.min_temperature <= args.temperature <= self.max_temperature):
@@ -190,60 +408,252 @@ class ArgumentParser:
         parser = self.define_required_args(parser)  # Define the required arguments
         parser = self.define_optional_args(parser)  # Define the optional arguments
 
-        argcomplete.autocomplete(parser)  # Enable autocomplete for the arguments
+        # Enable autocomplete for the arguments (only imported when the shell asks for completions)
+        if '_ARGCOMPLETE' in os.environ:
+            argcomplete.autocomplete(parser)
         args = parser.parse_args()
 
         self.validate_conversation_mode(args)  # Validate --conversation_mode
+        self.validate_choice(args, '--on_failure', ['error_row', 'skip', 'abort'])  # Validate --on_failure
+        self.validate_choice(args, '--adaptive_concurrency', ['on', 'off'])  # Validate --adaptive_concurrency
+        self.validate_choice(args, '--hedging', ['on', 'off'])  # Validate --hedging
+        self.validate_choice(args, '--cache', ['off', 'read', 'write', 'readwrite'])  # Validate --cache
+        self.validate_choice(args, '--history_strategy',
+                             ['sliding_window', 'keep_first_last', 'summarize'])  # Validate --history_strategy
+        self.validate_choice(args, '--output_format', list(OUTPUT_FORMAT_EXTENSIONS))  # Validate --output_format
+        self.validate_choice(args, '--connection_check', ['models', 'chat', 'off'])  # Validate --connection_check
+        self.validate_choice(args, '--work_queue_role', ['coordinator', 'worker'])  # Validate --work_queue_role
         self.clamp_temperature(args)  # Clamp --temperature
 
-        args.output_file = get_unique_output_filename(args.output_file)  # Get a unique filename
+        # Responses can only be cut off on the client side while they are streamed
+        if (args.stream_stop or args.max_response_chars) and not args.stream:
+            handle_error("Warp drive malfunction! Arguments '--stream_stop' and '--max_response_chars' require "
+                         "'--stream'. Launch sequence aborted!",
+                         "Arguments '--stream_stop' or '--max_response_chars' were provided without '--stream'.")
+
+        # Batch results are only fetched once the whole batch is done, so there is nothing to stream
+        if args.batch and args.stream:
+            handle_error("Warp drive malfunction! Arguments '--batch' and '--stream' cannot be combined. "
+                         "Launch sequence aborted!", "Arguments '--batch' and '--stream' were combined.")
+
+        # Batches are sent at once, so the responses cannot feed the conversation history of the next prompts
+        if args.batch and args.conversation_mode == 'on':
+            handle_error("Warp drive malfunction! Argument '--batch' requires '--conversation_mode off'. "
+                         "Launch sequence aborted!",
+                         "Argument '--batch' was combined with the conversation mode 'on'.")
+
+        # The shards are independent of each other, and their output is merged by concatenating the files
+        if args.work_queue and (args.conversation_mode == 'on' or args.batch or args.resume or
+                                args.output_format == 'parquet'):
+            handle_error("Warp drive malfunction! Argument '--work_queue' requires '--conversation_mode off', the "
+                         "'csv' or 'jsonl' output format, and cannot be combined with '--batch' or '--resume'. "
+                         "Launch sequence aborted!",
+                         "Argument '--work_queue' was combined with incompatible arguments.")
+
+        # A range of the prompts is a share of independent prompts, and the work queue splits the prompts by itself
+        if args.prompt_range and (args.conversation_mode == 'on' or args.work_queue):
+            handle_error("Warp drive malfunction! Argument '--prompt_range' requires '--conversation_mode off', and "
+                         "cannot be combined with '--work_queue'. Launch sequence aborted!",
+                         "Argument '--prompt_range' was combined with incompatible arguments.")
+
+        # The conversation tree branches out from a single conversation of live requests, and is capped in size
+        if args.branch_depth and args.conversation_mode == 'on':
+            if args.batch or args.work_queue or args.resume or len(args.ai_model) * len(args.guidelines_file) > 1:
+                handle_error("Warp drive malfunction! Argument '--branch_depth' cannot be combined with '--batch', "
+                             "'--work_queue', '--resume' or several '--ai_model' or '--guidelines_file' values. "
+                             "Launch sequence aborted!",
+                             "Argument '--branch_depth' was combined with incompatible arguments.")
+            if args.n ** args.branch_depth > self.max_branches:
+                handle_error(f"Warp drive malfunction! Conversation tree of -n {args.n} and '--branch_depth "
+                             f"{args.branch_depth}' exceeds the {self.max_branches} branches allowed by "
+                             f"'max_branches' in config.yaml. Launch sequence aborted!",
+                             f"Conversation tree of {args.n} ** {args.branch_depth} branches exceeded max_branches.")
+        else:
+            args.branch_depth = None
+
+        # The budgets are applied by the scheduler in front of the concurrent requests of a single run
+        args.has_budget = any(budget is not None for budget in (args.max_cost, args.max_tokens_total, args.deadline))
+        if args.has_budget and (args.conversation_mode == 'on' or args.batch or args.work_queue or
+                                len(args.ai_model) * len(args.guidelines_file) > 1):
+            handle_error("Warp drive malfunction! Arguments '--max_cost', '--max_tokens_total' and '--deadline' "
+                         "require '--conversation_mode off', and cannot be combined with '--batch', '--work_queue' "
+                         "or several '--ai_model' or '--guidelines_file' values. Launch sequence aborted!",
+                         "Budget arguments were combined with incompatible arguments.")
+
+        # The reference answers are only read by the scoring of the responses
+        if args.reference_file and not args.score:
+            handle_error("Warp drive malfunction! Argument '--reference_file' requires '--score'. "
+                         "Launch sequence aborted!", "Argument '--reference_file' was used without '--score'.")
+
+        # Every guidelines file is run against every AI model, each combination forming a cell of the matrix
+        args.ai_models = list(dict.fromkeys(args.ai_model))  # Drop the repeated values, keeping their order
+        args.guidelines_files = list(dict.fromkeys(args.guidelines_file))
+        args.ai_model = args.ai_models[0]
+        args.guidelines_file = args.guidelines_files[0]
+        args.is_matrix = len(args.ai_models) * len(args.guidelines_files) > 1
+
+        # The cells of a matrix run are processed side by side as live requests, and share a single output file
+        if args.is_matrix and (args.batch or args.work_queue or args.resume):
+            handle_error("Warp drive malfunction! Several '--ai_model' or '--guidelines_file' values cannot be "
+                         "combined with '--batch', '--work_queue' or '--resume'. Launch sequence aborted!",
+                         "Several AI models or guidelines files were combined with incompatible arguments.")
+
+        # Only the CSV output can be resumed, as it is the only format read back by the resumer
+        if args.resume and args.output_format != 'csv':
+            handle_error(f"Warp drive malfunction! Argument '--resume' only supports the 'csv' output format. "
+                         f"Received '{args.output_format}'. Launch sequence aborted!",
+                         f"Argument '--resume' was combined with the output format '{args.output_format}'.")
+
+        # Get a unique filename, unless the output is appended to the output file of an interrupted run
+        args.output_file = args.resume or get_unique_output_filename(args.output_file,
+                                                                     OUTPUT_FORMAT_EXTENSIONS[args.output_format])
 
         return args
 
 
+# Number of characters read from the input files at once
+FILE_READ_CHUNK_SIZE = 1 << 16
+
+
 # Class to parse the input files
 class FileParser:
     def __init__(self, prompts_file, guidelines_file):
         self.prompts_file = prompts_file
         self.guidelines_file = guidelines_file
 
-    # Method to open and read a file
+    # Method to open and read a file line by line (in large chunks, to keep the number of thread hops low)
     @staticmethod
-    async def read_file_contents(filename):
+    async def read_file_contents(filename, offset=0):
         try:
             async with aiofiles.open(filename, 'r') as file:
-                async for line in file:
-                    yield str(line).strip()
+                if offset:
+                    await file.seek(offset)  # Start at the given byte offset (Example: the first prompt of a shard)
+                remainder = ''
+                while True:
+                    chunk = await file.read(FILE_READ_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    lines = (remainder + chunk).split('\n')
+                    remainder = lines.pop()  # The last line may continue in the next chunk
+                    for line in lines:
+                        yield line.strip()
+                if remainder:
+                    yield remainder.strip()
         except FileNotFoundError:
             handle_error(f"Mission-critical file '{filename}' missing! Aborting launch!",
                          f"File '{filename}' could not be found.")
             exit(1)
 
+    # Property to check whether the prompts file holds several conversations
+    @property
+    def has_multiple_conversations(self):
+        return os.path.isdir(self.prompts_file) or self.prompts_file.lower().endswith('.jsonl')
+
+    # Method to count the prompts in the plain prompts file without keeping them in memory
+    def count_prompts(self):
+        try:
+            with open(self.prompts_file, 'rb') as file:
+                return sum(1 for line in file if line.strip())
+        except FileNotFoundError:
+            handle_error(f"Mission-critical file '{self.prompts_file}' missing! Aborting launch!",
+                         f"File '{self.prompts_file}' could not be found.")
+
+    # Method to find where each shard of the plain prompts file starts, as the index and byte offset of its first
+    # prompt (the prompts are counted on the way)
+    def get_shard_offsets(self, shard_size):
+        shard_offsets = []
+        index = 0
+        offset = 0
+        with open(self.prompts_file, 'rb') as file:
+            for line in file:
+                if line.strip():
+                    if index % shard_size == 0:
+                        shard_offsets.append((index + 1, offset))
+                    index += 1
+                offset += len(line)
+        return shard_offsets, index
+
+    # Method to get the position of the last prompt whose index does not exceed the given one (they match in a plain
+    # prompts file)
+    @staticmethod
+    def get_prompt_position(index):
+        return index
+
+    # Method to lazily read the prompts of the plain prompts file, numbered from 1
+    # (or only the prompts of a shard, from the index and byte offset of its first prompt up to its last index)
+    async def stream_indexed_prompts(self, first_index=1, offset=0, last_index=None):
+        index = first_index - 1
+        async for line in self.read_file_contents(self.prompts_file, offset):
+            if line:
+                index += 1
+                if last_index is not None and index > last_index:
+                    break
+                yield index, line
+
+    # Method to parse the prompts of each conversation
+    # (a directory holds one prompts file per conversation, a JSONL file holds a 'conversation_id' per prompt)
+    async def parse_conversations(self):
+        if os.path.isdir(self.prompts_file):
+            conversations = []
+            for filename in sorted(os.listdir(self.prompts_file)):
+                path = os.path.join(self.prompts_file, filename)
+                if os.path.isfile(path):
+                    prompts = [line async for line in self.read_file_contents(path) if line]
+                    conversations.append((os.path.splitext(filename)[0], prompts))
+            return conversations
+
+        # A JSONL file holds a conversation identifier per prompt
+        conversations = {}  # Prompts per conversation, in order of first appearance
+        line_number = 0
+        async for line in self.read_file_contents(self.prompts_file):
+            line_number += 1
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+                conversations.setdefault(str(record['conversation_id']), []).append(str(record['prompt']).strip())
+            except (ValueError, KeyError, TypeError):
+                handle_error(f"Line {line_number} of '{self.prompts_file}' is not a JSON object with the keys "
+                             f"'conversation_id' and 'prompt'. Aborting launch!",
+                             f"Line {line_number} of prompts file '{self.prompts_file}' could not be parsed.")
+        return list(conversations.items())
+
     # Method to parse the prompts file and the guidelines file
+    # (the prompts of a plain prompts file are only counted here, and streamed later on)
     async def parse_input_files(self):
-        prompts = [line async for line in self.read_file_contents(self.prompts_file) if line]
-        guidelines = ' '.join([line async for line in self.read_file_contents(self.guidelines_file)])
+        conversations = None
+        if self.has_multiple_conversations:
+            conversations = await self.parse_conversations()
+            prompt_count = sum(len(prompts) for _, prompts in conversations)
+        else:
+            prompt_count = self.count_prompts()
+        guidelines = await self.read_guidelines(self.guidelines_file)
 
         # Exit if the prompts file is empty
-        if not prompts or not any(line.strip() for line in prompts):
+        if not prompt_count:
             handle_error(f"Prompts file '{self.prompts_file}' is as empty as a vacuum in deep space. "
                          f"Program requires prompts for propulsion. Aborting launch!",
                          f"Prompts file '{self.prompts_file}' was empty.")
 
+        return conversations, guidelines, prompt_count
+
+    # Method to read the guidelines of a guidelines file
+    async def read_guidelines(self, guidelines_file):
+        guidelines = ' '.join([line async for line in self.read_file_contents(guidelines_file)])
+
         # Warn and proceed if the guidelines file is empty
         if not guidelines.strip():
             handle_error(
-                f"No guidelines in '{self.guidelines_file}' ➔ Expect unfiltered responses from the chatbot!",
-                f"Guidelines file '{self.guidelines_file}' was empty. "
+                f"No guidelines in '{guidelines_file}' ➔ Expect unfiltered responses from the chatbot!",
+                f"Guidelines file '{guidelines_file}' was empty. "
                 f"Program proceeded to execute with limitations.", is_warning=True)
 
-        return prompts, guidelines
+        return guidelines
 
 
-# Function to ensure that the generated output file has a unique filename
-def get_unique_output_filename(filename):
-    base_filename = filename.split('.')[0]
-    extension = '.csv'  # Default to .csv
+# Function to ensure that the generated output file has a unique filename with the given extension
+def get_unique_output_filename(filename, extension='.csv'):
+    base_filename = os.path.splitext(filename)[0]
 
     new_filename = f"{base_filename}{extension}"
     counter = 1
@@ -256,19 +666,29 @@ def get_unique_output_filename(filename):
 
 
 # Function to print status messages on the terminal during different stages of the program execution
-def print_status_messages(event, args=None):
+def print_status_messages(event, args=None, stats=None):
     messages = {
         "successful_connection_with_openai_api": [
             "[🌐] Connection with OpenAI API ✅                 (Possibilities upgraded to infinite!)\n",
             "[🔍] Program inputs verified ✅                    (Ready for launch. Clear skies ahead!)\n",
             "[🚀] Launching main program ✅                     (See you on the other side, slick!)\n"
         ],
+        "nothing_left_to_resume": [
+            f"[🏁] Every prompt is already recorded in '{args.output_file}' ✅    (Nothing left to resume!)\n"
+            if args else ""
+        ],
         "successful_program_execution": [
             f"\n[🌟] Program aced its mission ✅                   (Excelsior!)\n",
             f"[📂] Output neatly cataloged in '{args.output_file}' ✅    (Peek if intrigued!)\n" if args else ""
-        ]
+        ] + [f"[📊] {name}: {value}\n" for name, value in (stats or {}).items()]
     }
 
+    if args and args.quiet:
+        return
+
     for message in messages.get(event, []):
         print_coloured(GREEN, message)
-        time.sleep(0.5)  # Introduce a small delay between each status message
+
+        # Introduce a small delay between each status message, unless the output goes to a file or a pipe
+        if sys.stdout.isatty():
+            time.sleep(0.5)
@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+
+# Import the required modules and the helper functions
+from helper import config
+from required_modules import aiohttp, json
+
+# Encode and decode the JSON bodies with orjson when it is installed, as it is several times faster
+try:
+    import orjson
+except ModuleNotFoundError:
+    orjson = None
+
+
+# Function to encode an object as JSON (bytes with orjson, text otherwise, both of which can be sent as a body)
+def dumps_json(obj):
+    if orjson:
+        return orjson.dumps(obj)
+    return json.dumps(obj)
+
+
+# Function to decode a JSON document given as text or bytes (raises a ValueError when malformed)
+def loads_json(document):
+    if orjson:
+        return orjson.loads(document)
+    return json.loads(document)
+
+
+# Function to create the HTTP session shared by every request, with a connection pool sized to the concurrency
+# (along with the duplicates of the hedged requests that may be in flight at once)
+def create_client_session(concurrency_limit, hedge_limit=0):
+    settings = config.get('http_connection') or {}
+
+    # Leave a little headroom for the requests sent next to the prompts (Example: the conversation summaries), and
+    # room for the duplicates, which would otherwise wait for a free connection instead of going out
+    pool_size = settings.get('pool_size') or concurrency_limit + hedge_limit + 2
+
+    connector = aiohttp.TCPConnector(limit=pool_size, limit_per_host=pool_size, use_dns_cache=True,
+                                     ttl_dns_cache=settings.get('dns_cache_ttl'),
+                                     keepalive_timeout=settings.get('keepalive_timeout'))
+    timeout = aiohttp.ClientTimeout(total=settings.get('total_timeout'), connect=settings.get('connect_timeout'),
+                                    sock_read=settings.get('read_timeout'))
+
+    # Ask for compressed responses, which are decompressed on the fly
+    return aiohttp.ClientSession(connector=connector, timeout=timeout, auto_decompress=True,
+                                 headers={"Accept-Encoding": "gzip, deflate"})
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+
+# Local stand-in for the OpenAI API, to test and benchmark SniperChatAI without spending API credits
+# (Example: python mock_openai_server.py --port 8000 --latency_distribution lognormal --rate_limit_error_rate 0.05,
+# then point 'openai_api_url' in config.yaml to http://127.0.0.1:8000/v1/chat/completions)
+
+# Import the required modules
+from required_modules import argparse, asyncio, json, math, random, time
+from aiohttp import web
+
+# Rough number of characters per token, used to report the token usage
+CHARS_PER_TOKEN = 4
+
+# Server error status codes injected at random
+SERVER_ERROR_STATUS_CODES = (500, 502, 503)
+
+
+# Class to simulate the chat completions, models, files and batches endpoints of the OpenAI API
+class MockOpenAIServer:
+    def __init__(self, settings):
+        self.settings = settings
+        self.random = random.Random(settings.seed)  # Seeded, so that runs are reproducible
+        self.requests = 0
+        self.files = {}  # Uploaded and generated files by ID
+        self.batches = {}  # Batches by ID
+
+    # Method to draw the latency of a response from the configured distribution
+    def sample_latency(self):
+        mean = self.settings.latency_mean
+        spread = self.settings.latency_spread
+        distribution = self.settings.latency_distribution
+
+        if distribution == 'uniform':
+            return max(0.0, self.random.uniform(mean - spread, mean + spread))
+        if distribution == 'exponential':
+            return self.random.expovariate(1 / mean) if mean > 0 else 0.0
+        if distribution == 'lognormal':
+            # Spread is the standard deviation of the underlying normal distribution, the mean stays as configured
+            return self.random.lognormvariate(math.log(mean) - spread ** 2 / 2, spread) if mean > 0 else 0.0
+        return mean  # fixed
+
+    # Method to draw an injected error, if any (returns the status code and the headers to send)
+    def sample_error(self):
+        draw = self.random.random()
+        if draw < self.settings.rate_limit_error_rate:
+            return 429, {"Retry-After": str(self.settings.retry_after),
+                         "x-ratelimit-remaining-requests": "0",
+                         "x-ratelimit-reset-requests": f"{int(self.settings.retry_after * 1000)}ms"}
+        if draw < self.settings.rate_limit_error_rate + self.settings.server_error_rate:
+            return self.random.choice(SERVER_ERROR_STATUS_CODES), {}
+        return None, {}
+
+    # Method to generate the responses for a chat completion request, along with the token usage
+    def generate_completion(self, body):
+        messages = body.get("messages") or []
+        prompt = next((message["content"] for message in reversed(messages) if message.get("role") == "user"), "")
+        words = min(self.settings.response_words, body.get("max_tokens") or self.settings.response_words)
+        n = body.get("n") or 1
+
+        responses = [" ".join([f"Mock response {index + 1} to '{prompt[:40]}':"] + ["lorem"] * words)
+                     for index in range(n)]
+        prompt_tokens = sum(4 + len(message.get("content") or "") // CHARS_PER_TOKEN for message in messages)
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": words * n,
+                 "total_tokens": prompt_tokens + words * n}
+        return responses, usage
+
+    # Method to build a chat completion response body
+    def build_completion(self, body, responses, usage):
+        self.requests += 1
+        return {"id": f"chatcmpl-mock-{self.requests}", "object": "chat.completion", "created": int(time.time()),
+                "model": body.get("model"), "usage": usage,
+                "choices": [{"index": index, "message": {"role": "assistant", "content": response},
+                             "finish_reason": "stop"} for index, response in enumerate(responses)]}
+
+    # Handler of the chat completions endpoint
+    async def handle_chat_completion(self, request):
+        try:
+            body = await request.json()
+        except ValueError:
+            return web.json_response({"error": {"message": "Invalid JSON body"}}, status=400)
+
+        await asyncio.sleep(self.sample_latency())
+        status, headers = self.sample_error()
+        if status:
+            return web.json_response({"error": {"message": f"Injected error {status}"}}, status=status,
+                                     headers=headers)
+
+        responses, usage = self.generate_completion(body)
+        if not body.get("stream"):
+            return web.json_response(self.build_completion(body, responses, usage))
+
+        # Stream the responses word by word as server-sent events
+        stream = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await stream.prepare(request)
+        self.requests += 1
+
+        # Function to send a single server-sent event
+        async def send_event(data):
+            await stream.write(f"data: {json.dumps(data)}\n\n".encode('utf-8'))
+
+        chunk = {"id": f"chatcmpl-mock-{self.requests}", "object": "chat.completion.chunk", "model": body.get("model")}
+        for index, response in enumerate(responses):
+            for word in response.split(" "):
+                await send_event(dict(chunk, choices=[{"index": index, "delta": {"content": word + " "},
+                                                       "finish_reason": None}]))
+                await asyncio.sleep(self.settings.chunk_delay)
+            await send_event(dict(chunk, choices=[{"index": index, "delta": {}, "finish_reason": "stop"}]))
+        if (body.get("stream_options") or {}).get("include_usage"):
+            await send_event(dict(chunk, choices=[], usage=usage))
+        await stream.write(b"data: [DONE]\n\n")
+        return stream
+
+    # Handler of the models endpoint
+    async def handle_models(self, request):
+        return web.json_response({"object": "list", "data": [{"id": "mock-model", "object": "model"}]})
+
+    # Handler of the model lookup endpoint (a lightweight request to check the connection, any model exists)
+    async def handle_model(self, request):
+        return web.json_response({"id": request.match_info["model"], "object": "model", "owned_by": "mock"})
+
+    # Handler of the file upload endpoint
+    async def handle_file_upload(self, request):
+        form = await request.post()
+        file_id = f"file-mock-{len(self.files) + 1}"
+        self.files[file_id] = form["file"].file.read().decode('utf-8')
+        return web.json_response({"id": file_id, "object": "file", "purpose": form.get("purpose")})
+
+    # Handler of the file content endpoint
+    async def handle_file_content(self, request):
+        file_id = request.match_info["file_id"]
+        if file_id not in self.files:
+            return web.json_response({"error": {"message": f"No such file '{file_id}'"}}, status=404)
+        return web.Response(text=self.files[file_id], content_type="application/jsonl")
+
+    # Handler of the batch creation endpoint
+    async def handle_batch_creation(self, request):
+        body = await request.json()
+        batch_id = f"batch-mock-{len(self.batches) + 1}"
+        self.batches[batch_id] = {"id": batch_id, "object": "batch", "status": "in_progress",
+                                  "input_file_id": body["input_file_id"], "endpoint": body["endpoint"],
+                                  "completion_window": body.get("completion_window"),
+                                  "created_at": time.time(), "request_counts": {"total": 0, "completed": 0,
+                                                                                "failed": 0}}
+        return web.json_response(self.batches[batch_id])
+
+    # Handler of the batch status endpoint (a batch completes once the configured delay has passed)
+    async def handle_batch_status(self, request):
+        batch = self.batches.get(request.match_info["batch_id"])
+        if batch is None:
+            return web.json_response({"error": {"message": "No such batch"}}, status=404)
+
+        if batch["status"] == "in_progress" and time.time() - batch["created_at"] >= self.settings.batch_delay:
+            output_lines, error_lines = [], []
+            for line in self.files[batch["input_file_id"]].splitlines():
+                batch_request = json.loads(line)
+                status, _ = self.sample_error()
+                if status:
+                    error_lines.append({"custom_id": batch_request["custom_id"], "error": None, "response": {
+                        "status_code": status, "body": {"error": {"message": f"Injected error {status}"}}}})
+                else:
+                    responses, usage = self.generate_completion(batch_request["body"])
+                    output_lines.append({"custom_id": batch_request["custom_id"], "error": None, "response": {
+                        "status_code": 200, "body": self.build_completion(batch_request["body"], responses, usage)}})
+
+            for suffix, lines in (("output", output_lines), ("errors", error_lines)):
+                self.files[f"{batch['id']}-{suffix}"] = "".join(json.dumps(line) + "\n" for line in lines)
+            batch.update(status="completed", output_file_id=f"{batch['id']}-output",
+                         error_file_id=f"{batch['id']}-errors",
+                         request_counts={"total": len(output_lines) + len(error_lines),
+                                         "completed": len(output_lines), "failed": len(error_lines)})
+        return web.json_response(batch)
+
+    # Handler of the batch cancellation endpoint (a batch still in progress is cancelled without any results)
+    async def handle_batch_cancellation(self, request):
+        batch = self.batches.get(request.match_info["batch_id"])
+        if batch is None:
+            return web.json_response({"error": {"message": "No such batch"}}, status=404)
+
+        if batch["status"] == "in_progress":
+            batch["status"] = "cancelled"
+        return web.json_response(batch)
+
+    # Method to create the web application serving the endpoints
+    def create_app(self):
+        app = web.Application(client_max_size=256 * 1024 ** 2)
+        app.router.add_post("/v1/chat/completions", self.handle_chat_completion)
+        app.router.add_get("/v1/models", self.handle_models)
+        app.router.add_get("/v1/models/{model}", self.handle_model)
+        app.router.add_post("/v1/files", self.handle_file_upload)
+        app.router.add_get("/v1/files/{file_id}/content", self.handle_file_content)
+        app.router.add_post("/v1/batches", self.handle_batch_creation)
+        app.router.add_get("/v1/batches/{batch_id}", self.handle_batch_status)
+        app.router.add_post("/v1/batches/{batch_id}/cancel", self.handle_batch_cancellation)
+        return app
+
+
+# Function to parse the settings of the mock server
+def parse_settings(argv=None):
+    parser = argparse.ArgumentParser(description="Local stand-in for the OpenAI API")
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on (Default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8000, help='Port to listen on (Default: 8000)')
+    parser.add_argument('--latency_distribution', default='fixed',
+                        choices=['fixed', 'uniform', 'exponential', 'lognormal'],
+                        help='Distribution of the response latency (Default: fixed)')
+    parser.add_argument('--latency_mean', type=float, default=0.05,
+                        help='Mean response latency in seconds (Default: 0.05)')
+    parser.add_argument('--latency_spread', type=float, default=0.02,
+                        help='Half-width of the uniform distribution, or sigma of the lognormal one (Default: 0.02)')
+    parser.add_argument('--rate_limit_error_rate', type=float, default=0.0,
+                        help='Share of the requests answered with an HTTP 429 (Default: 0)')
+    parser.add_argument('--server_error_rate', type=float, default=0.0,
+                        help='Share of the requests answered with an HTTP 500, 502 or 503 (Default: 0)')
+    parser.add_argument('--retry_after', type=float, default=1.0,
+                        help='Retry-After header of the HTTP 429 responses, in seconds (Default: 1)')
+    parser.add_argument('--response_words', type=int, default=20,
+                        help='Filler words per response, capped by max_tokens (Default: 20)')
+    parser.add_argument('--chunk_delay', type=float, default=0.005,
+                        help='Delay in seconds between two streamed chunks (Default: 0.005)')
+    parser.add_argument('--batch_delay', type=float, default=1.0,
+                        help='Seconds until a batch completes (Default: 1)')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the random latencies and errors (Default: 0)')
+    return parser.parse_args(argv)
+
+
+# Starting point for the mock server
+if __name__ == "__main__":
+    settings = parse_settings()
+    print(f"Mock OpenAI API listening on http://{settings.host}:{settings.port}/v1 (Ctrl+C to stop)")
+    web.run_app(MockOpenAIServer(settings).create_app(), host=settings.host, port=settings.port, print=None)
@@ -2,17 +2,294 @@
 
 # Import the required modules and the helper functions
 from helper import config, handle_error
-from required_modules import json
+from http_transport import dumps_json, loads_json
+from rate_limiter import estimate_request_tokens
+from required_modules import aiohttp, asyncio, logging, parsedate_to_datetime, random, re, time
 
+# HTTP status codes that are worth retrying (timeouts, conflicts, rate limits and transient server errors)
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
 
-# Wrapper for making HTTP POST requests to the OpenAI API
-async def openai_api_request_wrapper(session, client, args, messages):
-    url = config.get('openai_api_url')
-    headers = {
+# Prefix of the error recorded in place of the responses when a prompt fails (with --on_failure error_row)
+ERROR_RESPONSE_PREFIX = "[ERROR] "
+
+# Finish reason of the streamed responses cut off on the client side (with --stream_stop or --max_response_chars)
+CLIENT_STOP_FINISH_REASON = "client_stop"
+
+# Rate limit reset headers sent by the OpenAI API, paired with their matching 'remaining' headers
+RATE_LIMIT_RESET_HEADERS = {
+    'x-ratelimit-reset-requests': 'x-ratelimit-remaining-requests',
+    'x-ratelimit-reset-tokens': 'x-ratelimit-remaining-tokens'
+}
+
+
+# Class to hold the responses generated for a prompt, along with the details of the request that generated them
+class ChatCompletionResponses(list):
+    def __init__(self, responses=(), finish_reasons=None, model=None, latency=None, usage=None, retries=0,
+                 cached=False):
+        super().__init__(responses)
+        self.finish_reasons = finish_reasons or [None] * len(self)  # Finish reason per response
+        self.model = model  # Model that generated the responses
+        self.latency = latency  # Duration in seconds of the request that succeeded
+        self.usage = usage or {}  # Token usage reported by the OpenAI API
+        self.retries = retries  # Number of retries it took
+        self.cached = cached  # Whether the responses were served from the cache
+        self.ttft = None  # Time to the first streamed token in seconds (--stream only)
+        self.inter_token_latency = None  # Average time between two streamed chunks in seconds (--stream only)
+
+    # Method to convert the responses and their details into a dictionary (Example: to store them in the cache)
+    def to_dict(self):
+        return {"responses": list(self), "finish_reasons": self.finish_reasons, "model": self.model,
+                "usage": self.usage}
+
+    # Method to rebuild the responses from a dictionary created by to_dict()
+    @classmethod
+    def from_dict(cls, data, **details):
+        return cls(data["responses"], data.get("finish_reasons"), data.get("model"), usage=data.get("usage"),
+                   **details)
+
+
+# Exception raised when a single request to the OpenAI API fails
+class OpenAIRequestError(Exception):
+    def __init__(self, message, status=None, retry_after=None):
+        super().__init__(message)
+        self.status = status  # HTTP status code (None for network errors and timeouts)
+        self.retry_after = retry_after  # Wait time in seconds suggested by the server, if any
+
+    # Property to check whether the failed request may succeed when retried
+    @property
+    def is_retryable(self):
+        return self.status is None or self.status in RETRYABLE_STATUS_CODES
+
+
+# Function to convert the durations used in the rate limit headers to seconds (Example: '20ms', '1s', '6m0s', '1h2m')
+def parse_reset_duration(value):
+    if not value:
+        return None
+
+    try:
+        return float(value)  # Plain number of seconds
+    except ValueError:
+        pass
+
+    units = {'h': 3600, 'm': 60, 's': 1, 'ms': 0.001}
+    parts = re.findall(r'(\d+(?:\.\d+)?)(ms|h|m|s)', value)
+    if not parts:
+        return None
+    return sum(float(amount) * units[unit] for amount, unit in parts)
+
+
+# Function to extract the wait time suggested by the server from the response headers
+def get_retry_after(headers):
+    # The 'Retry-After' header takes priority and holds either a number of seconds or an HTTP date
+    retry_after = headers.get('Retry-After')
+    if retry_after:
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            try:
+                return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+
+    # Fall back to the rate limit reset headers, preferring the limits that are actually exhausted
+    resets = {header: parse_reset_duration(headers.get(header)) for header in RATE_LIMIT_RESET_HEADERS}
+    resets = {header: reset for header, reset in resets.items() if reset is not None}
+    exhausted = [reset for header, reset in resets.items()
+                 if headers.get(RATE_LIMIT_RESET_HEADERS[header]) == '0']
+    if exhausted:
+        return max(exhausted)
+    if resets:
+        return min(resets.values())
+    return None
+
+
+# Function to calculate the wait time before the next retry (exponential backoff with full jitter)
+def get_backoff_delay(attempt, retry_after=None):
+    backoff_base = config['retry_backoff']['base']
+    backoff_max = config['retry_backoff']['max']
+
+    delay = random.uniform(0, min(backoff_max, backoff_base * (2 ** attempt)))
+
+    # Never retry sooner than the server asked for
+    if retry_after is not None:
+        delay = max(delay, min(retry_after, backoff_max))
+    return delay
+
+
+# Function to send a single HTTP request to the OpenAI API and return the decoded response body
+# (the JSON payload is sent by default, other request bodies such as file uploads can be passed as data)
+async def send_openai_api_request(session, url, headers, payload=None, method="POST", data=None):
+    if payload is not None:
+        data = dumps_json(payload)
+
+    async with session.request(method, url, headers=headers, data=data) as resp:
+        body, data = await read_json_body(resp)
+
+        if resp.status != 200:
+            raise get_request_error(resp, body, data)
+
+        if data is None:
+            raise OpenAIRequestError(f"Malformed response body: {body.strip()[:200]}")
+        return data
+
+
+# Function to read a response body, and decode it as JSON if possible (returns the text and the decoded body or None)
+async def read_json_body(resp):
+    body = await resp.read()
+    try:
+        data = loads_json(body)
+    except ValueError:
+        data = None
+    return body.decode('utf-8', errors='replace'), data
+
+
+# Function to build the error raised for a response with an error status
+def get_request_error(resp, body, data=None):
+    # Extract the relevant portion from the error message
+    if isinstance(data, dict) and isinstance(data.get("error"), dict):
+        message = data["error"].get("message")
+    else:
+        message = body.strip()[:200] or resp.reason
+    return OpenAIRequestError(f"HTTP {resp.status}: {message}", resp.status, get_retry_after(resp.headers))
+
+
+# Function to cut a streamed response off at the client-side stop phrase or character cap
+# (returns the response and whether it was cut off, the stop phrase is searched from the given position on)
+def apply_client_stop(response, stop_phrase=None, max_chars=None, search_from=0):
+    if stop_phrase:
+        position = response.find(stop_phrase, search_from)
+        if position != -1:
+            return response[:position], True
+    if max_chars and len(response) >= max_chars:
+        return response[:max_chars], True
+    return response, False
+
+
+# Function to send a streaming HTTP POST request to the OpenAI API and put the streamed choices back together
+# (returns the responses in the shape of a regular chat completion, the time to first token and the inter-token latency)
+async def send_openai_api_streaming_request(session, url, headers, payload, stop_phrase=None, max_chars=None):
+    started = time.monotonic()
+    responses = [""] * (payload.get("n") or 1)
+    finish_reasons = [None] * len(responses)
+    model = usage = None
+    first_token_time = last_token_time = None
+    chunks_received = 0  # Chunks that carried content
+
+    async with session.post(url, headers=headers, data=dumps_json(payload)) as resp:
+        if resp.status != 200:
+            raise get_request_error(resp, *await read_json_body(resp))
+
+        # Parse the server-sent events line by line as they arrive
+        async for line in resp.content:
+            line = line.strip()
+            if not line.startswith(b"data:"):
+                continue
+            event = line[5:].strip()
+            if event == b"[DONE]":
+                break
+
+            try:
+                chunk = loads_json(event)
+            except ValueError:
+                raise OpenAIRequestError(f"Malformed stream chunk: {event[:200].decode('utf-8', 'replace')}")
+            if isinstance(chunk.get("error"), dict):
+                raise OpenAIRequestError(f"Stream interrupted: {chunk['error'].get('message')}")
+
+            model = chunk.get("model") or model
+            usage = chunk.get("usage") or usage  # Sent in a last chunk without choices
+            for choice in chunk.get("choices") or []:
+                index = choice.get("index", 0)
+                if finish_reasons[index] == CLIENT_STOP_FINISH_REASON:
+                    continue  # Already cut off on the client side
+
+                content = (choice.get("delta") or {}).get("content")
+                if content:
+                    last_token_time = time.monotonic()
+                    first_token_time = first_token_time or last_token_time
+                    chunks_received += 1
+
+                    # Only the new content (and a stop phrase it may complete) needs to be searched
+                    search_from = max(0, len(responses[index]) - len(stop_phrase or "") + 1)
+                    responses[index], stopped = apply_client_stop(responses[index] + content, stop_phrase, max_chars,
+                                                                  search_from)
+                    if stopped:
+                        finish_reasons[index] = CLIENT_STOP_FINISH_REASON
+                        continue
+                if choice.get("finish_reason"):
+                    finish_reasons[index] = choice["finish_reason"]
+
+            # Stop reading once every response is cut off, instead of paying for the rest of the stream
+            if all(finish_reason == CLIENT_STOP_FINISH_REASON for finish_reason in finish_reasons):
+                resp.close()
+                break
+
+    data = {"model": model, "usage": usage,
+            "choices": [{"message": {"content": response}, "finish_reason": finish_reason}
+                        for response, finish_reason in zip(responses, finish_reasons)]}
+    ttft = first_token_time - started if first_token_time else None
+    inter_token_latency = ((last_token_time - first_token_time) / (chunks_received - 1)
+                           if chunks_received > 1 else None)
+    return data, ttft, inter_token_latency
+
+
+# Function to apply the failure policy to a request that could not be completed
+def handle_failed_request(error, on_failure, attempts, model=None):
+    error_message = f"Request failed after {attempts} attempt(s). Received the following response ➔ {error}"
+
+    if on_failure == 'abort':
+        handle_error(f"Connection issue with the OpenAI API. {error_message}",
+                     f"Connection issue with the OpenAI API. {error_message}.")
+
+    handle_error(f"Prompt dropped by the OpenAI API ➔ {error}. Moving on to the next prompt!",
+                 f"{error_message}. Applied failure policy '{on_failure}'.", is_warning=True)
+
+    # Record the error in place of the responses, or leave the prompt out of the output altogether
+    if on_failure == 'error_row':
+        return ChatCompletionResponses([f"{ERROR_RESPONSE_PREFIX}{error}"], ["error"], model, retries=attempts - 1)
+    return ChatCompletionResponses(model=model, retries=attempts - 1)
+
+
+# Function to get the base URL of the OpenAI API, that the chat completions endpoint lives under
+# (Example: https://api.openai.com/v1)
+def get_openai_api_base_url():
+    return config.get('openai_api_url').rsplit('/chat/completions', 1)[0]
+
+
+# Function to look up an AI model through the models endpoint, a lightweight request that costs no tokens
+# (a model that cannot be looked up after all retries aborts the program)
+async def look_up_ai_model(session, client, model, max_retries):
+    url = f"{get_openai_api_base_url()}/models/{model}"
+    headers = {"Authorization": build_request_headers(client)["Authorization"]}
+
+    attempt = 0
+    while True:
+        try:
+            return await send_openai_api_request(session, url, headers, method="GET")
+
+        # Handle potential errors
+        except OpenAIRequestError as OpenAIError:
+            error = OpenAIError
+        except (aiohttp.ClientError, asyncio.TimeoutError) as NetworkError:
+            error = OpenAIRequestError(f"{type(NetworkError).__name__}: {NetworkError}")
+
+        if not error.is_retryable or attempt >= max_retries:
+            handle_failed_request(error, 'abort', attempt + 1)
+
+        await asyncio.sleep(get_backoff_delay(attempt, error.retry_after))
+        attempt += 1
+
+
+# Function to build the headers of the requests sent to the OpenAI API
+def build_request_headers(client):
+    return {
         "Content-Type": "application/json",
         "Authorization": f"Bearer {client.api_key}"
     }
-    payload = {
+
+
+# Function to build the payload of a chat completion request (shared by the live and the batch requests)
+def build_request_payload(args, messages):
+    return {
         "model": args.ai_model,
         "messages": messages,
         "max_tokens": args.max_tokens,
@@ -20,14 +297,104 @@ async def openai_api_request_wrapper(session, client, args, messages):
         "stop": args.stop,
         "temperature": args.temperature
     }
+
+
+# Function to convert a chat completion returned by the OpenAI API into its responses and their details
+# (a body without choices is raised as a failed request, so that it is retried like a malformed body)
+def parse_chat_completion(data, model=None, latency=None, retries=0):
     try:
-        async with session.post(url, headers=headers, data=json.dumps(payload)) as resp:
-            data = await resp.json()
-            if resp.status != 200:
-                raise Exception(data["error"]["message"])  # Extract the relevant portion from the error message
-            return [choice["message"]["content"] for choice in data["choices"]]
-
-    # Handle potential errors
-    except Exception as OpenAIError:
-        handle_error(f"Connection issue with the OpenAI API. Received the following response ➔ {OpenAIError}",
-                     f"Connection issue with the OpenAI API. Received the following response ➔ {OpenAIError}.")
+        responses = [choice["message"]["content"] for choice in data["choices"]]
+        finish_reasons = [choice.get("finish_reason") for choice in data["choices"]]
+    except (AttributeError, KeyError, TypeError):
+        raise OpenAIRequestError(f"Malformed response body: {str(data)[:200]}")
+    return ChatCompletionResponses(responses, finish_reasons, data.get("model") or model, latency, data.get("usage"),
+                                   retries)
+
+
+# Wrapper for making HTTP POST requests to the OpenAI API
+async def openai_api_request_wrapper(session, client, args, messages, on_failure=None, rate_limiter=None,
+                                     concurrency_controller=None, cache=None, metrics=None, hedger=None):
+    url = config.get('openai_api_url')
+    headers = build_request_headers(client)
+    payload = build_request_payload(args, messages)
+    if args.stream:
+        payload["stream"] = True
+        payload["stream_options"] = {"include_usage": True}  # Report the token usage in the last chunk
+
+    # Serve the responses from the cache when the same request was answered before
+    if cache and cache.is_readable:
+        cached_responses = cache.get(payload)
+        if cached_responses is not None:
+            return ChatCompletionResponses.from_dict(cached_responses, cached=True)
+
+    estimated_tokens = estimate_request_tokens(messages, args.max_tokens, args.n)
+
+    # Function to send a single attempt of the request (a duplicate sent by the hedger waits for the rate limiter too)
+    # and correct its token estimate with the usage reported by the OpenAI API (an attempt cancelled by the hedger keeps
+    # its estimate, as the request has already reached the OpenAI API)
+    async def send_attempt(is_hedge=False):
+        if is_hedge and rate_limiter:
+            await rate_limiter.acquire(estimated_tokens)
+        if args.stream:
+            data, ttft, inter_token_latency = await send_openai_api_streaming_request(
+                session, url, headers, payload, args.stream_stop, args.max_response_chars)
+        else:
+            data = await send_openai_api_request(session, url, headers, payload)
+            ttft = inter_token_latency = None
+
+        if rate_limiter:
+            rate_limiter.record_usage(estimated_tokens, (data.get("usage") or {}).get("total_tokens"))
+        return data, ttft, inter_token_latency
+
+    attempt = 0
+    while True:
+        try:
+            # Wait for the shared rate limiter before every attempt, retries included
+            if rate_limiter:
+                waited = await rate_limiter.acquire(estimated_tokens)
+                if metrics:
+                    metrics.record_rate_limiter_wait(waited)
+
+            started = time.monotonic()
+            if hedger:
+                data, ttft, inter_token_latency = await hedger.send(send_attempt)
+            else:
+                data, ttft, inter_token_latency = await send_attempt()
+            latency = time.monotonic() - started
+            responses = parse_chat_completion(data, args.ai_model, latency, attempt)
+            responses.ttft, responses.inter_token_latency = ttft, inter_token_latency
+            if concurrency_controller:
+                concurrency_controller.record_attempt(latency)
+            if metrics:
+                metrics.record_request(latency, 200)
+
+            # Store the responses for later runs (unless they were cut off on the client side)
+            if cache and cache.is_writable and CLIENT_STOP_FINISH_REASON not in responses.finish_reasons:
+                cache.put(payload, responses.to_dict())
+            return responses
+
+        # Handle potential errors
+        except OpenAIRequestError as OpenAIError:
+            error = OpenAIError
+        except (aiohttp.ClientError, asyncio.TimeoutError) as NetworkError:
+            error = OpenAIRequestError(f"{type(NetworkError).__name__}: {NetworkError}")
+
+        # Let the concurrency controller react to throttling and timeouts
+        if concurrency_controller:
+            concurrency_controller.record_attempt(time.monotonic() - started, error)
+        if metrics:
+            metrics.record_request(time.monotonic() - started, error.status)
+
+        # Hold back all other requests as well when the server asks to slow down
+        if rate_limiter and error.retry_after:
+            rate_limiter.pause(error.retry_after)
+
+        # Give up once the error is permanent or the retry budget of the request is spent
+        if not error.is_retryable or attempt >= args.max_retries:
+            return handle_failed_request(error, on_failure or args.on_failure, attempt + 1, args.ai_model)
+
+        delay = get_backoff_delay(attempt, error.retry_after)
+        logging.warning(f"Request to the OpenAI API failed ({error}). Retry {attempt + 1}/{args.max_retries} "
+                        f"in {delay:.2f} seconds.")
+        await asyncio.sleep(delay)
+        attempt += 1
@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+
+# Import the required modules and the helper functions
+from helper import handle_error
+from required_modules import abc, asyncio, csv, json, os, time
+
+# Columns recorded for each response (the CSV output keeps the classic '#,Prompt,Response' columns)
+OUTPUT_COLUMNS = ["index", "prompt", "response", "conversation", "guidelines_file", "ai_model", "branch",
+                  "choice_index", "finish_reason", "model", "latency", "ttft", "inter_token_latency", "prompt_tokens",
+                  "completion_tokens", "retries", "cached"]
+
+# Columns added by the scoring of the responses (--score)
+SCORE_COLUMNS = ["data_leaks", "refusal", "similarity"]
+
+
+# Base class of the output sinks, each of which stores the output rows in a specific file format
+class OutputSink(abc.ABC):
+    def __init__(self, output_file, multiple_conversations=False, matrix=False, scoring=False, branching=False):
+        self.output_file = output_file
+        self.multiple_conversations = multiple_conversations  # Record the conversation of each prompt
+        self.matrix = matrix  # Record the guidelines file and the AI model of each result (matrix runs)
+        self.scoring = scoring  # Record the scores of each response (--score)
+        self.branching = branching  # Record the branch of the conversation tree of each response (--branch_depth)
+        self.file = None
+
+    # Method to open the output file in append mode
+    def open(self):
+        try:
+            self.file = open(self.output_file, mode='a', newline='', encoding='utf-8')
+        except OSError as e:
+            handle_error(f"Output file '{self.output_file}' could not be opened: {e}. Aborting launch!",
+                         f"Output file '{self.output_file}' could not be opened: {e}.")
+
+    # Method to store a single output row (a dictionary keyed by the output columns)
+    @abc.abstractmethod
+    def write_row(self, row):
+        pass
+
+    # Method to hand the buffered rows over to the operating system
+    def flush(self):
+        self.file.flush()
+
+    # Method to sync the output file to the disk
+    def sync(self):
+        os.fsync(self.file.fileno())
+
+    # Method to close the output file
+    def close(self):
+        if self.file and not self.file.closed:
+            self.flush()
+            self.sync()
+            self.file.close()
+
+
+# Class to store the output rows in a CSV file
+class CSVOutputSink(OutputSink):
+    def open(self):
+        super().open()
+        self.writer = csv.writer(self.file, lineterminator='\n')
+
+        # Write the header row if the file is empty
+        if self.file.tell() == 0:
+            header = ['#', 'Prompt', 'Response']
+            if self.multiple_conversations:
+                header.append('Conversation')
+            if self.matrix:
+                header += ['Guidelines', 'AI Model']
+            if self.branching:
+                header.append('Branch')
+            if self.scoring:
+                header += ['Data Leaks', 'Refusal', 'Similarity']
+            self.writer.writerow(header)
+
+    def write_row(self, row):
+        values = [row["index"], row["prompt"], row["response"]]
+        if self.multiple_conversations:
+            values.append(row["conversation"])
+        if self.matrix:
+            values += [row["guidelines_file"], row["ai_model"]]
+        if self.branching:
+            values.append(row["branch"])
+        if self.scoring:
+            values += [row["data_leaks"], row["refusal"], row["similarity"]]
+        self.writer.writerow(values)  # The csv module takes care of quoting commas, quotes and newlines
+
+
+# Class to store the output rows in a JSONL file (one JSON object per line)
+class JSONLOutputSink(OutputSink):
+    def write_row(self, row):
+        self.file.write(json.dumps(row, ensure_ascii=False) + '\n')
+
+
+# Class to store the output rows in a columnar Parquet file, one row group per batch of rows
+class ParquetOutputSink(OutputSink):
+    def __init__(self, output_file, multiple_conversations=False, matrix=False, scoring=False, branching=False,
+                 row_group_size=10000):
+        super().__init__(output_file, multiple_conversations, matrix, scoring, branching)
+        self.row_group_size = row_group_size  # Rows buffered per row group
+        self.column_names = OUTPUT_COLUMNS + SCORE_COLUMNS if scoring else OUTPUT_COLUMNS
+        self.columns = {column: [] for column in self.column_names}  # Buffered rows, column by column
+        self.writer = None
+
+    def open(self):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ModuleNotFoundError:
+            handle_error("Required Python module 'pyarrow' is missing for the Parquet output. "
+                         "Install it using 'pip install pyarrow'. Aborting launch!",
+                         "Python module 'pyarrow' required for the Parquet output was missing.")
+
+        self.pyarrow = pyarrow
+        fields = [
+            ("index", pyarrow.int64()), ("prompt", pyarrow.string()), ("response", pyarrow.string()),
+            ("conversation", pyarrow.string()), ("guidelines_file", pyarrow.string()),
+            ("ai_model", pyarrow.string()), ("branch", pyarrow.string()), ("choice_index", pyarrow.int32()),
+            ("finish_reason", pyarrow.string()), ("model", pyarrow.string()), ("latency", pyarrow.float64()),
+            ("ttft", pyarrow.float64()), ("inter_token_latency", pyarrow.float64()),
+            ("prompt_tokens", pyarrow.int64()), ("completion_tokens", pyarrow.int64()),
+            ("retries", pyarrow.int32()), ("cached", pyarrow.bool_())]
+        if self.scoring:
+            fields += [("data_leaks", pyarrow.string()), ("refusal", pyarrow.bool_()),
+                       ("similarity", pyarrow.float64())]
+        self.schema = pyarrow.schema(fields)
+
+        # A Parquet file cannot be appended to, as its footer describes the whole file
+        if os.path.exists(self.output_file) and os.path.getsize(self.output_file) > 0:
+            handle_error(f"Parquet output file '{self.output_file}' already exists and cannot be appended to. "
+                         f"Aborting launch!", f"Parquet output file '{self.output_file}' already existed.")
+        self.writer = pyarrow.parquet.ParquetWriter(self.output_file, self.schema)
+
+    def write_row(self, row):
+        for column in self.column_names:
+            self.columns[column].append(row[column])
+
+    # Method to write the buffered rows as a row group once enough rows are buffered (or when forced)
+    def write_row_group(self, force=False):
+        buffered_rows = len(self.columns["index"])
+        if buffered_rows and (force or buffered_rows >= self.row_group_size):
+            self.writer.write_table(self.pyarrow.table(self.columns, schema=self.schema))
+            self.columns = {column: [] for column in self.column_names}
+
+    def flush(self):
+        self.write_row_group()
+
+    def sync(self):
+        pass  # The Parquet file is only complete and readable once its footer is written on close
+
+    def close(self):
+        if self.writer:
+            self.write_row_group(force=True)
+            self.writer.close()
+            self.writer = None
+
+
+# Function to create the output sink for the given output format
+def create_output_sink(output_format, output_file, multiple_conversations=False, matrix=False, scoring=False,
+                       branching=False):
+    sinks = {"csv": CSVOutputSink, "jsonl": JSONLOutputSink, "parquet": ParquetOutputSink}
+    return sinks[output_format](output_file, multiple_conversations, matrix, scoring, branching)
+
+
+# Class to write the results to the output file through a long-lived output sink, in batches
+class OutputWriter:
+    def __init__(self, output_file, output_format="csv", multiple_conversations=False, flush_rows=100,
+                 flush_interval=0.5, fsync_interval=5.0, matrix=False, scoring_pipeline=None, branching=False):
+        self.sink = create_output_sink(output_format, output_file, multiple_conversations, matrix,
+                                       scoring_pipeline is not None, branching)
+        self.scoring_pipeline = scoring_pipeline  # Scores the rows before they are written (None: scoring is off)
+        self.flush_rows = flush_rows  # Rows buffered before they are flushed to the output file
+        self.flush_interval = flush_interval  # Seconds after which buffered rows are flushed anyway
+        self.fsync_interval = fsync_interval  # Seconds between two syncs of the output file to the disk
+        self.pending_rows = 0  # Rows written since the last flush
+        self.last_fsync = time.monotonic()
+        self.flush_task = None
+
+    # Method to open the output file
+    async def open(self):
+        self.sink.open()
+        await self.flush(fsync=True)
+
+        # Flush the buffered rows periodically, so that a slow trickle of results still reaches the disk
+        self.flush_task = asyncio.create_task(self.flush_periodically())
+
+    # Method to write the rows of a result (one row per response)
+    async def write_result(self, result):
+        index, prompt, responses, conversation_id, cell, branch_paths = result
+        cell = cell or {}
+        branch_paths = branch_paths or [None] * len(responses)
+        finish_reasons = getattr(responses, "finish_reasons", [None] * len(responses))
+        usage = getattr(responses, "usage", {})
+
+        rows = []
+        for choice_index, response in enumerate(responses):
+            rows.append({
+                "index": index, "prompt": prompt, "response": response, "conversation": conversation_id,
+                "guidelines_file": cell.get("guidelines_file"), "ai_model": cell.get("ai_model"),
+                "branch": branch_paths[choice_index], "choice_index": choice_index,
+                "finish_reason": finish_reasons[choice_index],
+                "model": getattr(responses, "model", None), "latency": getattr(responses, "latency", None),
+                "ttft": getattr(responses, "ttft", None),
+                "inter_token_latency": getattr(responses, "inter_token_latency", None),
+                "prompt_tokens": usage.get("prompt_tokens"), "completion_tokens": usage.get("completion_tokens"),
+                "retries": getattr(responses, "retries", 0), "cached": getattr(responses, "cached", False)})
+
+        # Scored rows are written once their batch is scored, still in order
+        if self.scoring_pipeline:
+            rows = await self.scoring_pipeline.score_rows(rows)
+        self.write_rows(rows)
+
+        if self.pending_rows >= self.flush_rows:
+            await self.flush()
+
+    # Method to store the given rows through the output sink
+    def write_rows(self, rows):
+        for row in rows:
+            self.sink.write_row(row)
+        self.pending_rows += len(rows)
+
+    # Method to hand the buffered rows over to the operating system, and sync them to the disk every now and then
+    async def flush(self, fsync=False):
+        self.sink.flush()
+        self.pending_rows = 0
+
+        if fsync or time.monotonic() - self.last_fsync >= self.fsync_interval:
+            self.last_fsync = time.monotonic()
+            await asyncio.get_running_loop().run_in_executor(None, self.sink.sync)
+
+    # Method to flush the buffered rows at a regular interval
+    async def flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            if self.scoring_pipeline:
+                self.write_rows(await self.scoring_pipeline.flush())
+            if self.pending_rows:
+                await self.flush()
+
+    # Method to flush the remaining rows and close the output file (also used when the program is interrupted)
+    def close(self):
+        if self.flush_task:
+            self.flush_task.cancel()
+            self.flush_task = None
+        if self.scoring_pipeline:
+            self.write_rows(self.scoring_pipeline.finish())
+        self.sink.close()
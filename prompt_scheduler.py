@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+
+# Import the required modules and the helper functions
+from concurrency_controller import get_percentile
+from helper import handle_error
+from rate_limiter import estimate_message_tokens
+from required_modules import asyncio, collections, heapq, json, os, time
+
+
+# Function to get the name of the manifest of the skipped prompts, next to the output file
+def get_skipped_prompts_filename(output_file):
+    return f"{os.path.splitext(output_file)[0]}_skipped.jsonl"
+
+
+# Function to estimate the prompt and completion tokens of a prompt, counting the full response budget
+def estimate_prompt_tokens(messages, max_tokens, n=1):
+    return estimate_message_tokens(messages), (max_tokens or 0) * (n or 1)
+
+
+# Class to dispatch the prompts within a spend budget and a deadline: the prompts read ahead are dispatched longest
+# expected first to shrink the tail of the run, and no new prompt is admitted once the projected spend or time would
+# exceed the budget (the prompts in flight still finish, and the prompts left out are listed in a manifest)
+class PromptScheduler:
+    def __init__(self, estimate_prompt, max_tokens_total=None, max_cost=None, deadline_at=None, token_prices=None,
+                 lookahead=200, skipped_prompts_file=None):
+        self.estimate_prompt = estimate_prompt  # Function giving the (prompt tokens, completion tokens) of a prompt
+        self.max_tokens_total = max_tokens_total  # Token budget of the run (None: unlimited)
+        self.max_cost = max_cost  # Spend budget of the run in USD (None: unlimited)
+        self.deadline_at = deadline_at  # Monotonic time after which no prompt is answered in time (None: no deadline)
+        self.token_prices = token_prices or (0, 0)  # USD per million prompt and completion tokens
+        self.lookahead = lookahead  # Prompts read ahead to pick the longest one from
+        self.skipped_prompts_file = skipped_prompts_file  # Manifest of the prompts left out (JSONL)
+        self.used_tokens = 0  # Tokens reported by the finished requests
+        self.spent = 0.0  # Spend of the finished requests in USD
+        self.reserved = {}  # Worst-case (tokens, cost) of each prompt in flight
+        self.reserved_tokens = 0
+        self.reserved_cost = 0.0
+        self.latencies = collections.deque(maxlen=1000)  # Latencies of the most recent requests
+        self.released = asyncio.Condition()  # Notified whenever a prompt in flight finishes
+        self.stop_reason = None  # Budget that ran out (None: still admitting)
+        self.admitted_prompts = 0
+        self.skipped_prompts = 0
+        self.manifest = None
+
+    # Method to get the worst-case cost in USD of the given tokens
+    def get_cost(self, prompt_tokens, completion_tokens):
+        return (prompt_tokens * self.token_prices[0] + completion_tokens * self.token_prices[1]) / 1_000_000
+
+    # Method to check whether a prompt fits the budgets, next to the prompts in flight (returns the budget it does not
+    # fit, or None)
+    def check_budgets(self, tokens, cost):
+        if self.deadline_at is not None:
+            expected_latency = get_percentile(self.latencies, 95) if self.latencies else 0
+            if time.monotonic() + expected_latency > self.deadline_at:
+                return "deadline"
+        if self.max_tokens_total is not None and (self.used_tokens + self.reserved_tokens + tokens >
+                                                  self.max_tokens_total):
+            return "max_tokens_total"
+        if self.max_cost is not None and self.spent + self.reserved_cost + cost > self.max_cost:
+            return "max_cost"
+        return None
+
+    # Method to decide whether a prompt is sent: a prompt that does not fit the budgets waits for the prompts in
+    # flight, whose actual usage may leave room for it, and stops the admission once nothing is left in flight
+    async def admit(self, index, prompt_tokens, completion_tokens):
+        tokens, cost = prompt_tokens + completion_tokens, self.get_cost(prompt_tokens, completion_tokens)
+        async with self.released:
+            while self.stop_reason is None:
+                budget = self.check_budgets(tokens, cost)
+                if budget is None:
+                    self.reserved[index] = (tokens, cost)
+                    self.reserved_tokens += tokens
+                    self.reserved_cost += cost
+                    self.admitted_prompts += 1
+                    return True
+
+                # Waiting for the prompts in flight cannot make up for the time
+                if budget == "deadline" or not self.reserved:
+                    self.stop_reason = budget
+                    break
+                await self.released.wait()
+        return False
+
+    # Method to record the usage of a finished prompt, freeing its reservation
+    async def record_result(self, index, responses):
+        usage = getattr(responses, "usage", {}) if not getattr(responses, "cached", False) else {}
+        prompt_tokens, completion_tokens = usage.get("prompt_tokens") or 0, usage.get("completion_tokens") or 0
+        self.used_tokens += prompt_tokens + completion_tokens
+        self.spent += self.get_cost(prompt_tokens, completion_tokens)
+        if getattr(responses, "latency", None) is not None:
+            self.latencies.append(responses.latency)
+
+        async with self.released:
+            tokens, cost = self.reserved.pop(index, (0, 0.0))
+            self.reserved_tokens -= tokens
+            self.reserved_cost -= cost
+            self.released.notify_all()
+
+    # Method to list a prompt left out in the manifest of the skipped prompts
+    def record_skipped_prompt(self, index, prompt):
+        self.skipped_prompts += 1
+        if self.skipped_prompts_file is None:
+            return
+        try:
+            if self.manifest is None:
+                self.manifest = open(self.skipped_prompts_file, mode='w', encoding='utf-8')
+            self.manifest.write(json.dumps({"index": index, "prompt": prompt.rstrip('\n'),
+                                            "reason": self.stop_reason}, ensure_ascii=False) + '\n')
+        except OSError as e:
+            handle_error(f"Manifest of the skipped prompts '{self.skipped_prompts_file}' could not be written: {e}. "
+                         f"Aborting mission!", f"Manifest of the skipped prompts could not be written: {e}.")
+
+    # Method to hand the prompts out in dispatch order, along with whether each of them is sent
+    # (take_in is awaited for every prompt read, in file order, before it is held back in the lookahead)
+    async def schedule(self, prompts, take_in, is_congested):
+        lookahead = []  # Heap of the prompts read ahead, longest expected first (file order among equals)
+
+        # Function to pick the next prompt out of the lookahead, and decide whether it is sent
+        async def dispatch(oldest=False):
+            if oldest:
+                # The prompt written next is held back here, so it skips the queue rather than stall the output
+                position = min(range(len(lookahead)), key=lambda position: lookahead[position][1])
+                lookahead[position], lookahead[-1] = lookahead[-1], lookahead[position]
+                _, index, prompt, prompt_tokens, completion_tokens = lookahead.pop()
+                heapq.heapify(lookahead)
+            else:
+                _, index, prompt, prompt_tokens, completion_tokens = heapq.heappop(lookahead)
+
+            if self.stop_reason is None and await self.admit(index, prompt_tokens, completion_tokens):
+                return index, prompt, True
+            self.record_skipped_prompt(index, prompt)
+            return index, prompt, False
+
+        try:
+            async for index, prompt in prompts:
+                while lookahead and is_congested():
+                    yield await dispatch(oldest=True)
+                await take_in(index)
+
+                prompt_tokens, completion_tokens = self.estimate_prompt(prompt)
+                heapq.heappush(lookahead, (-(prompt_tokens + completion_tokens), index, prompt, prompt_tokens,
+                                           completion_tokens))
+                if len(lookahead) >= self.lookahead:
+                    yield await dispatch()
+
+            while lookahead:
+                yield await dispatch()
+        finally:
+            if self.manifest:
+                self.manifest.close()
+
+    # Method to summarize the budgets for the run statistics
+    def get_summary(self):
+        summary = f"{self.admitted_prompts} prompt(s) sent"
+        if self.max_tokens_total is not None:
+            summary += f", {self.used_tokens} of {self.max_tokens_total} tokens used"
+        if self.max_cost is not None:
+            summary += f", ${self.spent:.4f} of ${self.max_cost:.4f} spent"
+        if self.skipped_prompts:
+            summary += f", {self.skipped_prompts} skipped once the {self.stop_reason} budget ran out"
+            if self.skipped_prompts_file:
+                summary += f" (listed in '{self.skipped_prompts_file}')"
+        return summary
+
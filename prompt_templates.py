@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+
+# Template suites expand prompt templates over wordlists on the fly, instead of pre-generating huge prompts files
+# (Example: python prompt_templates.py suite.yaml 42 1337, to map the prompt IDs of an output back to the template
+# and the words they were expanded from)
+
+# Import the required modules and the helper functions
+from helper import handle_error, setup_program, FileParser
+from required_modules import argparse, base64, bisect, json, os, quote, re, yaml
+
+# Extensions of a prompts file holding a template suite
+TEMPLATE_SUITE_EXTENSIONS = ('.yaml', '.yml')
+
+# Placeholder of a template along with the transforms applied to its word (Example: {payload|leetspeak|base64}),
+# or an escaped brace
+PLACEHOLDER_PATTERN = re.compile(r"\{\{|\}\}|\{([A-Za-z_]\w*)((?:\|[A-Za-z_][\w-]*)*)\}")
+
+# Character substitutions of the built-in transforms
+LEETSPEAK_TABLE = str.maketrans("aAeEiIoOsStT", "443311005577")
+ROT13_TABLE = str.maketrans("abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ",
+                            "nopqrstuvwxyzabcdefghijklmNOPQRSTUVWXYZABCDEFGHIJKLM")
+
+# Built-in transforms of the words bound to a placeholder, applied from left to right
+TRANSFORMS = {
+    "base64": lambda text: base64.b64encode(text.encode('utf-8')).decode('ascii'),
+    "hex": lambda text: text.encode('utf-8').hex(),
+    "url": lambda text: quote(text, safe=''),
+    "rot13": lambda text: text.translate(ROT13_TABLE),
+    "leetspeak": lambda text: text.translate(LEETSPEAK_TABLE),
+    "reverse": lambda text: text[::-1],
+    "upper": str.upper,
+    "lower": str.lower
+}
+
+MASK_64 = (1 << 64) - 1
+
+
+# Function to scramble a number into a well-spread 64-bit number (SplitMix64), the same on every host and Python
+# version, so that a sample of the suite is drawn identically by every worker
+def mix_bits(value):
+    value = (value + 0x9E3779B97F4A7C15) & MASK_64
+    value = ((value ^ (value >> 30)) * 0xBF58476D1CE4E5B9) & MASK_64
+    value = ((value ^ (value >> 27)) * 0x94D049BB133111EB) & MASK_64
+    return value ^ (value >> 31)
+
+
+# Function to check whether the prompts file holds a template suite
+def is_template_suite(prompts_file):
+    return prompts_file.lower().endswith(TEMPLATE_SUITE_EXTENSIONS)
+
+
+# Class to hold a prompt template, compiled into its literal text and its placeholders
+class PromptTemplate:
+    def __init__(self, text, names, parts, radices):
+        self.text = text
+        self.names = names  # Wordlists bound to the template, in order of first appearance
+        self.parts = parts  # Literal text, or the position of a wordlist in names along with the transforms
+        self.radices = radices  # Words per wordlist in names
+        self.combination_count = 1
+        for radix in radices:
+            self.combination_count *= radix
+
+    # Method to get the word indices bound by a combination number of the template
+    # (the last placeholder varies fastest, as with itertools.product)
+    def get_word_indices(self, number):
+        indices = [0] * len(self.radices)
+        for position in range(len(self.radices) - 1, -1, -1):
+            number, indices[position] = divmod(number, self.radices[position])
+        return indices
+
+    # Method to fill the placeholders of the template with the given words (one per wordlist in names)
+    def render(self, words):
+        prompt = []
+        for part in self.parts:
+            if isinstance(part, str):
+                prompt.append(part)
+                continue
+            position, transforms = part
+            word = words[position]
+            for transform in transforms:
+                word = transform(word)
+            prompt.append(word)
+        return ''.join(prompt)
+
+
+# Class to expand a template suite: every template is combined with every word of the wordlists it refers to, and
+# each combination is numbered, so that any prompt is rebuilt from its ID alone without expanding the others
+class TemplateSuite:
+    def __init__(self, suite_file):
+        self.suite_file = suite_file
+        suite = self.read_suite()
+
+        self.wordlists = {}
+        for name, wordlist in (suite.get('wordlists') or {}).items():
+            self.wordlists[str(name)] = self.read_wordlist(str(name), wordlist)
+
+        # Translation tables are used like the built-in transforms (Example: homoglyphs: {"a": "а", "o": "о"})
+        self.transforms = dict(TRANSFORMS)
+        for name, table in (suite.get('translations') or {}).items():
+            if name in TRANSFORMS:
+                self.report_invalid(f"translation table '{name}' shadows a built-in transform")
+            try:
+                translation = str.maketrans({str(key): str(value) for key, value in table.items()})
+            except (AttributeError, ValueError):
+                self.report_invalid(f"translation table '{name}' has to map single characters to their replacement")
+            self.transforms[name] = lambda text, translation=translation: text.translate(translation)
+
+        templates = suite.get('templates')
+        if not isinstance(templates, list) or not templates:
+            self.report_invalid("'templates' has to be a list of prompt templates")
+        self.templates = [self.compile_template(str(text).strip()) for text in templates]
+
+        # First combination number of each template
+        self.first_numbers = []
+        self.combination_count = 0
+        for template in self.templates:
+            self.first_numbers.append(self.combination_count)
+            self.combination_count += template.combination_count
+
+        # A sample draws one combination out of each of its equal slices of the suite, so that it spreads over every
+        # template and is drawn the same way on every run with the same seed
+        sample, seed = suite.get('sample'), suite.get('seed', 0)
+        if sample is not None and (not isinstance(sample, int) or sample < 1):
+            self.report_invalid("'sample' has to be a positive number of prompts")
+        if not isinstance(seed, int):
+            self.report_invalid("'seed' has to be a whole number")
+        self.sample = sample if sample is not None and sample < self.combination_count else None
+        self.seed_bits = mix_bits(seed & MASK_64)
+        self.prompt_count = self.sample or self.combination_count
+
+    # Method to report an invalid template suite, and exit the program
+    def report_invalid(self, reason):
+        handle_error(f"Template suite '{self.suite_file}' is invalid: {reason}. Aborting launch!",
+                     f"Template suite '{self.suite_file}' is invalid: {reason}.")
+
+    # Method to read the template suite file
+    def read_suite(self):
+        try:
+            with open(self.suite_file, 'r', encoding='utf-8') as file:
+                suite = yaml.safe_load(file)
+        except FileNotFoundError:
+            handle_error(f"Mission-critical file '{self.suite_file}' missing! Aborting launch!",
+                         f"File '{self.suite_file}' could not be found.")
+        except (OSError, UnicodeDecodeError, yaml.YAMLError) as e:
+            handle_error(f"Template suite '{self.suite_file}' could not be read: {e}. Aborting launch!",
+                         f"Template suite '{self.suite_file}' could not be read: {e}.")
+        if not isinstance(suite, dict):
+            self.report_invalid("it has to hold the keys 'templates' and 'wordlists'")
+        return suite
+
+    # Method to read the words of a wordlist, given inline or as a file with one word per line
+    # (relative to the template suite file)
+    def read_wordlist(self, name, wordlist):
+        if isinstance(wordlist, list):
+            words = [str(word) for word in wordlist]
+        else:
+            path = os.path.join(os.path.dirname(self.suite_file), str(wordlist))
+            try:
+                with open(path, 'r', encoding='utf-8') as file:
+                    words = [line.strip() for line in file if line.strip()]
+            except (OSError, UnicodeDecodeError) as e:
+                handle_error(f"Wordlist '{name}' of the template suite '{self.suite_file}' could not be read: {e}. "
+                             f"Aborting launch!", f"Wordlist '{path}' could not be read: {e}.")
+        if not words:
+            self.report_invalid(f"wordlist '{name}' is empty")
+        return words
+
+    # Method to compile a template into its literal text and its placeholders
+    def compile_template(self, text):
+        names, parts, literal, end = [], [], [], 0
+        for match in PLACEHOLDER_PATTERN.finditer(text):
+            literal.append(text[end:match.start()])
+            end = match.end()
+            if match.group(1) is None:
+                literal.append(match.group(0)[0])  # Escaped brace
+                continue
+
+            name, transform_names = match.group(1), match.group(2).split('|')[1:]
+            if name not in self.wordlists:
+                self.report_invalid(f"template '{text}' refers to the undefined wordlist '{name}'")
+            unknown_transforms = [transform for transform in transform_names if transform not in self.transforms]
+            if unknown_transforms:
+                self.report_invalid(f"template '{text}' refers to the undefined transform '{unknown_transforms[0]}'")
+
+            # A wordlist repeated in a template binds the same word each time
+            if name not in names:
+                names.append(name)
+            if literal:
+                parts.append(''.join(literal))
+                literal = []
+            parts.append((names.index(name), [self.transforms[transform] for transform in transform_names]))
+
+        literal.append(text[end:])
+        if ''.join(literal):
+            parts.append(''.join(literal))
+        return PromptTemplate(text, names, parts, [len(self.wordlists[name]) for name in names])
+
+    # Method to get the ID of the prompt at a position of the suite, numbered from 1 (the position and the ID match
+    # unless the suite is sampled)
+    def get_prompt_id(self, position):
+        if self.sample is None:
+            return position
+        first_number = (position - 1) * self.combination_count // self.sample
+        next_number = position * self.combination_count // self.sample
+        return first_number + mix_bits(self.seed_bits ^ position) % (next_number - first_number) + 1
+
+    # Method to get the position of the last prompt of the suite whose ID does not exceed the given one
+    def get_position(self, prompt_id):
+        prompt_id = min(prompt_id, self.combination_count)
+        if self.sample is None or prompt_id < 1:
+            return max(prompt_id, 0)
+        position = (prompt_id * self.sample - 1) // self.combination_count + 1  # Slice holding the prompt ID
+        return position if self.get_prompt_id(position) <= prompt_id else position - 1
+
+    # Method to get the template and the words bound by a prompt ID
+    def get_bindings(self, prompt_id):
+        number = prompt_id - 1
+        template_number = bisect.bisect_right(self.first_numbers, number) - 1
+        template = self.templates[template_number]
+        indices = template.get_word_indices(number - self.first_numbers[template_number])
+        return template_number, [self.wordlists[name][index] for name, index in zip(template.names, indices)]
+
+    # Method to expand the prompt of a prompt ID
+    def get_prompt(self, prompt_id):
+        template_number, words = self.get_bindings(prompt_id)
+        return self.templates[template_number].render(words)
+
+    # Method to describe the template and the words a prompt ID was expanded from
+    def describe(self, prompt_id):
+        template_number, words = self.get_bindings(prompt_id)
+        template = self.templates[template_number]
+        return {"id": prompt_id, "template": template_number + 1, "text": template.text,
+                "bindings": dict(zip(template.names, words)), "prompt": template.render(words)}
+
+
+# Class to read the prompts of a template suite like those of a plain prompts file, expanding them lazily in the
+# order of their IDs (the IDs number the prompts in the output, and stay the same across samples and shards)
+class TemplateParser(FileParser):
+    def __init__(self, prompts_file, guidelines_file):
+        super().__init__(prompts_file, guidelines_file)
+        self.suite = TemplateSuite(prompts_file)
+
+    # Property to check whether the prompts file holds several conversations
+    @property
+    def has_multiple_conversations(self):
+        return False
+
+    # Method to count the prompts of the suite, without expanding them
+    def count_prompts(self):
+        return self.suite.prompt_count
+
+    # Method to find where each shard of the suite starts (a shard is expanded from its first position, so there is
+    # no byte offset to look up)
+    def get_shard_offsets(self, shard_size):
+        prompt_count = self.suite.prompt_count
+        return [(first_index, 0) for first_index in range(1, prompt_count + 1, shard_size)], prompt_count
+
+    # Method to get the position of the last prompt whose ID does not exceed the given one
+    def get_prompt_position(self, index):
+        return self.suite.get_position(index)
+
+    # Method to lazily expand the prompts of the suite along with their IDs
+    # (or only the prompts of a range of positions, Example: a shard)
+    async def stream_indexed_prompts(self, first_index=1, offset=0, last_index=None):
+        prompt_count = self.suite.prompt_count
+        last_index = prompt_count if last_index is None else min(last_index, prompt_count)
+        for position in range(first_index, last_index + 1):
+            prompt_id = self.suite.get_prompt_id(position)
+            yield prompt_id, self.suite.get_prompt(prompt_id)
+
+
+# Function to parse the command-line arguments of the prompt ID lookup
+def parse_settings():
+    parser = argparse.ArgumentParser(description='Describe the template and the words the given prompt IDs of a '
+                                                 'template suite were expanded from, as JSON lines')
+    parser.add_argument('suite_file', help='Template suite file (.yaml)')
+    parser.add_argument('prompt_ids', type=int, nargs='+', help='Prompt IDs (the # column of the output)')
+    return parser.parse_args()
+
+
+# Starting point of the prompt ID lookup
+if __name__ == "__main__":
+    settings = parse_settings()
+    setup_program()
+    template_suite = TemplateSuite(settings.suite_file)
+    for requested_id in settings.prompt_ids:
+        if not 1 <= requested_id <= template_suite.combination_count:
+            handle_error(f"Prompt ID {requested_id} is out of the range of the suite "
+                         f"(1-{template_suite.combination_count}).",
+                         f"Prompt ID {requested_id} was out of range.", is_warning=True)
+            continue
+        print(json.dumps(template_suite.describe(requested_id), ensure_ascii=False))
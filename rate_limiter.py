@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+# Import the required modules
+from required_modules import asyncio, time
+
+# Rough number of characters per token for English text, used to estimate the token count of a request
+CHARS_PER_TOKEN = 4
+
+# Token overhead added by the OpenAI API for every message in a chat completion request
+TOKENS_PER_MESSAGE = 4
+
+
+# Function to estimate the number of tokens in a list of chat messages
+def estimate_message_tokens(messages):
+    return sum(TOKENS_PER_MESSAGE + len(message["content"] or "") // CHARS_PER_TOKEN for message in messages)
+
+
+# Function to estimate the number of tokens a chat completion request counts against the tokens-per-minute limit
+def estimate_request_tokens(messages, max_tokens, n=1):
+    return estimate_message_tokens(messages) + (max_tokens or 0) * (n or 1)
+
+
+# Class to model a bucket that holds up to a minute's worth of capacity and refills continuously
+class TokenBucket:
+    def __init__(self, capacity_per_minute):
+        self.capacity = capacity_per_minute
+        self.refill_rate = capacity_per_minute / 60  # Capacity regained per second
+        self.level = capacity_per_minute  # Start with a full bucket
+        self.last_refill = time.monotonic()
+
+    # Method to top up the bucket based on the time elapsed since the last refill
+    def refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.last_refill) * self.refill_rate)
+        self.last_refill = now
+
+    # Method to get the time in seconds until the requested amount becomes available
+    def get_wait_time(self, amount):
+        self.refill()
+
+        # A request larger than the whole bucket only waits for a full bucket, otherwise it would never be sent
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) / self.refill_rate
+
+    # Method to take the requested amount out of the bucket (the level may go negative and is paid back over time)
+    def consume(self, amount):
+        self.refill()
+        self.level -= amount
+
+    # Method to give back capacity that was over-reserved
+    def refund(self, amount):
+        self.refill()
+        self.level = min(self.capacity, self.level + amount)
+
+
+# Class to shape the traffic sent to the OpenAI API with requests-per-minute and tokens-per-minute buckets
+class RateLimiter:
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None, delay=0):
+        self.request_bucket = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.delay = delay  # Minimum spacing in seconds between two consecutive requests
+        self.next_request_time = 0.0  # Earliest time at which the next request may be sent
+        self.lock = asyncio.Lock()  # Serve the waiting requests in arrival order
+
+    # Method to wait until a request with the estimated token count may be sent, and reserve its capacity
+    async def acquire(self, estimated_tokens):
+        started = time.monotonic()
+
+        async with self.lock:
+            while True:
+                wait_times = [self.next_request_time - time.monotonic()]
+                if self.request_bucket:
+                    wait_times.append(self.request_bucket.get_wait_time(1))
+                if self.token_bucket:
+                    wait_times.append(self.token_bucket.get_wait_time(estimated_tokens))
+
+                wait_time = max(wait_times)
+                if wait_time <= 0:
+                    break
+                await asyncio.sleep(wait_time)
+
+            if self.request_bucket:
+                self.request_bucket.consume(1)
+            if self.token_bucket:
+                self.token_bucket.consume(estimated_tokens)
+            self.next_request_time = time.monotonic() + self.delay
+
+        return time.monotonic() - started  # Time spent waiting for the rate limiter
+
+    # Method to correct the reserved token count once the actual usage is reported by the OpenAI API
+    def record_usage(self, estimated_tokens, actual_tokens):
+        if not self.token_bucket or actual_tokens is None:
+            return
+
+        if actual_tokens < estimated_tokens:
+            self.token_bucket.refund(estimated_tokens - actual_tokens)
+        else:
+            self.token_bucket.consume(actual_tokens - estimated_tokens)
+
+    # Method to hold back every request until the server-suggested wait time has passed (Example: after an HTTP 429)
+    def pause(self, seconds):
+        self.next_request_time = max(self.next_request_time, time.monotonic() + seconds)
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+
+# Import the required modules
+from concurrency_controller import get_percentile
+from required_modules import asyncio, collections, time
+
+
+# Class to hedge the slow requests: once a request has been waiting longer than a latency percentile learned during
+# the run, a duplicate request is sent, the first response wins and the other request is cancelled
+# (the duplicates are capped to a share of the requests, so that the cost stays bounded, and to a number in flight at
+# once, which the connection pool keeps room for)
+class RequestHedger:
+    def __init__(self, percentile=95, budget=0.05, min_samples=20, window_size=1000, max_in_flight=None):
+        self.percentile = percentile  # Latency percentile after which a request is hedged
+        self.budget = budget  # Maximum share of duplicate requests
+        self.min_samples = min_samples  # Latencies recorded before the first request is hedged
+        self.latencies = collections.deque(maxlen=window_size)  # Latencies of the most recent successful requests
+        self.new_samples = 0  # Latencies recorded since the hedge delay was last computed
+        self.hedge_delay = None  # Seconds after which a request is hedged (None: not learned yet)
+        self.max_in_flight = max_in_flight  # Maximum duplicates in flight at once (None: unlimited)
+        self.hedges_in_flight = 0
+        self.requests = 0  # Requests sent, duplicates left out
+        self.hedges_fired = 0
+        self.hedges_won = 0  # Duplicates that answered before the request they duplicated
+
+    # Method to record the latency of a successful request, and follow the percentile as the latencies drift
+    def record_latency(self, latency):
+        self.latencies.append(latency)
+        self.new_samples += 1
+        if len(self.latencies) >= self.min_samples and (self.hedge_delay is None or
+                                                        self.new_samples >= self.min_samples):
+            self.hedge_delay = get_percentile(self.latencies, self.percentile)
+            self.new_samples = 0
+
+    # Property to check whether a duplicate request fits the hedge budget
+    @property
+    def can_hedge(self):
+        return (self.hedge_delay is not None and self.hedges_fired < self.budget * self.requests and
+                (self.max_in_flight is None or self.hedges_in_flight < self.max_in_flight))
+
+    # Method to send a request through the given coroutine function, hedging it with a duplicate if it is slow
+    # (send_attempt takes whether the attempt is the duplicate, and raises the error of a failed attempt)
+    async def send(self, send_attempt):
+        self.requests += 1
+        started = time.monotonic()
+        request = asyncio.ensure_future(send_attempt(False))
+        hedge = None
+        try:
+            if self.hedge_delay is not None:
+                await asyncio.wait({request}, timeout=self.hedge_delay)
+            if not request.done() and self.can_hedge:
+                self.hedges_fired += 1
+                self.hedges_in_flight += 1
+                hedge_started = time.monotonic()
+                hedge = asyncio.ensure_future(send_attempt(True))
+
+                # The first successful response wins, and the error of the request is raised if both of them fail
+                pending = {request, hedge}
+                while pending:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    winners = [attempt for attempt in done if attempt.exception() is None]
+                    if winners:
+                        if winners[0] is hedge:
+                            self.hedges_won += 1
+                            self.record_latency(time.monotonic() - hedge_started)
+                        else:
+                            self.record_latency(time.monotonic() - started)
+                        return winners[0].result()
+
+            result = await request
+            self.record_latency(time.monotonic() - started)
+            return result
+
+        # Cancel the losing request, or both of them when the caller is cancelled
+        finally:
+            for attempt in (request, hedge):
+                if attempt and not attempt.done():
+                    attempt.cancel()
+            if hedge:
+                self.hedges_in_flight -= 1
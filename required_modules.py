@@ -1,37 +1,45 @@
 #!/usr/bin/env python3
 
-try:
-    # Import the standard modules
-    import argparse
-    import asyncio
-    import json
-    import logging
-    import os
-    import sys
-    import time
-
-    # Import the third-party modules
-    import aiofiles
-    import aiohttp
-    import argcomplete
-    import yaml
-    from alive_progress import alive_bar
-    from dotenv import load_dotenv
-    from openai import OpenAI
-
-    load_dotenv()  # Load the .env file
-
-# Handle the missing modules
-except ModuleNotFoundError as e:
-    missing_module = e.name
+# Import the standard modules
+import abc
+import argparse
+import array
+import asyncio
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import copy
+import csv
+import hashlib
+import heapq
+import importlib
+import importlib.util
+import json
+import logging
+import math
+import os
+import random
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+from urllib.parse import quote, urlsplit
 
+
+# Function to report a missing module along with how to install it, and exit the program
+def report_missing_module(missing_module):
     if missing_module == 'argcomplete':
         action = "Install it using 'pip install argcomplete && activate-global-python-argcomplete'."
     elif missing_module == 'dotenv':
         action = "Install it using 'pip install python-dotenv'."
     elif missing_module == 'yaml':
         action = "Install it using 'pip install PyYAML'."
-    elif missing_module in ['aiofiles', 'aiohttp', 'alive_progress', 'openai', 'portalocker']:
+    elif missing_module in ['aiofiles', 'aiohttp', 'alive_progress', 'portalocker']:
         action = f"Install it using 'pip install {missing_module}'."
     else:
         action = "Consider upgrading Python."
@@ -39,3 +47,50 @@ except ModuleNotFoundError as e:
     print(f"\033[91m\n[⛔] Error: Required Python module '{missing_module}' is missing. {action} "
           f"Exiting program.\n\033[00m")
     exit(1)
+
+
+# Class to defer the import of a module (or of a single attribute of it) until it is first used,
+# so that runs that never touch it (Example: --help, or runs without the response cache) start faster
+class LazyModule:
+    def __init__(self, module_name, attribute=None):
+        self.module_name = module_name
+        self.attribute = attribute
+        self.target = None
+
+    # Method to import the module on first use
+    def load(self):
+        if self.target is None:
+            try:
+                module = importlib.import_module(self.module_name)
+            except ModuleNotFoundError as e:
+                report_missing_module(e.name)
+            self.target = getattr(module, self.attribute) if self.attribute else module
+        return self.target
+
+    def __getattr__(self, name):
+        return getattr(self.load(), name)
+
+    def __call__(self, *args, **kwargs):
+        return self.load()(*args, **kwargs)
+
+
+# Check that the third-party modules are installed without importing them yet
+for required_module in ['aiofiles', 'aiohttp', 'alive_progress', 'argcomplete', 'dotenv', 'yaml']:
+    if importlib.util.find_spec(required_module) is None:
+        report_missing_module(required_module)
+
+# Import the third-party modules lazily
+aiofiles = LazyModule('aiofiles')
+aiohttp = LazyModule('aiohttp')
+argcomplete = LazyModule('argcomplete')
+yaml = LazyModule('yaml')
+alive_bar = LazyModule('alive_progress', 'alive_bar')
+
+# Import the standard modules only some of the runs need lazily as well
+sqlite3 = LazyModule('sqlite3')
+base64 = LazyModule('base64')
+parsedate_to_datetime = LazyModule('email.utils', 'parsedate_to_datetime')
+
+# Load the .env file
+from dotenv import load_dotenv
+load_dotenv()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+
+# Import the required modules and the helper functions
+from helper import handle_error
+from openai_api_request_wrapper import ChatCompletionResponses
+from required_modules import asyncio, collections, hashlib, json, sqlite3, time
+
+# Request parameters that identify a response in the cache
+CACHE_KEY_FIELDS = ("model", "messages", "max_tokens", "n", "stop", "temperature")
+
+# Number of writes between two size-based evictions
+EVICTION_INTERVAL = 100
+
+
+# Function to derive the cache key from a request payload (a hash of its canonical JSON form)
+def get_cache_key(payload):
+    canonical_payload = json.dumps({field: payload.get(field) for field in CACHE_KEY_FIELDS},
+                                   sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256(canonical_payload.encode('utf-8')).hexdigest()
+
+
+# Class to persist the responses of the OpenAI API in an SQLite database, keyed by the request payload
+class ResponseCache:
+    def __init__(self, cache_file, mode, ttl=None, max_entries=None):
+        self.mode = mode  # read, write or readwrite
+        self.ttl = ttl  # Maximum age of a cached response in seconds (None: never expires)
+        self.max_entries = max_entries  # Maximum number of cached responses (None: unlimited)
+        self.hits = 0
+        self.misses = 0
+        self.writes_since_eviction = 0
+
+        try:
+            self.connection = sqlite3.connect(cache_file)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, responses TEXT, "
+                                    "created_at REAL, last_used REAL)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+            self.connection.commit()
+        except sqlite3.Error as e:
+            handle_error(f"Response cache '{cache_file}' could not be opened: {e}. Aborting launch!",
+                         f"Response cache '{cache_file}' could not be opened: {e}.")
+
+    # Property to check whether cached responses may be served
+    @property
+    def is_readable(self):
+        return self.mode in ('read', 'readwrite')
+
+    # Property to check whether new responses may be stored
+    @property
+    def is_writable(self):
+        return self.mode in ('write', 'readwrite')
+
+    # Method to look up the cached responses for a request payload (None on a miss)
+    def get(self, payload):
+        key = get_cache_key(payload)
+        row = self.connection.execute("SELECT responses, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+        now = time.time()
+
+        if row and self.ttl is not None and now - row[1] > self.ttl:
+            # Drop the expired response
+            if self.is_writable:
+                self.connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.connection.commit()
+            row = None
+
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        if self.is_writable:
+            self.connection.execute("UPDATE responses SET last_used = ? WHERE key = ?", (now, key))
+            self.connection.commit()
+        responses = json.loads(row[0])
+
+        # Entries written before the details of the responses were cached only hold the responses
+        if isinstance(responses, list):
+            responses = {"responses": responses}
+        return responses
+
+    # Method to store the responses (and their details) for a request payload
+    def put(self, payload, responses):
+        now = time.time()
+        self.connection.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+                                (get_cache_key(payload), json.dumps(responses, ensure_ascii=False), now, now))
+        self.connection.commit()
+
+        self.writes_since_eviction += 1
+        if self.writes_since_eviction >= EVICTION_INTERVAL:
+            self.evict()
+
+    # Method to drop the expired responses and the least recently used ones beyond the size limit
+    def evict(self):
+        self.writes_since_eviction = 0
+        if self.ttl is not None:
+            self.connection.execute("DELETE FROM responses WHERE created_at < ?", (time.time() - self.ttl,))
+        if self.max_entries is not None:
+            self.connection.execute("DELETE FROM responses WHERE key IN (SELECT key FROM responses "
+                                    "ORDER BY last_used DESC LIMIT -1 OFFSET ?)", (self.max_entries,))
+        self.connection.commit()
+
+    # Method to close the cache
+    def close(self):
+        if self.is_writable:
+            self.evict()
+        self.connection.close()
+
+
+# Class to send identical requests of a run only once (Example: the same prompt under two identical guidelines files)
+# (requests in flight are shared, and the latest successful responses are only remembered in memory, ahead of the
+# cache, at temperature 0 or when reusing finished requests is asked for, so that sampled responses stay independent)
+class RequestDeduplicator:
+    def __init__(self, max_entries=None):
+        self.max_entries = max_entries  # Maximum number of remembered responses (None: unlimited)
+        self.requests = collections.OrderedDict()  # Future of the responses per cache key, oldest first
+        self.hits = 0
+
+    # Method to get the responses for a request payload, sending the request only if no identical one was sent
+    # (only requests at temperature 0 are shared, as sampled ones are expected to get responses of their own)
+    async def get_or_send(self, payload, send_request):
+        if payload.get("temperature") != 0:
+            return await send_request()
+
+        key = get_cache_key(payload)
+        request = self.requests.get(key)
+        if request is not None:
+            self.hits += 1
+            self.requests.move_to_end(key)
+            responses = await asyncio.shield(request)
+            return ChatCompletionResponses.from_dict(responses.to_dict(), cached=True)
+
+        request = asyncio.get_running_loop().create_future()
+        self.requests[key] = request
+        try:
+            responses = await send_request()
+        except BaseException:
+            self.requests.pop(key, None)
+            request.cancel()
+            raise
+        request.set_result(responses)
+
+        # Failed requests are only shared while in flight, so that a later identical request is sent again
+        if not responses or "error" in responses.finish_reasons:
+            self.requests.pop(key, None)
+        while self.max_entries is not None and len(self.requests) > self.max_entries:
+            self.requests.popitem(last=False)
+        return responses
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+
+# Import the required modules and the helper functions
+from concurrency_controller import get_percentile
+from helper import handle_error
+from required_modules import array, collections, json, random, time
+
+# Percentiles reported for the latencies
+REPORTED_PERCENTILES = (50, 95, 99)
+
+# Values kept per series to estimate the percentiles from, however long the run
+SAMPLE_SIZE = 10000
+
+
+# Class to keep a uniform sample of a series of values (reservoir sampling), so that the memory stays flat however many
+# values are recorded, while their count and total stay exact
+class ReservoirSample:
+    def __init__(self, capacity=SAMPLE_SIZE, seed=0):
+        self.capacity = capacity
+        self.values = array.array('d')
+        self.count = 0  # Values recorded, sampled or not
+        self.total = 0.0
+        self.random = random.Random(seed)  # Seeded, so that the reported percentiles are reproducible
+
+    # Method to record a value, which replaces a random one of the sample once the sample is full
+    def append(self, value):
+        self.count += 1
+        self.total += value
+        if len(self.values) < self.capacity:
+            self.values.append(value)
+        else:
+            slot = self.random.randrange(self.count)
+            if slot < self.capacity:
+                self.values[slot] = value
+
+    def __len__(self):
+        return len(self.values)
+
+    def __iter__(self):
+        return iter(self.values)
+
+
+# Class to record the performance of a run: request latencies, waits, retries, token usage and status codes
+class RunMetrics:
+    def __init__(self):
+        self.started = time.monotonic()
+        self.started_at = time.time()  # Wall-clock time the prompts started being processed at
+        self.finished = None
+        self.latencies = ReservoirSample()  # HTTP latency of the request attempts
+        self.ttfts = ReservoirSample()  # Time to first token of the streamed results
+        self.queue_waits = ReservoirSample()  # Time the prompts waited for a concurrency slot
+        self.rate_limiter_waits = ReservoirSample()  # Time the request attempts waited for the rate limiter
+        self.status_codes = collections.Counter()  # Outcome of every request attempt ('network' for network errors)
+        self.results = 0  # Prompts whose result was recorded
+        self.cached_results = 0
+        self.failed_results = 0  # Prompts recorded with the finish reason 'error' (or left out with --on_failure skip)
+        self.retries = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+
+    # Method to (re)start the clock once the prompts start being processed
+    def start(self):
+        self.started = time.monotonic()
+        self.started_at = time.time()
+
+    # Method to stop the clock
+    def stop(self):
+        self.finished = time.monotonic()
+
+    # Property to get the duration of the run in seconds
+    @property
+    def elapsed(self):
+        return max(1e-9, (self.finished or time.monotonic()) - self.started)
+
+    # Method to record the time a request attempt waited for the rate limiter
+    def record_rate_limiter_wait(self, seconds):
+        self.rate_limiter_waits.append(seconds)
+
+    # Method to record the time a prompt waited for a concurrency slot
+    def record_queue_wait(self, seconds):
+        self.queue_waits.append(seconds)
+
+    # Method to record a single request attempt (status is None for network errors and timeouts)
+    def record_request(self, latency, status):
+        self.latencies.append(latency)
+        self.status_codes[status or 'network'] += 1
+
+    # Method to record the result recorded for a prompt
+    def record_result(self, responses):
+        self.results += 1
+        self.retries += getattr(responses, "retries", 0)
+        if getattr(responses, "cached", False):
+            self.cached_results += 1
+        if not responses or "error" in getattr(responses, "finish_reasons", []):
+            self.failed_results += 1
+        if getattr(responses, "ttft", None) is not None:
+            self.ttfts.append(responses.ttft)
+        self.record_usage(responses)
+
+    # Method to record the tokens used by a request (Example: a summary of the conversation history, which is not a
+    # result of its own)
+    def record_usage(self, responses):
+        # Cached and deduplicated responses cost no tokens in this run
+        usage = getattr(responses, "usage", {}) if not getattr(responses, "cached", False) else {}
+        self.prompt_tokens += usage.get("prompt_tokens") or 0
+        self.completion_tokens += usage.get("completion_tokens") or 0
+
+    # Method to get the requested percentiles of a series of values (None when there are no values)
+    @staticmethod
+    def get_percentiles(values):
+        return {percentile: get_percentile(values, percentile) if values else None
+                for percentile in REPORTED_PERCENTILES}
+
+    # Method to get the average of a series of values (over every recorded value, not only the sampled ones)
+    @staticmethod
+    def get_average(values):
+        return values.total / values.count if values.count else 0.0
+
+    # Method to summarize the run in a dictionary (Example: for the JSON export)
+    def to_dict(self):
+        requests = sum(self.status_codes.values())
+        total_tokens = self.prompt_tokens + self.completion_tokens
+        return {
+            "started_at": self.started_at,
+            "elapsed_seconds": self.elapsed,
+            "results": self.results,
+            "cached_results": self.cached_results,
+            "failed_results": self.failed_results,
+            "requests": requests,
+            "requests_per_second": requests / self.elapsed,
+            "retries": self.retries,
+            "status_codes": {str(status): count for status, count in self.status_codes.most_common()},
+            "latency_seconds": {f"p{percentile}": value
+                                for percentile, value in self.get_percentiles(self.latencies).items()},
+            "ttft_seconds": {f"p{percentile}": value
+                             for percentile, value in self.get_percentiles(self.ttfts).items()},
+            "average_queue_wait_seconds": self.get_average(self.queue_waits),
+            "average_rate_limiter_wait_seconds": self.get_average(self.rate_limiter_waits),
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "tokens_per_second": total_tokens / self.elapsed
+        }
+
+    # Method to summarize the run in a few lines for the terminal
+    def get_report(self):
+        summary = self.to_dict()
+        report = {
+            "Requests": f"{summary['requests']} sent in {summary['elapsed_seconds']:.1f}s "
+                        f"({summary['requests_per_second']:.2f}/s), {summary['retries']} retried",
+            "Tokens": f"{summary['prompt_tokens']} prompt + {summary['completion_tokens']} completion "
+                      f"({summary['tokens_per_second']:.1f}/s)"
+        }
+        if self.latencies:
+            report["Latency p50/p95/p99"] = " / ".join(f"{value:.2f}s"
+                                                       for value in summary["latency_seconds"].values())
+        if self.ttfts:
+            report["Time to first token p50/p95/p99"] = " / ".join(f"{value:.2f}s"
+                                                                   for value in summary["ttft_seconds"].values())
+        report["Average wait"] = (f"{summary['average_queue_wait_seconds']:.2f}s for a thread, "
+                                  f"{summary['average_rate_limiter_wait_seconds']:.2f}s for the rate limits")
+
+        errors = {status: count for status, count in summary["status_codes"].items() if status != '200'}
+        if errors:
+            report["Errors"] = ", ".join(f"{status} × {count}" for status, count in errors.items())
+        return report
+
+    # Method to write the summary as a Prometheus text file (Example: for the node exporter's textfile collector)
+    def to_prometheus(self):
+        summary = self.to_dict()
+        lines = []
+
+        # Function to add a metric with its type, and one sample per label set
+        def add_metric(name, metric_type, help_text, samples):
+            lines.append(f"# HELP sniperchatai_{name} {help_text}")
+            lines.append(f"# TYPE sniperchatai_{name} {metric_type}")
+            for labels, value in samples:
+                label_text = ",".join(f'{key}="{label}"' for key, label in labels.items())
+                lines.append(f"sniperchatai_{name}{{{label_text}}} {value}" if labels else
+                             f"sniperchatai_{name} {value}")
+
+        add_metric("requests_total", "counter", "Request attempts sent to the OpenAI API by status code.",
+                   [({"status": status}, count) for status, count in summary["status_codes"].items()])
+        add_metric("results_total", "counter", "Prompts whose result was recorded.", [({}, summary["results"])])
+        add_metric("cached_results_total", "counter", "Results served from the response cache.",
+                   [({}, summary["cached_results"])])
+        add_metric("failed_results_total", "counter", "Prompts that failed after all retries.",
+                   [({}, summary["failed_results"])])
+        add_metric("retries_total", "counter", "Retried request attempts.", [({}, summary["retries"])])
+        add_metric("tokens_total", "counter", "Tokens reported by the OpenAI API.",
+                   [({"type": "prompt"}, summary["prompt_tokens"]),
+                    ({"type": "completion"}, summary["completion_tokens"])])
+        add_metric("request_latency_seconds", "summary", "HTTP latency of the request attempts.",
+                   [({"quantile": percentile / 100}, value)
+                    for percentile, value in self.get_percentiles(self.latencies).items() if value is not None])
+        add_metric("ttft_seconds", "summary", "Time to first token of the streamed responses.",
+                   [({"quantile": percentile / 100}, value)
+                    for percentile, value in self.get_percentiles(self.ttfts).items() if value is not None])
+        add_metric("average_wait_seconds", "gauge", "Average wait per prompt or request attempt.",
+                   [({"for": "thread"}, summary["average_queue_wait_seconds"]),
+                    ({"for": "rate_limits"}, summary["average_rate_limiter_wait_seconds"])])
+        add_metric("run_duration_seconds", "gauge", "Duration of the run.", [({}, summary["elapsed_seconds"])])
+        return "\n".join(lines) + "\n"
+
+    # Method to export the summary to a JSON file ('.json' extension) or a Prometheus text file (any other extension)
+    def export(self, metrics_file):
+        try:
+            with open(metrics_file, 'w', encoding='utf-8') as file:
+                if metrics_file.lower().endswith('.json'):
+                    json.dump(self.to_dict(), file, indent=2)
+                else:
+                    file.write(self.to_prometheus())
+        except OSError as e:
+            handle_error(f"Metrics could not be exported to '{metrics_file}': {e}. The output is unaffected!",
+                         f"Metrics could not be exported to '{metrics_file}': {e}.", is_warning=True)
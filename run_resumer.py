@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+# Import the required modules and the helper functions
+from helper import handle_error
+from openai_api_request_wrapper import ERROR_RESPONSE_PREFIX
+from required_modules import array, csv, os, zlib
+
+
+# Function to compute a compact checksum of a prompt, used to verify that the output matches the prompts file
+def get_prompt_checksum(prompt):
+    return zlib.crc32(prompt.encode('utf-8'))
+
+
+# Class to rebuild the state of an interrupted run from the output file it left behind
+class RunResumer:
+    def __init__(self, output_file, responses_per_prompt):
+        self.output_file = output_file
+        self.responses_per_prompt = responses_per_prompt  # Rows expected per prompt (-n)
+        self.completed = bytearray()  # One flag per prompt index, set once its rows are recorded
+        self.checksums = array.array('L')  # Checksum of the recorded prompt per index
+        self.last_responses = {}  # Last recorded response per index (only kept in conversation mode)
+        self.completed_count = 0  # Number of completed prompts
+        self.last_completed_index = 0  # Highest completed prompt index
+
+    # Method to flag a prompt index as completed
+    def mark_completed(self, index, prompt):
+        if index >= len(self.completed):
+            growth = max(index + 1, 2 * len(self.completed)) - len(self.completed)
+            self.completed.extend(bytes(growth))
+            self.checksums.extend([0] * growth)
+        if not self.completed[index]:
+            self.completed_count += 1
+        self.completed[index] = 1
+        self.checksums[index] = get_prompt_checksum(prompt)
+        self.last_completed_index = max(self.last_completed_index, index)
+
+    # Method to check whether a prompt index is already recorded in the output file
+    def is_completed(self, index):
+        return index < len(self.completed) and self.completed[index] == 1
+
+    # Method to stream the output file, index the recorded prompts and cut off a partially written last result
+    def load(self, conversation_mode):
+        if not os.path.exists(self.output_file):
+            handle_error(f"Output file '{self.output_file}' to resume from is nowhere to be found. Aborting launch!",
+                         f"Output file '{self.output_file}' to resume from could not be found.")
+
+        position = 0  # Byte offset up to which the output file has been read
+        line_complete = True  # Whether the last line read ends with a newline
+        truncate_at = None  # Byte offset of the first partially written row, if any
+        last_group = None  # Index, prompt, row count, start offset and first response of the result being read
+
+        with open(self.output_file, 'rb') as file:
+            # Yield the decoded lines while keeping track of the byte offset
+            def read_lines():
+                nonlocal position, line_complete
+                for line in file:
+                    position += len(line)
+                    line_complete = line.endswith(b'\n')
+                    yield line.decode('utf-8', errors='replace')
+
+            reader = csv.reader(read_lines())
+            next(reader, None)  # Skip the header row
+            row_start = position
+            try:
+                for row in reader:
+                    # A row that does not end with a newline was cut off while being written
+                    if not line_complete or len(row) < 3 or not row[0].isdigit():
+                        truncate_at = row_start
+                        break
+
+                    index, prompt, response = int(row[0]), row[1], row[2]
+                    if last_group and last_group[0] == index:
+                        last_group[2] += 1
+                    else:
+                        if last_group:
+                            self.mark_completed(last_group[0], last_group[1])
+                        last_group = [index, prompt, 1, row_start, response]
+
+                    if conversation_mode == 'on':
+                        # Responses of failed requests never made it into the conversation history
+                        self.last_responses[index] = "" if response.startswith(ERROR_RESPONSE_PREFIX) else response
+                    row_start = position
+
+            # A quoted field left open at the end of the file was cut off while being written
+            except csv.Error:
+                truncate_at = row_start
+
+        # Only the last result can be partially written, as the results are written in order
+        if last_group:
+            index, prompt, row_count, group_start, first_response = last_group
+            is_error_row = row_count == 1 and first_response.startswith(ERROR_RESPONSE_PREFIX)
+            if truncate_at is not None or (row_count < self.responses_per_prompt and not is_error_row):
+                truncate_at = group_start
+                self.last_responses.pop(index, None)
+            else:
+                self.mark_completed(index, prompt)
+
+        if truncate_at is not None:
+            with open(self.output_file, 'r+b') as file:
+                file.truncate(truncate_at)
+            handle_error(f"Partially written output at the end of '{self.output_file}' discarded. "
+                         f"Those prompts will be sent again.",
+                         f"Truncated output file '{self.output_file}' at byte {truncate_at} to drop a partially "
+                         f"written result.", is_warning=True)
+
+    # Method to verify that a recorded prompt matches the prompts file
+    def verify_prompt(self, index, prompt):
+        if self.checksums[index] != get_prompt_checksum(prompt):
+            handle_error(f"Prompt #{index} in '{self.output_file}' does not match the prompts file. "
+                         f"Resuming a different prompt suite? Aborting launch!",
+                         f"Prompt #{index} recorded in '{self.output_file}' does not match the prompts file.")
+
+    # Method to get the highest recorded index among the indexed prompts of a conversation
+    def get_last_recorded_index(self, indexed_prompts):
+        return max((index for index, _ in indexed_prompts if self.is_completed(index)), default=0)
+
+    # Method to filter out the prompts of a conversation that are already recorded in the output file
+    def get_pending_prompts(self, indexed_prompts, conversation_mode):
+        last_recorded_index = self.get_last_recorded_index(indexed_prompts)
+
+        pending_prompts = []
+        for index, prompt in indexed_prompts:
+            if self.is_completed(index):
+                self.verify_prompt(index, prompt)
+            # A conversation only continues after its last recorded prompt, gaps were part of the conversation
+            elif conversation_mode == 'off' or index > last_recorded_index:
+                pending_prompts.append((index, prompt))
+        return pending_prompts
+
+    # Method to lazily filter out the prompts of a single streamed conversation that are already recorded
+    # (in conversation mode, the conversation history is rebuilt on the way; without it, the prompts missing from the
+    # middle of the output file are handed out again, and end up after the recorded rows)
+    async def filter_pending_prompts(self, indexed_prompts, conversation_mode, conversation_history):
+        async for index, prompt in indexed_prompts:
+            if self.is_completed(index):
+                self.verify_prompt(index, prompt)
+
+            # A conversation only continues after its last recorded prompt, gaps were part of the conversation
+            if conversation_mode == 'on' and index <= self.last_completed_index:
+                conversation_history.append((prompt, self.last_responses.get(index, "")))
+            elif not self.is_completed(index):
+                yield index, prompt
+
+    # Method to count the pending prompts of a single streamed conversation
+    # (get_prompt_position tells how many prompts come up to an index, Example: in a sampled template suite)
+    def count_pending_prompts(self, prompt_count, conversation_mode, get_prompt_position=None):
+        if conversation_mode == 'on':
+            recorded_prompts = (get_prompt_position(self.last_completed_index) if get_prompt_position
+                                else self.last_completed_index)
+            return max(0, prompt_count - recorded_prompts)
+        return max(0, prompt_count - self.completed_count)
+
+    # Method to rebuild the history of a conversation from its recorded prompts and responses
+    def get_conversation_history(self, indexed_prompts):
+        last_recorded_index = self.get_last_recorded_index(indexed_prompts)
+        return [(prompt, self.last_responses.get(index, "")) for index, prompt in indexed_prompts
+                if index <= last_recorded_index]
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+
+# Import the required modules and the helper functions
+from helper import config, handle_error, print_status_messages
+from output_writer import OutputWriter
+from required_modules import alive_bar, asyncio, contextlib, logging, os, shutil, subprocess, sys
+from work_queue import get_worker_id, WorkQueue
+
+# Arguments of the coordinator that are not passed on to the local worker processes
+COORDINATOR_ONLY_ARGUMENTS = {'--local_workers', '--work_queue_role', '--metrics_file', '--output_file'}
+
+
+# Function to derive the command-line arguments of a local worker process from those of the coordinator
+def get_worker_arguments(coordinator_arguments, worker_number, metrics_file=None):
+    worker_arguments = []
+    skip_value = False
+    for argument in coordinator_arguments:
+        if skip_value:
+            skip_value = False
+            continue
+        if argument.split('=', 1)[0] in COORDINATOR_ONLY_ARGUMENTS:
+            skip_value = '=' not in argument  # The value follows as a separate argument
+            continue
+        worker_arguments.append(argument)
+
+    worker_arguments += ['--work_queue_role', 'worker', '--quiet']
+
+    # Each worker exports its own metrics next to those of the coordinator
+    if metrics_file:
+        base_filename, extension = os.path.splitext(metrics_file)
+        worker_arguments += ['--metrics_file', f"{base_filename}_worker_{worker_number}{extension}"]
+    return worker_arguments
+
+
+# Class to process the prompts shard by shard through a work queue shared by several worker processes
+# (which may run on different hosts sharing the filesystem, each with its own API key), and to merge the output of
+# the shards into the ordered output file once every shard is done
+class ShardRunner:
+    def __init__(self, args, file_parser, prompt_count, scoring_pipeline=None):
+        tuning = config['work_queue_tuning']
+        self.args = args
+        self.file_parser = file_parser
+        self.prompt_count = prompt_count
+        self.scoring_pipeline = scoring_pipeline  # Scores the responses of every shard (None: scoring is off)
+        self.shard_size = tuning['shard_size']  # Prompts per shard
+        self.poll_interval = tuning['poll_interval']  # Seconds between two checks for shards to pick up
+        self.lease_seconds = tuning['lease_seconds']
+        self.is_coordinator = args.work_queue_role == 'coordinator'
+        self.worker_id = get_worker_id()
+        self.work_queue = WorkQueue(args.work_queue, self.lease_seconds, create=self.is_coordinator)
+        self.local_workers = []  # Worker processes started by the coordinator
+        self.processed_shards = 0
+        self.total_shards = 0
+
+    # Method to fill the work queue with the shards (coordinator only), and to check that it belongs to this run
+    # (returns False when the output of every shard has already been merged)
+    def prepare(self):
+        if self.is_coordinator:
+            shard_offsets, prompt_count = self.file_parser.get_shard_offsets(self.shard_size)
+            self.work_queue.create(shard_offsets, prompt_count, {
+                "prompts_file": os.path.abspath(self.args.prompts_file),
+                "prompt_count": prompt_count,
+                "output_file": os.path.abspath(self.args.output_file),
+                "output_format": self.args.output_format
+            })
+
+        settings = self.work_queue.get_settings()
+        if int(settings["prompt_count"]) != self.prompt_count or settings["output_format"] != self.args.output_format:
+            handle_error(f"Work queue '{self.args.work_queue}' was created for {settings['prompt_count']} prompts "
+                         f"from '{settings['prompts_file']}' with the output format '{settings['output_format']}'. "
+                         f"Pass the same prompts file and output format. Aborting launch!",
+                         f"Work queue '{self.args.work_queue}' did not match the prompts file or the output format.")
+
+        # The output of every worker ends up next to the output file of the coordinator
+        self.args.output_file = settings["output_file"]
+        self.total_shards = len(self.work_queue.get_shards())
+        return "merged" not in settings
+
+    # Method to get the output file of a single lease of a shard
+    def get_shard_output_file(self, shard_id, attempt):
+        base_filename, extension = os.path.splitext(self.args.output_file)
+        return f"{base_filename}_shard_{shard_id}_{attempt}{extension}"
+
+    # Method to start the local worker processes, which run with the same arguments as the coordinator
+    def start_local_workers(self):
+        for worker_number in range(1, self.args.local_workers + 1):
+            command = [sys.executable, os.path.abspath(sys.argv[0])] + get_worker_arguments(
+                sys.argv[1:], worker_number, self.args.metrics_file)
+            self.local_workers.append(subprocess.Popen(command))
+
+    # Method to renew the lease of a shard while it is being processed
+    async def renew_lease_periodically(self, shard):
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            if not self.work_queue.renew_lease(shard, self.worker_id):
+                logging.warning(f"Lease of shard {shard['shard_id']} was taken over by another worker.")
+                return
+
+    # Method to process the prompts of a leased shard into its own output file
+    async def process_shard(self, session, shard, prompt_orchestrator, bar):
+        shard_file = self.get_shard_output_file(shard["shard_id"], shard["attempt"])
+        output_writer = OutputWriter(shard_file, self.args.output_format, False, config.get('output_flush_rows'),
+                                     config.get('output_flush_interval'), config.get('output_fsync_interval'),
+                                     scoring_pipeline=self.scoring_pipeline)
+        await output_writer.open()
+        prompt_orchestrator.output_writer = output_writer
+
+        renewal_task = asyncio.create_task(self.renew_lease_periodically(shard))
+        completed = False
+        try:
+            # The output of the shard is flushed and closed before the shard is marked as done, or handed back
+            try:
+                prompts = self.file_parser.stream_indexed_prompts(shard["first_index"], shard["file_offset"],
+                                                                  shard["last_index"])
+                await prompt_orchestrator.process_prompts_concurrently(
+                    session, prompts, shard["last_index"] - shard["first_index"] + 1, bar)
+            finally:
+                output_writer.close()
+
+            completed = self.work_queue.complete_shard(shard, self.worker_id, shard_file)
+            if completed:
+                self.processed_shards += 1
+            else:
+                # Another worker took the shard over after the lease expired, so its output is used instead
+                handle_error(f"Shard {shard['shard_id']} was taken over by another worker after its lease expired. "
+                             f"Its output here is discarded!",
+                             f"Lease of shard {shard['shard_id']} expired before it was done.", is_warning=True)
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(shard_file)
+
+        # Hand the shard back right away if it could not be finished (Example: the worker was interrupted)
+        finally:
+            renewal_task.cancel()
+            if not completed:
+                self.work_queue.release_shard(shard, self.worker_id)
+
+    # Method to concatenate the output of the shards, in order, into the output file
+    def merge_output_files(self):
+        shards = self.work_queue.get_shards()
+        try:
+            with open(self.args.output_file, 'wb') as output_file:
+                for position, (_, shard_file, _) in enumerate(shards):
+                    with open(shard_file, 'rb') as shard_output:
+                        if self.args.output_format == 'csv' and position:
+                            shard_output.readline()  # Keep the header row of the first shard only
+                        shutil.copyfileobj(shard_output, output_file)
+                output_file.flush()
+                os.fsync(output_file.fileno())
+        except OSError as e:
+            handle_error(f"Output of the shards could not be merged into '{self.args.output_file}': {e}. "
+                         f"Aborting mission!", f"Output of the shards could not be merged: {e}.")
+        self.work_queue.set_setting("merged", self.args.output_file)
+
+        # Remove the output of the shards, along with any output left behind by workers whose lease expired
+        for shard_id, _, attempts in shards:
+            for attempt in range(1, attempts + 1):
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(self.get_shard_output_file(shard_id, attempt))
+
+    # Method to process shards until none is left to pick up, then (coordinator only) wait for the shards of the
+    # other workers and merge the output
+    async def run(self, session, prompt_orchestrator):
+        if not self.prepare():
+            print_status_messages("nothing_left_to_resume", self.args)
+            return
+        if self.is_coordinator:
+            self.start_local_workers()
+
+        try:
+            # The coordinator follows the progress of every worker, a worker only its own
+            with alive_bar(self.prompt_count if self.is_coordinator else None, disable=self.args.quiet) as bar:
+                prompts_done_elsewhere = 0
+                while True:
+                    shard = self.work_queue.lease_shard(self.worker_id)
+                    if shard:
+                        await self.process_shard(session, shard, prompt_orchestrator, bar)
+                    elif not self.is_coordinator or self.work_queue.is_finished:
+                        break
+                    else:
+                        # Wait for the shards leased by the other workers, which are picked up here if a lease expires
+                        await asyncio.sleep(self.poll_interval)
+
+                    if self.is_coordinator:
+                        done_prompts = self.work_queue.count_done_prompts(excluded_worker_id=self.worker_id)
+                        if done_prompts > prompts_done_elsewhere:
+                            bar(done_prompts - prompts_done_elsewhere)
+                            prompts_done_elsewhere = done_prompts
+        # Wait for the local workers without blocking the event loop (Example: the requests still in flight here)
+        finally:
+            for worker in self.local_workers:
+                if await asyncio.get_running_loop().run_in_executor(None, worker.wait):
+                    handle_error(f"Local worker process {worker.pid} exited with the code {worker.returncode}. "
+                                 f"Its unfinished shards are picked up by the other workers!",
+                                 f"Local worker process {worker.pid} exited with the code {worker.returncode}.",
+                                 is_warning=True)
+
+        if self.is_coordinator:
+            self.merge_output_files()
+        self.work_queue.close()
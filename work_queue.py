@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+
+# Import the required modules and the helper functions
+from helper import handle_error
+from required_modules import os, socket, sqlite3, time
+
+
+# Function to get an identifier of the current worker process, unique across the hosts sharing a work queue
+def get_worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+# Class to share the shards of a prompts file between worker processes through an SQLite database
+# (each shard is leased by a single worker at a time, and the lease of a crashed worker expires so that another
+# worker picks the shard up again)
+class WorkQueue:
+    def __init__(self, queue_file, lease_seconds, create=False):
+        self.queue_file = queue_file
+        self.lease_seconds = lease_seconds  # Seconds a lease lasts unless it is renewed
+
+        # Only the coordinator creates the work queue, the workers join an existing one
+        if not create and not os.path.exists(queue_file):
+            handle_error(f"Work queue '{queue_file}' not found. Start the coordinator first. Aborting launch!",
+                         f"Work queue '{queue_file}' could not be found.")
+
+        try:
+            # Transactions are started explicitly, so that leasing a shard is atomic across the processes
+            self.connection = sqlite3.connect(queue_file, timeout=60, isolation_level=None)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value TEXT)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS shards (shard_id INTEGER PRIMARY KEY, "
+                                    "first_index INTEGER, last_index INTEGER, file_offset INTEGER, "
+                                    "status TEXT DEFAULT 'pending', worker_id TEXT, lease_expires_at REAL, "
+                                    "attempts INTEGER DEFAULT 0, output_file TEXT)")
+        except sqlite3.Error as e:
+            handle_error(f"Work queue '{queue_file}' could not be opened: {e}. Aborting launch!",
+                         f"Work queue '{queue_file}' could not be opened: {e}.")
+
+    # Method to fill a new work queue with the shards of the prompts file, along with the settings of the run
+    # (returns False when the work queue was filled before, Example: by an earlier coordinator run)
+    def create(self, shard_offsets, prompt_count, settings):
+        with self.connection:
+            self.connection.execute("BEGIN IMMEDIATE")
+            if self.connection.execute("SELECT COUNT(*) FROM settings").fetchone()[0]:
+                return False
+
+            self.connection.executemany("INSERT INTO settings VALUES (?, ?)", settings.items())
+            last_indices = [first_index - 1 for first_index, _ in shard_offsets[1:]] + [prompt_count]
+            self.connection.executemany(
+                "INSERT INTO shards (first_index, last_index, file_offset) VALUES (?, ?, ?)",
+                [(first_index, last_index, offset)
+                 for (first_index, offset), last_index in zip(shard_offsets, last_indices)])
+            return True
+
+    # Method to get the settings of the run the work queue was created for
+    def get_settings(self):
+        return dict(self.connection.execute("SELECT name, value FROM settings"))
+
+    # Method to record a setting of the run (Example: once the output has been merged)
+    def set_setting(self, name, value):
+        self.connection.execute("INSERT OR REPLACE INTO settings VALUES (?, ?)", (name, str(value)))
+
+    # Method to lease the next pending shard, or a shard whose lease has expired (None when there is none)
+    def lease_shard(self, worker_id):
+        now = time.time()
+        with self.connection:
+            self.connection.execute("BEGIN IMMEDIATE")
+            row = self.connection.execute(
+                "SELECT shard_id, first_index, last_index, file_offset, attempts FROM shards "
+                "WHERE status = 'pending' OR (status = 'leased' AND lease_expires_at < ?) "
+                "ORDER BY shard_id LIMIT 1", (now,)).fetchone()
+            if row is None:
+                return None
+
+            shard_id, first_index, last_index, file_offset, attempts = row
+            self.connection.execute("UPDATE shards SET status = 'leased', worker_id = ?, lease_expires_at = ?, "
+                                    "attempts = ? WHERE shard_id = ?",
+                                    (worker_id, now + self.lease_seconds, attempts + 1, shard_id))
+
+        # The attempt number tells the leases of a shard apart, in case an expired lease is still being worked on
+        return {"shard_id": shard_id, "first_index": first_index, "last_index": last_index,
+                "file_offset": file_offset, "attempt": attempts + 1}
+
+    # Method to extend the lease of a shard (returns False when the lease has been taken over by another worker)
+    def renew_lease(self, shard, worker_id):
+        with self.connection:
+            cursor = self.connection.execute(
+                "UPDATE shards SET lease_expires_at = ? WHERE shard_id = ? AND status = 'leased' AND worker_id = ? "
+                "AND attempts = ?", (time.time() + self.lease_seconds, shard["shard_id"], worker_id, shard["attempt"]))
+        return cursor.rowcount == 1
+
+    # Method to mark a leased shard as done along with its output file
+    # (returns False when the lease has been taken over by another worker, whose output is used instead)
+    def complete_shard(self, shard, worker_id, output_file):
+        with self.connection:
+            cursor = self.connection.execute(
+                "UPDATE shards SET status = 'done', output_file = ?, lease_expires_at = NULL WHERE shard_id = ? "
+                "AND status = 'leased' AND worker_id = ? AND attempts = ?",
+                (output_file, shard["shard_id"], worker_id, shard["attempt"]))
+        return cursor.rowcount == 1
+
+    # Method to hand a leased shard back right away (Example: when the worker is interrupted)
+    def release_shard(self, shard, worker_id):
+        with self.connection:
+            self.connection.execute(
+                "UPDATE shards SET status = 'pending', worker_id = NULL, lease_expires_at = NULL WHERE shard_id = ? "
+                "AND status = 'leased' AND worker_id = ? AND attempts = ?",
+                (shard["shard_id"], worker_id, shard["attempt"]))
+
+    # Method to count the prompts of the finished shards, optionally leaving out those of a given worker
+    def count_done_prompts(self, excluded_worker_id=None):
+        return self.connection.execute(
+            "SELECT COALESCE(SUM(last_index - first_index + 1), 0) FROM shards WHERE status = 'done' "
+            "AND worker_id IS NOT ?", (excluded_worker_id,)).fetchone()[0]
+
+    # Property to check whether every shard is done
+    @property
+    def is_finished(self):
+        return not self.connection.execute("SELECT COUNT(*) FROM shards WHERE status != 'done'").fetchone()[0]
+
+    # Method to get every shard in order, along with its output file and the number of times it was leased
+    def get_shards(self):
+        return self.connection.execute("SELECT shard_id, output_file, attempts FROM shards "
+                                       "ORDER BY shard_id").fetchall()
+
+    # Method to close the work queue
+    def close(self):
+        self.connection.close()